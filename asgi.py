@@ -0,0 +1,279 @@
+""" Async serving mode of the backend.
+
+An ASGI app, served by uvicorn workers under gunicorn (see the 'web-async' entry of the Procfile),
+that answers the I/O-bound read end points without holding a thread while it waits on Spotify, which
+is called through httpx, and only holds a storage thread while it waits on MongoDB (async_database.py),
+so one worker keeps many requests in flight instead of one per thread. The Server-Sent Events streams
+of friends' updates are async generators too, so open streams hold no thread and are not limited
+to STREAM_MAX_OPEN. Every other route, and the paginated or streamed variants of the list end points,
+is handed to the Flask app of backend.py, which runs on a thread pool, so both modes answer the same
+requests with the same responses.
+
+Writes (e.g. storing the current track fetched from Spotify) keep going through the Database
+methods on the thread pool, which bump the resource versions and publish the live events.
+"""
+
+import time
+import httpx
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_etags, quote_etag
+import backend
+import metrics
+from async_database import get_async_database, shutdown_executor
+from backend import (RESPONSE_HEADER, STREAM_HEADER, ensure_event_feed, format_event, friend_lists,
+                     store_current_track_response, stored_track_info)
+from current_track_cache import get_current_track_cache
+from database_manager import get_converted_email
+from json_encoding import dumps
+from pubsub import AsyncSubscription, get_broker
+from response_cache import get_versions_async, make_etag, response_bodies, user_key, REACTIONS_KEY
+from spotify_client import AsyncSpotifyClient, get_spotify_client
+from token_manager import get_token_manager
+
+""" Query parameters of the paginated and streamed variants, which are served by the Flask app """
+PAGING_PARAMS = ('after', 'limit', 'format')
+
+flask_app = WSGIMiddleware(backend.app)
+
+_spotify = None
+
+
+class AsyncEndpoint:
+    """ ASGI app answering with the Response returned by handler(request), timed like the Flask
+    routes. Requests for which delegate(request) is true are handed to the Flask app instead """
+
+    def __init__(self, route, handler, delegate=None):
+        self.route = route
+        self.handler = handler
+        self.delegate = delegate
+
+    async def __call__(self, scope, receive, send):
+        request = Request(scope, receive)
+        if self.delegate is not None and self.delegate(request):
+            await flask_app(scope, receive, send)
+            return
+        # tasks share the event loop thread, so their stacks cannot be told apart by the profiler
+        metrics.start_request(sample_stacks=False)
+        try:
+            response = await self.handler(request)
+        finally:
+            timer = metrics.finish_request(self.route)
+        if metrics.SERVER_TIMING and timer is not None:
+            response.headers['Server-Timing'] = timer.server_timing()
+        await response(scope, receive, send)
+
+
+def paged(request):
+    """ Returns True if the request asks for a page or a stream rather than the whole list """
+    return any(param in request.query_params for param in PAGING_PARAMS)
+
+
+def int_param(request, name):
+    """ Returns the query parameter name as an int, None if it is missing or not a number """
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def flag_param(request, name):
+    """ Returns True if the query parameter name is given and not '0' or 'false' """
+    return request.query_params.get(name, '') not in ('', '0', 'false')
+
+
+def json_response(payload, status=200):
+    """ Returns payload serialized as a JSON response """
+    return Response(dumps(payload), status, RESPONSE_HEADER, media_type='application/json')
+
+# Conditional, cached JSON response
+
+
+async def cached_json_response(request, keys, build):
+    """ backend.cached_json_response for an async build(): same ETags, same 304s
+    and the same cache of serialized bodies """
+    versions = await get_versions_async(keys, get_async_database().get_versions)
+    etag = make_etag(f'{request.url.path}?{request.url.query}', versions)
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=dict(RESPONSE_HEADER, etag=quote_etag(etag)))
+    body = response_bodies.get(etag)
+    status = 200
+    if body is None:
+        payload, status = await build()
+        body = dumps(payload)
+        if status == 200:
+            response_bodies.put(etag, body)
+    response = Response(body, status, RESPONSE_HEADER,
+                        media_type='application/json')
+    if status == 200:
+        response.headers['etag'] = quote_etag(etag)
+    return response
+
+
+async def friends_feed_keys(email):
+    """ backend.friends_feed_keys with async reads, sharing its cache of friend lists """
+    key = user_key(get_converted_email(email))
+    database = get_async_database()
+    version = (await get_versions_async([key], database.get_versions))[key]
+    friends = friend_lists.get((key, version))
+    if friends is None:
+        user = await database.get_user(email, {"_id": 0, "friends": 1})
+        friends = [user_key(friend)
+                   for friend in user['friends']] if user else []
+        friend_lists.put((key, version), friends)
+    return [key] + friends
+
+# End points
+
+
+async def get_user(request):
+    """ GET /user/<email>: the complete user """
+    email = request.path_params['email']
+    summary_only = flag_param(request, 'summary_only')
+
+    async def build():
+        user = await get_async_database().get_complete_user(email, summary_only=summary_only)
+        if user:
+            return {'user': user}, 200
+        return {"error": "User not found"}, 404
+    return await cached_json_response(request, [user_key(get_converted_email(email))], build)
+
+
+async def get_friends(request):
+    """ GET /user/friends/<email>: the complete users of a user's friends """
+    email = request.path_params['email']
+    limit = int_param(request, 'limit')
+    songs_per_friend = int_param(request, 'songs_per_friend')
+    summary_only = flag_param(request, 'summary_only')
+
+    async def build():
+        friends = await get_async_database().get_friends_feed(email, limit, songs_per_friend, summary_only)
+        if friends is not None:
+            return {'friends': friends}, 200
+        return {"error": "User not found"}, 404
+    return await cached_json_response(request, await friends_feed_keys(email), build)
+
+
+async def get_song_history(request):
+    """ GET /songs/<email>: a user's whole song history """
+    email = request.path_params['email']
+
+    async def build():
+        song_history = await get_async_database().get_all_song_history_from_user(email)
+        if song_history:
+            return {'song_history': song_history}, 200
+        return {"error": "song history not found"}, 404
+    return await cached_json_response(request, [user_key(get_converted_email(email))], build)
+
+
+async def get_all_reactions(request):
+    """ GET /reactions: all reactions """
+    async def build():
+        return {'reactions': await get_async_database().get_all_reactions()}, 200
+    return await cached_json_response(request, [REACTIONS_KEY], build)
+
+
+async def get_current_track(request):
+    """ GET /current-track/<email>: the track a user is playing, polls for the same user share one load """
+    email = request.path_params['email']
+    if backend.CURRENT_TRACK_SOURCE == 'database':
+        def loader(): return get_stored_current_track(email)
+    else:
+        def loader(): return refresh_current_track(email)
+    track = await get_current_track_cache().get_async(get_converted_email(email), loader)
+    if track:
+        return json_response(track)
+    # like Werkzeug, a 204 has no body
+    return Response(status_code=204, headers=RESPONSE_HEADER)
+
+
+async def refresh_current_track(email):
+    """ backend.refresh_current_track with the Spotify call made through httpx """
+    # stored tokens are almost always served from the token manager's memory,
+    # it only reads the database or refreshes the token on the thread pool when they expire
+    access_token = await run_in_threadpool(get_token_manager().get_access_token, email)
+    response = None
+    if access_token:
+        try:
+            response = await get_async_spotify_client().get_currently_playing(access_token)
+        except httpx.TransportError:
+            pass
+    return await run_in_threadpool(store_current_track_response, email, response)
+
+
+async def stream_friends_events(request):
+    """ GET /stream/friends/<email>: backend.stream_friends_events without holding a thread per open stream """
+    email = request.path_params['email']
+    database = get_async_database()
+    if not await database.user_exists(email):
+        return json_response({"error": "User not found"}, 404)
+    await run_in_threadpool(ensure_event_feed)
+    friends = [get_converted_email(friend)
+               for friend in await database.get_all_user_friends(email)]
+    subscription = get_broker().subscribe(friends, AsyncSubscription)
+    return StreamingResponse(server_sent_events(subscription), 200, STREAM_HEADER,
+                             media_type='text/event-stream')
+
+
+async def server_sent_events(subscription):
+    """ backend.server_sent_events awaiting the events of an AsyncSubscription """
+    deadline = time.monotonic() + backend.STREAM_MAX_SECONDS
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            event = await subscription.get(timeout=backend.STREAM_HEARTBEAT_SECONDS)
+            yield format_event(subscription, event)
+    finally:
+        get_broker().unsubscribe(subscription)
+
+
+async def get_stored_current_track(email):
+    """ backend.get_stored_current_track with an async read """
+    user = await get_async_database().get_user(email, {"_id": 0, "current_track": 1})
+    return stored_track_info(user)
+
+# Application
+
+
+def get_async_spotify_client():
+    """ Returns the worker's AsyncSpotifyClient, created on first use on the worker's event loop,
+    against the same Spotify urls as the Flask app's client """
+    global _spotify
+    if _spotify is None:
+        spotify = get_spotify_client()
+        _spotify = AsyncSpotifyClient(
+            api_url=spotify.api_url, accounts_url=spotify.accounts_url)
+    return _spotify
+
+
+async def shutdown():
+    """ Close the httpx client and stop the storage threads """
+    global _spotify
+    if _spotify is not None:
+        await _spotify.close()
+        _spotify = None
+    shutdown_executor()
+
+
+app = Starlette(routes=[
+    Route('/user/{email}', AsyncEndpoint('/user/<email>', get_user),
+          methods=['GET']),
+    Route('/user/friends/{email}', AsyncEndpoint('/user/friends/<email>', get_friends),
+          methods=['GET']),
+    Route('/songs/{email}', AsyncEndpoint('/songs/<email>', get_song_history, paged),
+          methods=['GET']),
+    Route('/reactions', AsyncEndpoint('/reactions', get_all_reactions, paged),
+          methods=['GET']),
+    Route('/current-track/stats', flask_app),
+    Route('/current-track/spotify', flask_app),
+    Route('/current-track/{email}', AsyncEndpoint('/current-track/<email>', get_current_track),
+          methods=['GET']),
+    Route('/stream/friends/{email}', AsyncEndpoint('/stream/friends/<email>', stream_friends_events),
+          methods=['GET']),
+    # everything else, including the other methods of the routes above
+    Mount('', flask_app),
+], on_shutdown=[shutdown])
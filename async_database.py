@@ -0,0 +1,74 @@
+""" Awaitable storage for the ASGI app of asgi.py.
+
+AsyncStorage exposes the methods of the storage engine selected by STORAGE_BACKEND as coroutines.
+MongoDB calls run on a thread pool with as many threads as the connection pool has connections,
+so a request waiting on MongoDB only holds a pool thread for the duration of the query, never
+while it waits on Spotify. That is also how Motor works, whose 2.x line (the one for PyMongo 3)
+does not run on current Python versions, and it keeps a single implementation of every query.
+Calls of the memory engine never wait on I/O and run on the event loop directly.
+"""
+
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import database_manager
+from database_manager import get_database, DB_MAX_POOL_SIZE
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ Returns the process-wide thread pool MongoDB calls run on, creating it on first use.
+    Like the MongoClient, a pool inherited from a parent process is not reused after a fork """
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _executor_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(
+                    max_workers=DB_MAX_POOL_SIZE, thread_name_prefix='storage')
+                _executor_pid = pid
+    return _executor
+
+
+def shutdown_executor():
+    """ Stop the thread pool, the next get_executor() call builds a new one """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=False)
+        _executor = None
+        _executor_pid = None
+
+
+def get_async_database():
+    """ Returns the storage engine selected by STORAGE_BACKEND with awaitable methods """
+    if database_manager.STORAGE_BACKEND == 'memory':
+        return AsyncStorage(get_database())
+    return AsyncStorage(get_database(), get_executor())
+
+
+class AsyncStorage:
+    """ Wraps a storage engine so its methods can be awaited. With an executor the calls run on it,
+    in a copy of the caller's context so their MongoDB commands count towards its request metrics.
+    Without one they run inline """
+
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self.storage, name)
+
+        async def call(*args, **kwargs):
+            if self.executor is None:
+                return method(*args, **kwargs)
+            context = contextvars.copy_context()
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(context.run, method, *args, **kwargs))
+        return call
@@ -7,11 +7,22 @@
 
 """ The module below is to get user authorization using the Spotify 'Authorization Code Flow' """
 
-import requests
-from flask import Flask, request, url_for, session, jsonify, redirect, render_template, make_response
+from flask import Flask, request, url_for, session, jsonify, redirect, render_template, make_response, Response, stream_with_context
 from flask_cors import CORS
 from urllib.parse import urlencode
-from database_manager import User, Song, Reaction, Database, get_converted_email, get_original_email
+from database_manager import User, Song, Reaction, get_database, ValidationError, validate_payload, get_converted_email, get_original_email, ping_database
+from spotify_client import get_spotify_client, parse_current_track
+from token_manager import get_token_manager
+from current_track_cache import get_current_track_cache
+from pubsub import get_broker, ensure_change_stream_feed
+from json_encoding import MongoJSONEncoder, dumps
+from response_cache import get_versions, make_etag, response_bodies, LRUCache, user_key, REACTIONS_KEY
+import database_manager
+import metrics
+from bson.errors import InvalidId
+import requests
+import threading
+import time
 import uuid
 import os
 
@@ -30,19 +41,7 @@ We can grab the code from the argument of our callback url.
 """
 SPOTIFY_AUTH_URL = 'https://accounts.spotify.com/authorize?'
 
-"""
-Url where we can get the token info by providing the code.
-Using the code that we got by requesting to the above url as one of the parameters,
-we can get the token info from Spotify.
-Token info consists of the access token, the expiration time, and the refresh token.
-"""
-SPOTIFY_ACCESS_TOKEN_URL = 'https://accounts.spotify.com/api/token'
-
-""" End point url to get user current track """
-SPOTIFY_GET_CURRENT_TRACK_URL = 'https://api.spotify.com/v1/me/player/currently-playing'
-
-""" End point url to get user account information """
-SPOTIFY_GET_USER_PROFILE_URL = 'https://api.spotify.com/v1/me'
+# the token, current track and user profile end points are called through spotify_client
 # end of SPOTIFY END POINTS
 
 # SPOTIFY DEVELOPER APP CREDENTIALS
@@ -52,6 +51,7 @@ CLIENT_SECRET = os.environ.get('SPOTIFY_CLIENT_SECRET')
 # end of SPOTIFY DEVELOPER APP CREDENTIALS
 
 app = Flask(__name__)
+app.json_encoder = MongoJSONEncoder
 CORS(app)
 
 app.secret_key = os.environ.get('APP_SECRET_KEY')
@@ -61,6 +61,34 @@ RESPONSE_HEADER = {"Access-Control-Allow-Origin": "*",
                    "Access-Control-Allow-Methods": "GET,PUT,POST,DELETE,OPTIONS",
                    "Access-Control-Allow-Headers": "Content-Type"}
 
+STREAM_HEADER = dict(RESPONSE_HEADER, **{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+""" Friend lists of the users whose friends feed was requested, keyed by (user key, version) """
+friend_lists = LRUCache()
+
+""" Where GET /current-track/<email> reads from: 'spotify', or 'database' when poller.py keeps current tracks up to date """
+CURRENT_TRACK_SOURCE = os.environ.get('CURRENT_TRACK_SOURCE', 'spotify')
+
+""" Seconds between keep-alive comments on event streams, and the longest time a stream stays open
+(browsers' EventSource reconnects by itself, which also picks up changes to the friend list) """
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 300))
+
+""" Event streams a process keeps open at once. Every stream holds a worker thread for up to
+STREAM_MAX_SECONDS, so keep it below GUNICORN_THREADS (the async mode of asgi.py has no limit) """
+STREAM_MAX_OPEN = int(os.environ.get('STREAM_MAX_OPEN', 2))
+stream_slots = threading.BoundedSemaphore(STREAM_MAX_OPEN)
+
+""" Milliseconds a client turned away because all STREAM_MAX_OPEN streams are open waits before it reconnects """
+STREAM_BUSY_RETRY_MS = int(os.environ.get('STREAM_BUSY_RETRY_MS', 30000))
+
+""" Number of documents per page on paginated end points when no limit is given, and the largest limit allowed """
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+""" Most users POST /users:batch returns at once """
+MAX_BATCH_USERS = int(os.environ.get('MAX_BATCH_USERS', 100))
+
 # @app.after_request
 # def after_request(response):
 #   response.headers.add('Access-Control-Allow-Origin', '*')
@@ -103,15 +131,20 @@ def callback():
             'client_secret': CLIENT_SECRET
         }
 
-        response = requests.post(
-            SPOTIFY_ACCESS_TOKEN_URL, data=request_data).json()
+        response = get_spotify_client().request_token(request_data).json()
+        if 'access_token' not in response:
+            return jsonify({"success": "False"}), 400
         session['token_info'] = response
+        session.pop('logged_user', None)
 
         # insert user to database
         user_data = get_user_spotify_data()
         insert_user_to_database(user_data)
         session['logged_user'] = get_converted_email(user_data['email'])
 
+        # keep the token server side, so it can be refreshed and used by any worker
+        get_token_manager().save_token_info(user_data['email'], response)
+
         return redirect('http://localhost:3000/home')
     return jsonify({"success": "False"}), 400
 
@@ -123,27 +156,36 @@ def get_current_track(email):
     """ Returns the current playing track of a user, access token is needed. Or insert a current playing track given by the frontend. """
     if request.method == 'GET':
         #logged_user = session['logged_user']
-        response = get_user_current_track()
+        # concurrent and repeated polls for the same user share one Spotify call and database write
+        if CURRENT_TRACK_SOURCE == 'database':
+            loader = lambda: get_stored_current_track(email)
+        else:
+            loader = lambda: refresh_current_track(email)
+        response = get_current_track_cache().get(get_converted_email(email), loader)
         if response:
-            # insert the current track to the logged in user's database
-            song = Song(email, response['id'], response['track_name'], response['artists'],
-                        "", response['link'], response['image_url'], response['preview_url'])
-            Database().update_current_track(email, song)
             response = jsonify(response), 200, RESPONSE_HEADER
             return response
-        Database().update_current_track(email, None)
         response = jsonify(
             {"error": "there is no track playing."}), 204, RESPONSE_HEADER
         return response
     elif request.method == 'POST':
         # insert the current track to the logged in user's database
-        new_song_json = request.get_json()
-        song = Song(email, new_song_json['song_id'], new_song_json['song_name'], new_song_json['song_artists'],
-                    "", new_song_json['song_url'], new_song_json['song_image_url'], new_song_json['preview_url'])
-        Database().update_current_track(email, song)
+        new_song_json = request.get_json(silent=True)
+        song = Song.from_payload(email, new_song_json)
+        save_current_track(email, song)
+        # later polls must not be answered with the track cached before this one
+        get_current_track_cache().invalidate(get_converted_email(email))
         response = jsonify({'new_song': new_song_json}), 201, RESPONSE_HEADER
         return response
 
+# End point with the current track cache counters, for tuning CURRENT_TRACK_CACHE_TTL
+
+
+@app.route('/current-track/stats')
+def get_current_track_stats():
+    """ Returns the hit, miss and coalesce counters of the current track cache """
+    return jsonify(get_current_track_cache().get_stats()), 200, RESPONSE_HEADER
+
 # End point to get user's currently playing track using Python requests
 
 
@@ -167,6 +209,31 @@ def get_user_profile():
         return response
     return jsonify({"error": "User not found"}), 404
 
+# Request metrics, see metrics.py
+
+
+@app.before_request
+def start_request_timer():
+    """ Start attributing database, Spotify and serialization time to this request """
+    metrics.start_request()
+
+
+@app.after_request
+def finish_request_timer(response):
+    """ Add the request to the per-route histograms, and send its Server-Timing header if enabled.
+    Streamed responses are only timed until their headers are sent """
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    timer = metrics.finish_request(route)
+    if metrics.SERVER_TIMING and timer is not None:
+        response.headers['Server-Timing'] = timer.server_timing()
+    return response
+
+
+@app.route('/metrics')
+def get_metrics():
+    """ Per-route latency histograms in the Prometheus text format """
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
 # End point of the home page
 
 
@@ -175,11 +242,21 @@ def welcome():
     """ Home page of the backend """
     return 'Welcome Home!'
 
+# End point for load balancer / uptime health checks
+
+
+@app.route('/health')
+def health_check():
+    """ Returns 200 if the database is reachable, 503 otherwise """
+    if ping_database():
+        return jsonify({"database": "ok"}), 200
+    return jsonify({"database": "unreachable"}), 503
+
 # Get user from database
 # @app.route('/user/<email>')
 # def get_user_from_db(email):
-#     if Database().user_exists(email):
-#         user_data = Database().get_user(email)
+#     if get_database().user_exists(email):
+#         user_data = get_database().get_user(email)
 #         return jsonify({'user': user_data}), 200
 #     return jsonify({"error":"User not found"}), 404
 
@@ -190,17 +267,18 @@ def welcome():
 def get_user_from_db(email):
     """ Get user from database or insert user to database """
     if request.method == 'GET':
-        if Database().user_exists(email):
-            user = get_complete_user_info(email)
+        summary_only = flag_arg('summary_only')
+
+        def build():
+            user = get_complete_user_info(email, summary_only)
             if user:
                 # # also get the current playing track if the <email> is the current logged in user
                 # if user['email'] == session['logged_user']:
                 #     current_track = get_user_current_track()
                 #     user['current_track'] = current_track
-                response = jsonify({'user': user}), 200, RESPONSE_HEADER
-                return response
-        response = jsonify({"error": "User not found"}), 404, RESPONSE_HEADER
-        return response
+                return {'user': user}, 200
+            return {"error": "User not found"}, 404
+        return cached_json_response([user_key(get_converted_email(email))], build)
 
     elif request.method == 'POST':
         user_data = request.get_json()
@@ -208,25 +286,69 @@ def get_user_from_db(email):
         response = jsonify({'user': user_data}), 201, RESPONSE_HEADER
         return response
 
+# Get many users at once
+
+
+@app.route('/users:batch', methods=['POST'])
+def get_users_batch():
+    """ Get the complete user data of the emails in the request body, optionally only some fields
+    (?fields=current_track,song_history or "fields" in the body), as a map keyed by email.
+    Unknown users map to null """
+    batch_json = request.get_json(silent=True)
+    emails = batch_json.get('emails') if isinstance(batch_json, dict) else None
+    if not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return jsonify({"error": "emails must be a list of emails"}), 400, RESPONSE_HEADER
+    if len(emails) > MAX_BATCH_USERS:
+        return jsonify({"error": f"at most {MAX_BATCH_USERS} emails per batch"}), 400, RESPONSE_HEADER
+    fields = batch_json.get('fields', request.args.get('fields'))
+    if isinstance(fields, str):
+        fields = [field for field in fields.split(',') if field]
+    if fields is not None and not (isinstance(fields, list) and all(isinstance(field, str) for field in fields)):
+        return jsonify({"error": "fields must be a comma separated string or a list of field names"}), 400, RESPONSE_HEADER
+    try:
+        users = get_database().get_complete_users(emails, fields)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400, RESPONSE_HEADER
+    response = jsonify({'users': {email: users.get(get_converted_email(email))
+                                  for email in emails}}), 200, RESPONSE_HEADER
+    return response
+
 # Get all friends or insert a friend for a user
 
 
 @app.route('/user/friends/<email>', methods=['GET', 'POST', 'DELETE'])
 def get_or_insert_friend_for_user(email):
     if request.method == 'GET':
-        if Database().user_exists(email):
-            result = []
-            friends = Database().get_all_user_friends(email)
-            for friend in friends:
-                friend_data = get_complete_user_info(friend)
-                result.append(friend_data)
-            response = jsonify({'friends': result}), 200, RESPONSE_HEADER
-            return response
-        response = jsonify({"error": "User not found"}), 404, RESPONSE_HEADER
-        return response
+        # optional paging of the feed: at most <limit> friends, each with their <songs_per_friend> latest songs
+        limit = request.args.get('limit', type=int)
+        songs_per_friend = request.args.get('songs_per_friend', type=int)
+        # reaction counts instead of the reactions of every song
+        summary_only = flag_arg('summary_only')
+
+        def build():
+            friends = get_database().get_friends_feed(
+                email, limit, songs_per_friend, summary_only)
+            if friends is not None:
+                return {'friends': friends}, 200
+            return {"error": "User not found"}, 404
+        return cached_json_response(friends_feed_keys(email), build)
     elif request.method == 'POST':
-        new_friend_json = request.get_json()
-        success = Database().insert_friend_to_user(
+        new_friend_json = validate_payload(request.get_json(silent=True), {"email": str}, {
+                                           "friend_email": str, "friend_emails": list, "mutual": bool})
+        if 'friend_emails' in new_friend_json:
+            # bulk import, optionally making each friendship mutual
+            if not all(isinstance(friend_email, str) for friend_email in new_friend_json['friend_emails']):
+                raise ValidationError("invalid fields: friend_emails")
+            new_friends = get_database().add_friends(
+                new_friend_json['email'], new_friend_json['friend_emails'], new_friend_json.get('mutual', False))
+            if new_friends is None:
+                response = jsonify({"error": "User not found"}), 404, RESPONSE_HEADER
+                return response
+            response = jsonify({'new_friends': new_friends}
+                               ), 201, RESPONSE_HEADER
+            return response
+        validate_payload(new_friend_json, {"friend_email": str})
+        success = get_database().insert_friend_to_user(
             new_friend_json['email'], new_friend_json['friend_email'])
         if success:
             new_friend = get_complete_user_info(
@@ -238,12 +360,15 @@ def get_or_insert_friend_for_user(email):
                            ), 204, RESPONSE_HEADER
         return response
     elif request.method == 'DELETE':
-        remove_friend_json = request.get_json()
-        if Database().user_exists(email):
-            Database().delete_friend(
+        remove_friend_json = validate_payload(request.get_json(silent=True), {
+                                              "email": str, "friend_email": str})
+        if get_database().user_exists(email):
+            get_database().delete_friend(
                 remove_friend_json['email'], remove_friend_json['friend_email'])
             response = jsonify(success=True), 204, RESPONSE_HEADER
             return response
+        response = jsonify({"error": "User not found"}), 404, RESPONSE_HEADER
+        return response
 
 # Get or insert song history for user
 
@@ -251,109 +376,355 @@ def get_or_insert_friend_for_user(email):
 @app.route('/songs/<email>', methods=['GET', 'POST'])
 def get_or_insert_song_history_from_db(email):
     if request.method == 'GET':
-        if Database().song_history_for_user_exists(email):
-            song_history = Database().get_all_song_history_from_user(email)
-            response = jsonify({'song_history': song_history}
-                               ), 200, RESPONSE_HEADER
+        response = paginated_response('song_history', lambda after, limit: get_database(
+        ).iter_song_history_from_user(email, after, limit))
+        if response:
             return response
-        response = jsonify(
-            {"error": "song history not found"}), 404, RESPONSE_HEADER
-        return response
+
+        def build():
+            song_history = get_database().get_all_song_history_from_user(email)
+            if song_history:
+                return {'song_history': song_history}, 200
+            return {"error": "song history not found"}, 404
+        return cached_json_response([user_key(get_converted_email(email))], build)
     elif request.method == 'POST':
-        song_history_json = request.get_json()
-        song_history = Song(song_history_json['email'], song_history_json['song_id'], song_history_json['song_name'],
-                            song_history_json['song_artists'], song_history_json['song_album'], song_history_json['song_url'], song_history_json['song_image_url'])
-        Database().create_song_history(song_history)
+        song_history_json = validate_payload(
+            request.get_json(silent=True), {"email": str})
+        song_history = Song.from_payload(
+            song_history_json['email'], song_history_json)
+        get_database().create_song_history(song_history)
         response = jsonify(
             {'song_history': song_history_json}), 201, RESPONSE_HEADER
         return response
 
+# Reaction counts, for views that only show how many people reacted
+
+
+@app.route('/reactions/summary')
+def get_reactions_summary():
+    """ Returns {song_id: number of reactions} of the songs a recipient received reactions for (?email=<email>),
+    or of the given songs across all recipients (?song_id=<id>, repeatable) """
+    email = request.args.get('email')
+    song_ids = request.args.getlist('song_id')
+    if email:
+        return cached_json_response([user_key(get_converted_email(email))],
+                                    lambda: ({'summary': get_database().get_reaction_counts(email)}, 200))
+    if song_ids:
+        return cached_json_response([REACTIONS_KEY],
+                                    lambda: ({'summary': get_database().get_song_reaction_counts(song_ids)}, 200))
+    response = jsonify({"error": "email or song_id is required"}
+                       ), 400, RESPONSE_HEADER
+    return response
+
 # Get and Insert reaction for a song to database
 
 
 @app.route('/reactions/<email>/<song_id>', methods=['GET', 'POST', 'DELETE'])
 def get_or_insert_reactions_from_db(email, song_id):
     if request.method == 'GET':
-        if Database().reaction_sender_exists(email, song_id):
-            reactions = Database().get_sender_reactions(email, song_id)
+        reactions = get_database().get_sender_reactions(email, song_id)
+        if reactions:
             response = jsonify({'reactions': reactions}), 200, RESPONSE_HEADER
             return response
         response = jsonify({"error": "reactions not found"}
                            ), 204, RESPONSE_HEADER
         return response
     elif request.method == 'POST':
-        reaction_json = request.get_json()
-        name = Database().get_user(reaction_json['email'])
-        name = name['name']
-        sender_name = Database().get_user(reaction_json['sender_email'])
-        sender_name = sender_name['name']
-        reaction = Reaction(reaction_json['email'], name, reaction_json['sender_email'], sender_name, reaction_json['song_id'], reaction_json['song_name'], reaction_json['song_artists'],
-                            reaction_json['song_album'], reaction_json['song_url'], reaction_json['song_image_url'], reaction_json['preview_url'], reaction_json['time_stamp'])
-        Database().create_reaction(reaction)
-        response = jsonify({'reaction': reaction_json}), 201, RESPONSE_HEADER
+        reaction_json = validate_payload(request.get_json(
+            silent=True), Reaction.PAYLOAD_FIELDS, Song.OPTIONAL_PAYLOAD_FIELDS)
+        # the names of the recipient and the sender, in one query
+        users = get_database().get_complete_users(
+            [reaction_json['email'], reaction_json['sender_email']], ['name'])
+        recipient = users.get(get_converted_email(reaction_json['email']))
+        sender = users.get(get_converted_email(reaction_json['sender_email']))
+        if recipient is None or sender is None:
+            response = jsonify({"error": "User not found"}
+                               ), 404, RESPONSE_HEADER
+            return response
+        reaction = Reaction.from_payload(
+            reaction_json, recipient['name'], sender['name'])
+        created = get_database().create_reaction(reaction)
+        # 200 if the sender had already reacted to this song
+        response = jsonify({'reaction': reaction_json}
+                           ), 201 if created else 200, RESPONSE_HEADER
         return response
     elif request.method == 'DELETE':
-        if Database().reaction_sender_exists(email, song_id):
-            Database().delete_sender_reaction(email, song_id)
+        if get_database().delete_sender_reaction(email, song_id):
             response = jsonify(success=True), 204, RESPONSE_HEADER
             return response
         response = jsonify({"error": "reactions not found"}
                            ), 404, RESPONSE_HEADER
         return response
 
+# Stream friends' current track changes and new reactions as Server-Sent Events
+
+
+@app.route('/stream/friends/<email>')
+def stream_friends_events(email):
+    """ Pushes 'current_track' and 'reaction' events of the user's friends as they happen """
+    if not get_database().user_exists(email):
+        response = jsonify({"error": "User not found"}), 404, RESPONSE_HEADER
+        return response
+    if not stream_slots.acquire(blocking=False):
+        # an EventSource closes for good on any status but 200, so end the stream at once instead:
+        # the browser re-fetches the friends feed on the 'resync' event and reconnects after the retry delay
+        response = Response(f'retry: {STREAM_BUSY_RETRY_MS}\n\nevent: resync\ndata: {{}}\n\n',
+                            200, STREAM_HEADER, mimetype='text/event-stream')
+        return response
+    try:
+        ensure_event_feed()
+        friends = [get_converted_email(friend)
+                   for friend in get_database().get_all_user_friends(email)]
+    except Exception:
+        stream_slots.release()
+        raise
+    subscription = get_broker().subscribe(friends)
+    response = Response(stream_with_context(server_sent_events(subscription)),
+                        200, STREAM_HEADER, mimetype='text/event-stream')
+    # the generator only unsubscribes once it has started
+    response.call_on_close(lambda: get_broker().unsubscribe(subscription))
+    response.call_on_close(stream_slots.release)
+    return response
+
+
+def ensure_event_feed():
+    """ Start following MongoDB change streams in this process if events come from them,
+    the memory engine publishes its writes itself """
+    if database_manager.STORAGE_BACKEND != 'memory':
+        ensure_change_stream_feed(get_database())
+
 # Get all reactions for all users
 
 
 @app.route('/reactions')
 def get_all_reactions():
-    reactions = Database().get_all_reactions()
-    response = jsonify({'reactions': reactions}), 200, RESPONSE_HEADER
+    response = paginated_response(
+        'reactions', lambda after, limit: get_database().iter_all_reactions(after, limit))
+    if response:
+        return response
+    return cached_json_response([REACTIONS_KEY], lambda: ({'reactions': get_database().get_all_reactions()}, 200))
+
+# Malformed request payloads
+
+
+@app.errorhandler(ValidationError)
+def payload_error(error):
+    """ Answer 400 with the reason when a request payload fails validation """
+    response = jsonify({"error": str(error)}), 400, RESPONSE_HEADER
+    return response
+
+# Server-Sent Events formatting
+
+
+def server_sent_events(subscription, heartbeat=None, max_seconds=None):
+    """ Yields the events of a subscription in the text/event-stream format, with keep-alive
+    comments in between. If events were dropped because the client was too slow, a 'resync'
+    event tells it to re-fetch the friends feed. The subscription ends with the stream """
+    heartbeat = heartbeat or STREAM_HEARTBEAT_SECONDS
+    deadline = time.monotonic() + (max_seconds or STREAM_MAX_SECONDS)
+    try:
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < deadline:
+            event = subscription.get(timeout=heartbeat)
+            yield format_event(subscription, event)
+    finally:
+        get_broker().unsubscribe(subscription)
+
+
+def format_event(subscription, event):
+    """ Returns an event (None after a heartbeat without events) of a subscription in the text/event-stream
+    format, preceded by a 'resync' event if events were dropped since the last one """
+    text = ''
+    if subscription.overflowed:
+        subscription.overflowed = False
+        text = 'event: resync\ndata: {}\n\n'
+    if event is None:
+        return text + ': keep-alive\n\n'
+    event_type, data = event
+    return text + f'event: {event_type}\ndata: {dumps(data)}\n\n'
+
+# Conditional, cached JSON response
+
+
+def cached_json_response(keys, build):
+    """ Serve the (payload, status) returned by build() as JSON, with an ETag derived from the
+    request path and the versions of the resource keys it was built from. Answers 304 if the
+    client already has that ETag, and reuses the body serialized for it earlier in this process.
+    Versions are read before build() runs and bumped after every write, so a body is never
+    older than its ETag """
+    versions = get_versions(keys, get_database().get_versions)
+    etag = make_etag(request.full_path, versions)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=RESPONSE_HEADER)
+        response.set_etag(etag)
+        return response
+    body = response_bodies.get(etag)
+    status = 200
+    if body is None:
+        payload, status = build()
+        body = dumps(payload)
+        if status == 200:
+            response_bodies.put(etag, body)
+    response = Response(body, status, RESPONSE_HEADER,
+                        mimetype='application/json')
+    if status == 200:
+        response.set_etag(etag)
     return response
 
+
+def friends_feed_keys(email):
+    """ Returns the resource keys of a user's friends feed: the user's own key and their friends' keys.
+    The friend list is read from the database only when the user's version changed """
+    key = user_key(get_converted_email(email))
+    version = get_versions([key], get_database().get_versions)[key]
+    friends = friend_lists.get((key, version))
+    if friends is None:
+        user = get_database().get_user(email, {"_id": 0, "friends": 1})
+        friends = [user_key(friend)
+                   for friend in user['friends']] if user else []
+        friend_lists.put((key, version), friends)
+    return [key] + friends
+
+def flag_arg(name):
+    """ Returns True if the query parameter name is given and not '0' or 'false' """
+    return request.args.get(name, '') not in ('', '0', 'false')
+
+# Paginated or streamed list response
+
+
+def paginated_response(key, fetch):
+    """ Serve the documents returned by fetch(after, limit) either as a stream of
+    newline-delimited JSON (?format=ndjson) or as one page (?limit=<n>&after=<cursor>),
+    where 'next' is the cursor of the following page. Returns None when neither was asked
+    for, so the caller can fall back to returning the whole list """
+    after = request.args.get('after')
+    limit = request.args.get('limit', type=int)
+    try:
+        if request.args.get('format') == 'ndjson':
+            documents = fetch(after, max(limit or 0, 0))
+            lines = (dumps(document) + '\n' for document in documents)
+            return Response(stream_with_context(lines), 200, RESPONSE_HEADER, mimetype='application/x-ndjson')
+        if after is None and limit is None:
+            return None
+        limit = min(max(limit or DEFAULT_PAGE_SIZE, 1), MAX_PAGE_SIZE)
+        documents = list(fetch(after, limit))
+    except InvalidId:
+        return jsonify({"error": "invalid cursor"}), 400, RESPONSE_HEADER
+    next_cursor = str(documents[-1]['_id']) if len(documents) == limit else None
+    return jsonify({key: documents, 'next': next_cursor}), 200, RESPONSE_HEADER
+
 # Insert new user to the database
 
 
 def insert_user_to_database(user_data):
     """ Check if user has existed in the database, if not insert the user to the database """
     if user_data:
-        user_email = user_data['email']
-        user_display_name = user_data['display_name']
-        user_id = user_data['id']
-        user_pic = user_data['images'][0]['url']
-        if not Database().user_exists(user_email):
-            new_user = User(user_display_name, user_id, user_email, user_pic)
-            Database().create_user(new_user)
+        new_user = User.from_payload(user_data)
+        if not get_database().user_exists(new_user.email):
+            get_database().create_user(new_user)
 
 # Get complete user object
 
 
-def get_complete_user_info(email):
-    """ Get the complete user data including songs history, reactions, and current track """
-    if Database().user_exists(email):
-        user = Database().get_user(email)
-        user['song_history'] = Database().get_all_song_history_from_user(email)
-        for song in user['song_history']:
-            reactions = Database().get_reactions(email, song['song_id'])
-            song['reactions'] = reactions
-        return user
+def get_complete_user_info(email, summary_only=False):
+    """ Get the complete user data including songs history, reactions (or their counts with summary_only), and current track """
+    return get_database().get_complete_user(email, summary_only=summary_only)
+
+# Fetch a user's current track from Spotify and record it in the database
+
+
+def refresh_current_track(email):
+    """ Returns the current playing track of a user from Spotify, and stores it as the user's current track """
+    access_token = get_access_token(email)
+    response = None
+    if access_token:
+        try:
+            response = get_spotify_client().get_currently_playing(access_token)
+        except requests.RequestException:
+            pass
+    return store_current_track_response(email, response)
+
+
+def store_current_track_response(email, response):
+    """ Stores the track of a Spotify currently playing response as the user's current track and returns it.
+    Without a response (no access token for the user, or Spotify could not be reached) or with an error
+    response, nothing is known about what the user plays: nothing is written and the stored current
+    track is returned, like poller.py skips those users """
+    if response is None or response.status_code >= 400:
+        if response is not None and response.status_code == 401:
+            # token revoked or expired, reload it from the database next time
+            get_token_manager().forget(email)
+        return get_stored_current_track(email)
+    track = parse_current_track(response.json()) if response.status_code == 200 else None
+    # insert the current track to the user's database
+    save_current_track(email, song_from_current_track(email, track))
+    return track
+
+
+def song_from_current_track(email, track):
+    """ Returns the Song of a current track returned by get_user_current_track, None if nothing is playing """
+    if not track:
+        return None
+    return Song(email, track['id'], track['track_name'], track['artists'],
+                "", track['link'], track['image_url'], track['preview_url'])
+
+
+def get_stored_current_track(email):
+    """ Returns the current track stored in the database for a user (kept up to date by poller.py),
+    in the same format as get_user_current_track """
+    user = get_database().get_user(email, {"_id": 0, "current_track": 1})
+    return stored_track_info(user)
+
+
+def stored_track_info(user):
+    """ Returns the current track of a user document in the format of get_user_current_track,
+    None if the user does not exist or is not playing anything """
+    song = user.get('current_track') if user else None
+    if not song:
+        return None
+    return {
+        "id": song['song_id'],
+        "track_name": song['song_name'],
+        "artists": song['artist'],
+        "link": song['song_url'],
+        "image_url": song['song_image_url'],
+        "preview_url": song['preview_url']
+    }
+
+
+def save_current_track(email, song):
+    """ Update the user's current track. Reporting the song already stored is a single read-only
+    round trip, so it is not remembered here: another worker or poller.py may have changed it since """
+    get_database().update_current_track(email, song)
+
+# Get a valid Spotify access token for a user
+
+
+def get_access_token(email=None):
+    """ Returns the access token of a user, or of the logged in user if no email is given.
+    Stored tokens are refreshed before they expire, the token in the session cookie is
+    only used for the logged in user (e.g. right after login) """
+    logged_user = session.get('logged_user')
+    email = email or logged_user
+    if email:
+        access_token = get_token_manager().get_access_token(email)
+        if access_token:
+            return access_token
+    if email is None or get_converted_email(email) == logged_user:
+        return session.get('token_info', {}).get('access_token')
     return None
 
 # Get user's Spotify account information using Python requests
 
 
-def get_user_spotify_data():
-    """ Returns the Spotify account information of a user, access token is needed """
-    try:
-        access_token = session['token_info']['access_token']
-    except AccessTokenError:
+def get_user_spotify_data(email=None):
+    """ Returns the Spotify account information of a user (the logged in user by default), access token is needed """
+    access_token = get_access_token(email)
+    if not access_token:
         print("cannot find access token")
+        return None
 
-    response = requests.get(
-        SPOTIFY_GET_USER_PROFILE_URL,
-        headers={
-            "Authorization": f"Bearer {access_token}"
-        }
-    )
+    response = get_spotify_client().get_current_user(access_token)
 
     if response.status_code < 400:
         json_resp = response.json()
@@ -363,44 +734,17 @@ def get_user_spotify_data():
 # Get user's currently playing track using Python requests
 
 
-def get_user_current_track():
-    """ Returns the current playing track of a user, access token is needed """
-    try:
-        access_token = session['token_info']['access_token']
-    except AccessTokenError:
+def get_user_current_track(email=None):
+    """ Returns the current playing track of a user (the logged in user by default), access token is needed """
+    access_token = get_access_token(email)
+    if not access_token:
         print("cannot find access token")
+        return None
 
-    response = requests.get(
-        SPOTIFY_GET_CURRENT_TRACK_URL,
-        headers={
-            "Authorization": f"Bearer {access_token}"
-        }
-    )
+    response = get_spotify_client().get_currently_playing(access_token)
 
     if response.status_code == 200:
-        json_resp = response.json()
-
-        track_id = json_resp['item']['id']
-        track_name = json_resp['item']['name']
-        artists = list(json_resp['item']['artists'])
-        image_url = json_resp['item']['album']['images'][0]['url']
-
-        link = json_resp['item']['external_urls']['spotify']
-
-        artist_names = ', '.join([artist['name'] for artist in artists])
-
-        preview_url = json_resp['item']['preview_url']
-
-        current_track_info = {
-            "id": track_id,
-            "track_name": track_name,
-            "artists": artist_names,
-            "link": link,
-            "image_url": image_url,
-            "preview_url": preview_url
-        }
-
-        return current_track_info
+        return parse_current_track(response.json())
     return None
 
 
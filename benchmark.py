@@ -0,0 +1,185 @@
+""" Benchmarks for the database access patterns used by the backend.
+
+Run against a scratch database, e.g.
+    DB_ENDPOINT=mongodb://localhost:27017 DB_NAME=spottem_bench python benchmark.py
+Every benchmark seeds its own users (emails starting with 'bench-') and removes them afterwards.
+"""
+
+import time
+import bson
+from pymongo import monitoring
+from database_manager import User, Song, Reaction, Database, get_converted_email
+
+
+class CommandCounter(monitoring.CommandListener):
+    """ Counts the commands (round trips) sent to the database, the size of their replies
+    and the time it takes to decode them """
+
+    def __init__(self):
+        self.count = 0
+        self.reply_bytes = 0
+        self.decode_seconds = 0.0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        # the reply was already decoded by the driver, encode it again to get its size
+        # and time a fresh decode of those bytes
+        data = bson.encode(event.reply)
+        start = time.perf_counter()
+        bson.decode(data)
+        self.decode_seconds += time.perf_counter() - start
+        self.reply_bytes += len(data)
+
+    def failed(self, event):
+        pass
+
+
+# must be registered before the shared client is created
+command_counter = CommandCounter()
+monitoring.register(command_counter)
+
+
+def measure(func, repeat=5):
+    """ Runs func repeat times, returns (round trips per call, median latency in ms) """
+    timings = []
+    start_count = command_counter.count
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    round_trips = (command_counter.count - start_count) / repeat
+    return round_trips, timings[len(timings) // 2]
+
+
+def measure_transfer(func, repeat=5):
+    """ Runs func repeat times, returns (reply KB per call, decode ms per call, median latency in ms) """
+    start_bytes = command_counter.reply_bytes
+    start_decode = command_counter.decode_seconds
+    latency = measure(func, repeat)[1]
+    kilobytes = (command_counter.reply_bytes - start_bytes) / 1024 / repeat
+    decode_ms = (command_counter.decode_seconds - start_decode) * 1000 / repeat
+    return kilobytes, decode_ms, latency
+
+
+def seed_user(email, history_size, reactions_per_song=1):
+    """ Insert a user with history_size songs, each with reactions_per_song reactions """
+    db = Database()
+    db.create_user(User('Bench User', 0, email, None))
+    db.song_history_coll.insert_many([
+        Song(email, f'bench-song-{i}', f'Song {i}', 'Artist', 'Album',
+             'song url', 'image url', 'preview url').to_document()
+        for i in range(history_size)
+    ])
+    reactions = [
+        Reaction(email, 'Bench User', get_converted_email(f'bench-sender-{j}@spottem.com'), 'Sender',
+                 f'bench-song-{i}', f'Song {i}', 'Artist', 'Album', 'song url', 'image url',
+                 'preview url', 'time stamp').to_document()
+        for i in range(history_size) for j in range(reactions_per_song)
+    ]
+    if reactions:
+        db.reactions_coll.insert_many(reactions)
+
+
+def remove_user(email):
+    """ Delete a seeded user together with their songs and reactions """
+    db = Database()
+    db.delete_user(email)
+    db.delete_all_song_history_for_user(email)
+    db.reactions_coll.delete_many({"email": get_converted_email(email)})
+
+
+def legacy_complete_user_info(email):
+    """ The previous per-song implementation of get_complete_user_info, kept for comparison """
+    if Database().user_exists(email):
+        user = Database().get_user(email)
+        user['song_history'] = Database().get_all_song_history_from_user(email)
+        for song in user['song_history']:
+            song['reactions'] = Database().get_reactions(email, song['song_id'])
+        return user
+    return None
+
+
+def bench_complete_user_info(history_sizes=(0, 10, 100, 500)):
+    """ Compare round trips and latency of the per-song lookups with the single aggregation """
+    print('get_complete_user_info: history size | legacy trips, ms | aggregation trips, ms')
+    for size in history_sizes:
+        email = f'bench-user-{size}@spottem.com'
+        seed_user(email, size)
+        try:
+            legacy = measure(lambda: legacy_complete_user_info(email))
+            aggregated = measure(lambda: Database().get_complete_user(email))
+            print(f'{size:>5} | {legacy[0]:>6.0f}, {legacy[1]:>8.2f} | '
+                  f'{aggregated[0]:>3.0f}, {aggregated[1]:>8.2f}')
+        finally:
+            remove_user(email)
+
+
+def legacy_friends_feed(email):
+    """ The previous per-friend implementation of GET /user/friends/<email>, kept for comparison """
+    result = []
+    if Database().user_exists(email):
+        for friend in Database().get_all_user_friends(email):
+            result.append(legacy_complete_user_info(friend))
+    return result
+
+
+def bench_friends_feed(friend_counts=(1, 10, 50), history_size=50):
+    """ Compare round trips and latency of the per-friend feed with the batched feed """
+    print(f'friends feed ({history_size} songs each): friends | legacy trips, ms | batched trips, ms')
+    for count in friend_counts:
+        email = f'bench-feed-{count}@spottem.com'
+        friends = [f'bench-feed-{count}-friend-{i}@spottem.com' for i in range(count)]
+        seed_user(email, 0)
+        for friend in friends:
+            seed_user(friend, history_size)
+        Database().user_coll.update_one(
+            {"email": get_converted_email(email)},
+            {"$set": {"friends": [get_converted_email(friend) for friend in friends]}})
+        try:
+            legacy = measure(lambda: legacy_friends_feed(email), repeat=3)
+            batched = measure(lambda: Database().get_friends_feed(email), repeat=3)
+            print(f'{count:>5} | {legacy[0]:>6.0f}, {legacy[1]:>8.2f} | '
+                  f'{batched[0]:>3.0f}, {batched[1]:>8.2f}')
+        finally:
+            for friend in friends:
+                remove_user(friend)
+            remove_user(email)
+
+
+def bench_projections(history_size=500):
+    """ Compare reply size, decode time and latency of the read methods with and without the
+    projections the routes pass """
+    email = 'bench-projection@spottem.com'
+    seed_user(email, history_size)
+    converted = get_converted_email(email)
+    db = Database()
+    cases = [
+        ('user exists', lambda: db.user_coll.find_one({"email": converted}),
+         lambda: db.user_exists(email)),
+        ('user name', lambda: db.get_user(email),
+         lambda: db.get_user(email, {"_id": 0, "name": 1})),
+        ('friends', lambda: db.get_user(email)['friends'],
+         lambda: db.get_all_user_friends(email)),
+        ('song ids', lambda: db.get_all_song_history_from_user(email),
+         lambda: db.get_all_song_history_from_user(email, {"_id": 0, "song_id": 1})),
+        ('current track', lambda: db.get_complete_user(email),
+         lambda: db.get_complete_user(email, ['current_track'])),
+    ]
+    print(f'projections ({history_size} songs): read | full KB, decode ms, ms | projected KB, decode ms, ms')
+    try:
+        for name, full, projected in cases:
+            full_transfer = measure_transfer(full)
+            projected_transfer = measure_transfer(projected)
+            print(f'{name:>13} | {full_transfer[0]:>8.1f}, {full_transfer[1]:>6.2f}, {full_transfer[2]:>8.2f} | '
+                  f'{projected_transfer[0]:>8.1f}, {projected_transfer[1]:>6.2f}, {projected_transfer[2]:>8.2f}')
+    finally:
+        remove_user(email)
+
+
+if __name__ == '__main__':
+    bench_complete_user_info()
+    bench_friends_feed()
+    bench_projections()
@@ -0,0 +1,72 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# CLOCK
+
+
+class Clock:
+    """ Stand-in for time.time / time.monotonic, only moves when a test sets now """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+# LOCAL STUB OF THE SPOTIFY END POINTS
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Answers with the next queued (status, headers, body), or 200 {} when the queue is empty """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.server.bodies.append(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))).decode())
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        server.requests.append((self.command, self.path, self.client_address[1]))
+        status, headers, body = server.responses.pop(0) if server.responses else (200, {}, {})
+        if status is None:
+            # simulate a hanging server
+            server.release.wait(5)
+            status, headers, body = 200, {}, {}
+        payload = b'' if status == 204 else json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.responses = []
+    server.bodies = []
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
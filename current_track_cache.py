@@ -0,0 +1,158 @@
+""" Short-lived cache of users' current tracks with request coalescing.
+
+The frontend polls GET /current-track/<email> for every visible user. Within CURRENT_TRACK_CACHE_TTL
+seconds polls for the same user are answered from memory, and concurrent polls that miss the cache
+wait for the one upstream Spotify call already in flight instead of making their own.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+""" Seconds a current track fetched from Spotify is served from memory """
+CURRENT_TRACK_CACHE_TTL = float(os.environ.get('CURRENT_TRACK_CACHE_TTL', 5))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class _Call:
+    """ An upstream call in flight, followers wait on done and then read result or error """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CurrentTrackCache:
+    """ Per-user TTL cache with single-flight loading """
+
+    def __init__(self, ttl=CURRENT_TRACK_CACHE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = {}
+        self._calls = {}
+        self._async_calls = {}
+        self._lock = threading.Lock()
+        self._next_sweep = clock() + ttl
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+    def get(self, email, loader):
+        """ Returns the cached value for email, or loader() if it expired.
+        Only one loader per email runs at a time, concurrent callers share its result """
+        with self._lock:
+            entry = self._cached(email)
+            if entry is not None:
+                self.stats['hits'] += 1
+                return entry[1]
+            call = self._calls.get(email)
+            if call is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                self.stats['misses'] += 1
+                call = self._calls[email] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = loader()
+        except Exception as error:
+            call.error = error
+            raise
+        else:
+            self._store(email, call.result)
+        finally:
+            with self._lock:
+                del self._calls[email]
+            call.done.set()
+        return call.result
+
+    async def get_async(self, email, loader):
+        """ get for a loader that is a coroutine function (the async end points of asgi.py),
+        concurrent callers on the event loop wait for the one loader in flight """
+        with self._lock:
+            entry = self._cached(email)
+            if entry is not None:
+                self.stats['hits'] += 1
+                return entry[1]
+            future = self._async_calls.get(email)
+            if future is not None:
+                self.stats['coalesced'] += 1
+                leader = False
+            else:
+                self.stats['misses'] += 1
+                future = self._async_calls[email] = asyncio.get_running_loop(
+                ).create_future()
+                leader = True
+
+        if not leader:
+            # a follower giving up must not cancel the leader's result for the others
+            return await asyncio.shield(future)
+
+        try:
+            result = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            # mark it retrieved, the leader raises it even if no follower waits
+            future.exception()
+            raise
+        else:
+            self._store(email, result)
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._async_calls[email]
+        return result
+
+    def _cached(self, email):
+        """ Returns the (expiry, value) entry of email if it has not expired, dropping it if it has.
+        Called with the lock held """
+        entry = self._entries.get(email)
+        if entry is not None and entry[0] <= self.clock():
+            del self._entries[email]
+            entry = None
+        return entry
+
+    def _store(self, email, value):
+        """ Cache value for email. At most once per TTL it also drops the expired entries
+        of users nobody asked for since, so the cache does not keep every user ever polled """
+        with self._lock:
+            now = self.clock()
+            self._entries[email] = (now + self.ttl, value)
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.ttl
+                for expired in [key for key, entry in self._entries.items() if entry[0] <= now]:
+                    del self._entries[expired]
+
+    def invalidate(self, email):
+        """ Drop the cached value of email """
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def get_stats(self):
+        """ Returns a copy of the hit, miss and coalesce counters """
+        with self._lock:
+            stats = dict(self.stats)
+            stats['cached_users'] = len(self._entries)
+        return stats
+
+
+def get_current_track_cache():
+    """ Returns the process-wide CurrentTrackCache, creating it on first use """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = CurrentTrackCache()
+    return _cache
@@ -1,8 +1,58 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, UpdateMany, ReturnDocument, ASCENDING
+from bson import ObjectId
+from pubsub import publish_local
+from response_cache import forget_versions, user_key, REACTIONS_KEY
+from metrics import command_listener
+from pymongo.errors import PyMongoError, DuplicateKeyError, BulkWriteError
 import certifi
 import os
+import threading
 
 DB_ENDPOINT = os.environ.get('DB_ENDPOINT')
+DB_NAME = os.environ.get('DB_NAME', 'spottem')
+
+""" Storage engine behind get_database: 'mongo', or 'memory' for the in-process engine of memory_storage.py """
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+
+# CONNECTION POOL SETTINGS
+""" Maximum number of connections kept open by each worker process """
+DB_MAX_POOL_SIZE = int(os.environ.get('DB_MAX_POOL_SIZE', 20))
+
+""" Number of connections the pool keeps warm even when idle """
+DB_MIN_POOL_SIZE = int(os.environ.get('DB_MIN_POOL_SIZE', 0))
+
+""" Idle connections older than this are closed and replaced (milliseconds) """
+DB_MAX_IDLE_TIME_MS = int(os.environ.get('DB_MAX_IDLE_TIME_MS', 60000))
+
+""" How long to wait for a suitable server before failing an operation (milliseconds) """
+DB_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.environ.get('DB_SERVER_SELECTION_TIMEOUT_MS', 5000))
+
+""" Timeout for opening a new connection, including the TLS handshake (milliseconds) """
+DB_CONNECT_TIMEOUT_MS = int(os.environ.get('DB_CONNECT_TIMEOUT_MS', 5000))
+
+""" Timeout for a single send/receive on an established connection (milliseconds) """
+DB_SOCKET_TIMEOUT_MS = int(os.environ.get('DB_SOCKET_TIMEOUT_MS', 10000))
+
+""" How long a request may wait for a free pooled connection (milliseconds) """
+DB_WAIT_QUEUE_TIMEOUT_MS = int(
+    os.environ.get('DB_WAIT_QUEUE_TIMEOUT_MS', 5000))
+
+""" Interval of the driver's background server health checks (milliseconds) """
+DB_HEARTBEAT_FREQUENCY_MS = int(
+    os.environ.get('DB_HEARTBEAT_FREQUENCY_MS', 10000))
+
+""" Keep a materialized profile_view document per user, see complete_user_pipeline.
+Run 'python manage.py rebuild-profile-views' before turning this on """
+PROFILE_VIEWS_ENABLED = os.environ.get('PROFILE_VIEWS_ENABLED', '') not in ('', '0', 'false')
+
+""" Number of documents fetched per round trip when streaming a cursor """
+CURSOR_BATCH_SIZE = int(os.environ.get('DB_CURSOR_BATCH_SIZE', 200))
+# end of CONNECTION POOL SETTINGS
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
 
 def get_converted_email(email):
@@ -14,11 +64,109 @@ def get_original_email(email):
     converted = email.replace('-', '.')
     return converted
 
+# Shared MongoClient for the whole process
+
+
+def get_client():
+    """ Returns the process-wide MongoClient, creating it on first use.
+    MongoClient is not fork-safe, so a client inherited from a parent process
+    (e.g. the gunicorn master) is discarded and a new one is built in the child. """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = MongoClient(DB_ENDPOINT,
+                                      tlsCAFile=certifi.where(),
+                                      maxPoolSize=DB_MAX_POOL_SIZE,
+                                      minPoolSize=DB_MIN_POOL_SIZE,
+                                      maxIdleTimeMS=DB_MAX_IDLE_TIME_MS,
+                                      serverSelectionTimeoutMS=DB_SERVER_SELECTION_TIMEOUT_MS,
+                                      connectTimeoutMS=DB_CONNECT_TIMEOUT_MS,
+                                      socketTimeoutMS=DB_SOCKET_TIMEOUT_MS,
+                                      waitQueueTimeoutMS=DB_WAIT_QUEUE_TIMEOUT_MS,
+                                      heartbeatFrequencyMS=DB_HEARTBEAT_FREQUENCY_MS,
+                                      event_listeners=[command_listener],
+                                      connect=False)
+                _client_pid = pid
+    return _client
+
+
+def close_client():
+    """ Closes the process-wide MongoClient, the next get_client() call builds a new one """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _client_pid = None
+
+
+def ping_database():
+    """ Returns True if the database answers a ping within the server selection timeout """
+    try:
+        get_client().admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+
+# Request payload validation
+
+
+class ValidationError(ValueError):
+    """ Raised when a request payload is not an object, misses fields or has fields of the wrong type """
+    pass
+
+
+def validate_payload(payload, required, optional=None):
+    """ Returns payload if it is a dict with every field of required and no field of the wrong type.
+    required and optional map field names to the allowed type or tuple of types,
+    optional fields may also be missing or null """
+    if not isinstance(payload, dict):
+        raise ValidationError("expected a JSON object")
+    missing = [field for field in required if field not in payload]
+    if missing:
+        raise ValidationError(f"missing fields: {', '.join(missing)}")
+    invalid = [field for field, types in required.items()
+               if not isinstance(payload[field], types)]
+    invalid += [field for field, types in (optional or {}).items()
+                if payload.get(field) is not None and not isinstance(payload[field], types)]
+    if invalid:
+        raise ValidationError(f"invalid fields: {', '.join(invalid)}")
+    return payload
+
+# Base class of the documents stored in the database
+
+
+class Model:
+    """ Compact record whose __slots__ are the fields of its document """
+    __slots__ = ()
+
+    def to_document(self):
+        """ Returns a new document with the fields of the model """
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    @classmethod
+    def from_document(cls, document):
+        """ Returns the model of a stored document, fields the model does not have (e.g. _id) are ignored """
+        model = cls.__new__(cls)
+        for field in cls.__slots__:
+            setattr(model, field, document.get(field))
+        return model
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_document() == other.to_document()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_document()!r})'
+
 # class user to store user data
 
 
-class User:
+class User(Model):
     """ Class to store user data """
+    __slots__ = ('name', 'user_id', 'email', 'user_dp',
+                 'is_online', 'friends', 'current_track')
 
     def __init__(self, name, user_id, email, user_dp):
         self.name = name
@@ -29,11 +177,28 @@ class User:
         self.friends = []
         self.current_track = None
 
+    @classmethod
+    def from_payload(cls, payload):
+        """ Returns the user of a Spotify user profile, raises ValidationError if it is malformed """
+        validate_payload(payload, {"email": str, "id": str}, {
+                         "display_name": str, "images": list})
+        image = (payload.get('images') or [{}])[0]
+        if not isinstance(image, dict) or not isinstance(image.get('url'), (str, type(None))):
+            raise ValidationError("invalid fields: images")
+        return cls(payload.get('display_name'), payload['id'], payload['email'], image.get('url'))
+
 # class to store song data
 
 
-class Song:
+class Song(Model):
     """ Class to store song data """
+    __slots__ = ('email', 'song_id', 'song_name', 'artist', 'album',
+                 'song_url', 'song_image_url', 'preview_url')
+
+    """ Fields of a song in request payloads, and their types """
+    PAYLOAD_FIELDS = {"song_id": str, "song_name": str, "song_artists": str,
+                      "song_url": str, "song_image_url": str}
+    OPTIONAL_PAYLOAD_FIELDS = {"song_album": str, "preview_url": str}
 
     def __init__(self, email, song_id, song_name, artist, album, song_url, song_image_url, preview_url):
         self.email = get_converted_email(email)
@@ -45,11 +210,25 @@ class Song:
         self.song_image_url = song_image_url
         self.preview_url = preview_url
 
+    @classmethod
+    def from_payload(cls, email, payload):
+        """ Returns the song of a request payload for the user email, raises ValidationError if it is malformed """
+        validate_payload(payload, cls.PAYLOAD_FIELDS,
+                         cls.OPTIONAL_PAYLOAD_FIELDS)
+        return cls(email, payload['song_id'], payload['song_name'], payload['song_artists'], payload.get('song_album') or "",
+                   payload['song_url'], payload['song_image_url'], payload.get('preview_url'))
+
 # class to store reaction data
 
 
-class Reaction:
+class Reaction(Model):
     """ Class to store reaction data """
+    __slots__ = ('email', 'name', 'sender_email', 'sender_name', 'song_id', 'song_name', 'artist',
+                 'album', 'song_url', 'song_image_url', 'preview_url', 'time_stamp')
+
+    """ Fields of a reaction in request payloads, and their types """
+    PAYLOAD_FIELDS = dict(Song.PAYLOAD_FIELDS, email=str,
+                          sender_email=str, time_stamp=(str, int, float))
 
     def __init__(self, email, name, sender_email, sender_name, song_id, song_name, artist, album, song_url, song_image_url, preview_url, time_stamp):
         self.email = get_converted_email(email)
@@ -57,7 +236,6 @@ class Reaction:
         self.sender_email = sender_email
         self.sender_name = sender_name
         self.song_id = song_id
-        self.song_id = song_id
         self.song_name = song_name
         self.artist = artist
         self.album = album
@@ -66,164 +244,567 @@ class Reaction:
         self.preview_url = preview_url
         self.time_stamp = time_stamp
 
+    @classmethod
+    def from_payload(cls, payload, name, sender_name):
+        """ Returns the reaction of a request payload, given the names of the recipient and the sender.
+        Raises ValidationError if the payload is malformed """
+        validate_payload(payload, cls.PAYLOAD_FIELDS,
+                         Song.OPTIONAL_PAYLOAD_FIELDS)
+        return cls(payload['email'], name, payload['sender_email'], sender_name, payload['song_id'], payload['song_name'],
+                   payload['song_artists'], payload.get('song_album') or "", payload['song_url'], payload['song_image_url'],
+                   payload.get('preview_url'), payload['time_stamp'])
+
+# Keyset pagination helpers
+
+
+def after_query(after):
+    """ Returns the filter selecting documents inserted after the document with _id after.
+    Raises bson.errors.InvalidId if after is not a valid cursor """
+    if after is None:
+        return {}
+    return {"_id": {"$gt": ObjectId(after)}}
+
+
+def iter_documents(cursor):
+    """ Yield the documents of a cursor with their _id (if projected) converted to a string """
+    for document in cursor:
+        if '_id' in document:
+            document['_id'] = str(document['_id'])
+        yield document
+
+
+def cursor_projection(projection):
+    """ Returns projection without an _id exclusion, so paged documents keep their cursor """
+    if projection is None:
+        return None
+    projection = {field: value for field,
+                  value in projection.items() if field != "_id"}
+    return projection or None
+
+
+def document_exists(collection, query):
+    """ Returns True if a document matches query, counted on the index without fetching it """
+    return collection.count_documents(query, limit=1) > 0
+
+# Aggregation pipeline to assemble complete user documents
+
+
+def email_lookup(collection, as_field):
+    """ Returns a $lookup stage that joins the documents of collection with the user's email,
+    in insertion (_id) order: the email prefixed indexes would otherwise return them in index order """
+    return {"$lookup": {
+        "from": collection,
+        "let": {"email": "$email"},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$email", "$$email"]}}},
+            {"$sort": {"_id": 1}}
+        ],
+        "as": as_field
+    }}
+
+
+def complete_user_pipeline(query, songs_per_user=None, summary_only=False):
+    """ Returns an aggregation pipeline over the user collection that attaches each matched
+    user's song history, and to every song the reactions the user received for it.
+    Both lookups are equality joins on the indexed email field in insertion order, the reactions are then
+    matched to their songs server side, so the whole tree costs a single round trip.
+    If songs_per_user is given only that many of the most recent songs are kept.
+    With summary_only every song gets a reaction_count read from the reaction counters
+    instead of its list of reactions. """
+    song_history = "$song_history"
+    if songs_per_user is not None:
+        song_history = {"$slice": ["$song_history", -max(songs_per_user, 0)]}
+    song_reactions = {"$filter": {
+        "input": "$received_reactions",
+        "as": "reaction",
+        "cond": {"$eq": ["$$reaction.song_id", "$$song.song_id"]}
+    }}
+    if summary_only:
+        reactions = {"reaction_count": {"$ifNull": [
+            {"$arrayElemAt": [{"$map": {
+                "input": song_reactions,
+                "as": "counter",
+                "in": "$$counter.count"
+            }}, 0]},
+            0
+        ]}}
+    else:
+        reactions = {"reactions": {"$map": {
+            "input": song_reactions,
+            "as": "reaction",
+            "in": {"$mergeObjects": [
+                "$$reaction",
+                {"_id": {"$toString": "$$reaction._id"}}
+            ]}
+        }}}
+    return [
+        {"$match": query},
+        email_lookup("song_history", "song_history"),
+        email_lookup("reaction_counts" if summary_only else "reactions", "received_reactions"),
+        {"$addFields": {
+            "_id": {"$toString": "$_id"},
+            "song_history": {"$map": {
+                "input": song_history,
+                "as": "song",
+                "in": {"$mergeObjects": [
+                    "$$song",
+                    dict({"_id": {"$toString": "$$song._id"}}, **reactions)
+                ]}
+            }}
+        }},
+        {"$project": {"received_reactions": 0}}
+    ]
+
+
+def profile_view_summary_pipeline(query, songs_per_user=None):
+    """ Returns an aggregation pipeline over the profile_view collection that replaces the
+    reactions of every song with their reaction_count """
+    song_history = "$song_history"
+    if songs_per_user is not None:
+        song_history = {"$slice": ["$song_history", -max(songs_per_user, 0)]}
+    return [
+        {"$match": query},
+        {"$addFields": {
+            "song_history": {"$map": {
+                "input": song_history,
+                "as": "song",
+                "in": {"$mergeObjects": [
+                    "$$song",
+                    {"reaction_count": {"$size": {"$ifNull": ["$$song.reactions", []]}}}
+                ]}
+            }}
+        }},
+        {"$project": {"song_history.reactions": 0}}
+    ]
+
+""" Top level fields of a complete user, the fields that can be selected in get_complete_users """
+COMPLETE_USER_FIELDS = ('_id', 'name', 'user_id', 'email', 'user_dp', 'is_online',
+                        'friends', 'current_track', 'song_history')
+
+def get_database():
+    """ Returns the storage engine selected by STORAGE_BACKEND: a Database on the shared MongoClient,
+    or the process-wide in-memory engine """
+    if STORAGE_BACKEND == 'memory':
+        from memory_storage import get_memory_database
+        return get_memory_database()
+    return Database()
+
+""" Most MongoDB commands each Database method sends, with PROFILE_VIEWS_ENABLED off (the iter_ methods:
+for their first batch). A write that changes something costs its own commands plus one versions
+bulk_write for every resource key it changed, see response_cache. test_database.py holds the methods
+to these budgets, load_test.py counts the calls of the memory engine with them """
+ROUND_TRIPS = {
+    'create_user': 2,
+    'get_user': 1,
+    'get_complete_user': 1,
+    'get_complete_users': 1,
+    # the user's friend list, then the friends
+    'get_friends_feed': 2,
+    'delete_user': 2,
+    'user_exists': 1,
+    # user_exists on the friend, then $addToSet
+    'insert_friend_to_user': 3,
+    # find of the existing friends, then one bulk_write
+    'add_friends': 3,
+    'delete_friend': 2,
+    'get_all_user_friends': 1,
+    # find_one_and_update, then the upsert of the previous track into the history.
+    # Reporting the song already playing is a single command
+    'update_current_track': 3,
+    'create_song_history': 2,
+    'create_song_histories': 2,
+    'get_all_song_history_from_user': 1,
+    'iter_song_history_from_user': 1,
+    'delete_all_song_history_for_user': 2,
+    'song_history_for_user_exists': 1,
+    # the upsert, then the recipient's and the song's reaction counters
+    'create_reaction': 4,
+    'get_reactions': 1,
+    'get_sender_reactions': 1,
+    'get_all_reactions': 1,
+    'iter_all_reactions': 1,
+    # find_one_and_delete, then the two reaction counters
+    'delete_reaction': 4,
+    'delete_sender_reaction': 4,
+    'get_reaction_counts': 1,
+    'get_song_reaction_counts': 1,
+    'reaction_exists': 1,
+    'reaction_sender_exists': 1,
+    'rebuild_reaction_counts': 2,
+    'rebuild_profile_views': 1,
+    'bump_versions': 1,
+    'get_versions': 1,
+    'save_token': 1,
+    'get_token': 1,
+    'get_token_emails': 1,
+    'delete_token': 1,
+}
+
 # Database manager to perform CRUD operations on the database using the MongoDB driver
 
 
 class Database:
-    """ Database Manager to perform CRUD to MongoDB """
+    """ Database Manager to perform CRUD to MongoDB.
+    Its public methods are the storage interface, memory_storage.MemoryDatabase implements the same ones """
 
     def __init__(self):
-        self.cluster = MongoClient(DB_ENDPOINT, tlsCAFile=certifi.where())
-        self.db = self.cluster["spottem"]
+        self.cluster = get_client()
+        self.db = self.cluster[DB_NAME]
         self.user_coll = self.db["user"]
         self.song_history_coll = self.db["song_history"]
         self.reactions_coll = self.db["reactions"]
+        self.tokens_coll = self.db["tokens"]
+        self.profile_view_coll = self.db["profile_view"]
+        self.versions_coll = self.db["versions"]
+        self.reaction_counts_coll = self.db["reaction_counts"]
+        self.song_reaction_counts_coll = self.db["song_reaction_counts"]
 
     # USER CRUD OPERATIONS
     def create_user(self, user):
         """ Create a user in the database """
-        self.user_coll.insert_one(user.__dict__)
+        document = user.to_document()
+        result = self.user_coll.insert_one(document)
+        if PROFILE_VIEWS_ENABLED:
+            view = dict(document, _id=str(
+                result.inserted_id), song_history=[])
+            self.profile_view_coll.replace_one(
+                {"email": user.email}, view, upsert=True)
+        self.bump_versions([user_key(user.email)])
 
-    def get_user(self, user_email):
-        """ Get a user from the database """
+    def get_user(self, user_email, projection=None):
+        """ Get a user from the database, projection selects the fields to return """
         query = {
             "email": get_converted_email(user_email)
         }
-        user = self.user_coll.find_one(query)
-        user['_id'] = str(user['_id'])
+        user = self.user_coll.find_one(query, projection)
+        if user and '_id' in user:
+            user['_id'] = str(user['_id'])
         return user
 
+    def get_complete_user(self, user_email, fields=None, summary_only=False):
+        """ Get a user with their song history and the reactions to each song in one aggregation,
+        fields and summary_only are as in get_complete_users """
+        return self.get_complete_users([user_email], fields, summary_only).get(get_converted_email(user_email))
+
+    def get_complete_users(self, user_emails, fields=None, summary_only=False):
+        """ Get the complete user data of many users in one round trip, keyed by converted email.
+        fields limits each user to those of COMPLETE_USER_FIELDS (email is always included),
+        song histories are only joined when asked for. Unknown emails are left out.
+        With summary_only the songs carry a reaction_count instead of their reactions """
+        emails = list(dict.fromkeys(get_converted_email(email)
+                                    for email in user_emails))
+        if not emails:
+            return {}
+        query = {
+            "email": {"$in": emails}
+        }
+        projection = None
+        if fields is not None:
+            unknown = set(fields) - set(COMPLETE_USER_FIELDS)
+            if unknown:
+                raise ValueError(
+                    f"unknown fields: {', '.join(sorted(unknown))}")
+            projection = dict.fromkeys(fields, 1)
+            projection["email"] = 1
+            projection.setdefault("_id", 0)
+        if PROFILE_VIEWS_ENABLED and summary_only:
+            pipeline = profile_view_summary_pipeline(query)
+            if projection is not None:
+                pipeline.append({"$project": projection})
+            response = self.profile_view_coll.aggregate(pipeline)
+        elif PROFILE_VIEWS_ENABLED:
+            response = self.profile_view_coll.find(query, projection)
+        else:
+            if projection is None or "song_history" in projection:
+                pipeline = complete_user_pipeline(
+                    query, summary_only=summary_only)
+            else:
+                pipeline = [
+                    {"$match": query},
+                    {"$addFields": {"_id": {"$toString": "$_id"}}}
+                ]
+            if projection is not None:
+                pipeline.append({"$project": projection})
+            response = self.user_coll.aggregate(pipeline)
+        return {user['email']: user for user in response}
+
+    def get_friends_feed(self, user_email, limit=None, songs_per_friend=None, summary_only=False):
+        """ Get the complete user data of a user's friends, in the order they were added.
+        Costs two round trips however many friends and songs there are.
+        With summary_only the songs carry a reaction_count instead of their reactions.
+        Returns None if the user does not exist. """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        user = self.user_coll.find_one(query, {"friends": 1})
+        if user is None:
+            return None
+        friends = user.get("friends", [])
+        if limit is not None:
+            friends = friends[:max(limit, 0)]
+        if not friends:
+            return []
+        friends_query = {
+            "email": {"$in": friends}
+        }
+        if PROFILE_VIEWS_ENABLED and summary_only:
+            response = self.profile_view_coll.aggregate(
+                profile_view_summary_pipeline(friends_query, songs_per_friend))
+        elif PROFILE_VIEWS_ENABLED:
+            projection = None
+            if songs_per_friend is not None:
+                projection = {"song_history": {
+                    "$slice": -max(songs_per_friend, 0)}}
+            response = self.profile_view_coll.find(friends_query, projection)
+        else:
+            response = self.user_coll.aggregate(
+                complete_user_pipeline(friends_query, songs_per_friend, summary_only))
+        by_email = {
+            friend['email']: friend for friend in response
+        }
+        return [by_email[email] for email in friends if email in by_email]
+
     def delete_user(self, user_email):
         """ Delete a user from the database """
         query = {
             "email": get_converted_email(user_email)
         }
         self.user_coll.delete_one(query)
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.delete_one(query)
+        self.bump_versions([user_key(query["email"])])
 
     def user_exists(self, user_email):
         """ Check if a user exists in the database """
         query = {
             "email": get_converted_email(user_email)
         }
-        return self.user_coll.find_one(query) is not None
+        return document_exists(self.user_coll, query)
 
     def insert_friend_to_user(self, user_email, friend_email):
-        """ Insert a friend to user friends array """
+        """ Insert a friend to user friends array.
+        Returns False if friend_email is not a valid user or is already a friend """
         # check if friend_email is a valid user
         if not (self.user_exists(friend_email)):
             return False
 
-        # check if friend already exists in the friend list
-        existing_friends = self.get_all_user_friends(user_email)
-        if get_original_email(friend_email) in existing_friends:
-            return False
-
         query = {
             "email": get_converted_email(user_email)
         }
-        self.user_coll.update_one(
-            query,
-            {
-                "$push": {"friends": get_converted_email(friend_email)}
-            }
-        )
+        update = {
+            "$addToSet": {"friends": get_converted_email(friend_email)}
+        }
+        result = self.user_coll.update_one(query, update)
+        if result.modified_count == 0:
+            return False
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.update_one(query, update)
+        self.bump_versions([user_key(query["email"])])
         return True
 
-    def delete_friend(self, user_email, friend_email):
+    def add_friends(self, user_email, friend_emails, mutual=False):
+        """ Insert many friends to user friends array in one write, unknown emails are skipped.
+        If mutual is True the user is also added to each friend's friends array.
+        Returns the emails of the friends that exist, None if the user does not exist """
         user_email = get_converted_email(user_email)
-        friend_email = get_converted_email(friend_email)
-        user = self.get_user(user_email)
-        if user:
-            friends = user['friends']
-            if friend_email in friends:
-                friends.remove(friend_email)
-            query = {
-                "email": user_email
-            }
-            self.user_coll.update_one(
-                query,
-                {
-                    "$set": {'friends': friends}
-                }
+        # de-duplicate while keeping the order the friends were given in
+        friend_emails = [friend_email for friend_email in dict.fromkeys(
+            get_converted_email(friend_email) for friend_email in friend_emails) if friend_email != user_email]
+
+        # check in the same query that the user and the friends are valid users
+        query = {
+            "email": {"$in": [user_email] + friend_emails}
+        }
+        existing = {friend['email']
+                    for friend in self.user_coll.find(query, {"email": 1})}
+        if user_email not in existing:
+            return None
+        valid_friends = [
+            friend_email for friend_email in friend_emails if friend_email in existing]
+        if not valid_friends:
+            return []
+
+        operations = [
+            UpdateOne(
+                {"email": user_email},
+                {"$addToSet": {"friends": {"$each": valid_friends}}}
             )
+        ]
+        if mutual:
+            operations.append(
+                UpdateMany(
+                    {"email": {"$in": valid_friends}},
+                    {"$addToSet": {"friends": user_email}}
+                )
+            )
+        self.user_coll.bulk_write(operations, ordered=False)
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.bulk_write(operations, ordered=False)
+        changed = [user_email] + (valid_friends if mutual else [])
+        self.bump_versions([user_key(email) for email in changed])
+        return [get_original_email(friend) for friend in valid_friends]
+
+    def delete_friend(self, user_email, friend_email):
+        """ Remove a friend from user friends array, returns True if it was removed """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        update = {
+            "$pull": {"friends": get_converted_email(friend_email)}
+        }
+        result = self.user_coll.update_one(query, update)
+        if result.modified_count == 0:
+            return False
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.update_one(query, update)
+        self.bump_versions([user_key(query["email"])])
+        return True
 
     def get_all_user_friends(self, user_email):
-        """ Get all friends of a user """
-        user = self.get_user(user_email)
-        friends = []
-        for friend in user["friends"]:
-            friends.append(get_original_email(friend))
-        return friends
+        """ Get all friends of a user, an empty list if the user does not exist """
+        user = self.get_user(user_email, {"_id": 0, "friends": 1})
+        if user is None:
+            return []
+        return [get_original_email(friend) for friend in user.get("friends", [])]
 
     def update_current_track(self, user_email, song):
-        """ Update the current playing track of user in the database """
-        # get the current user's current track
-        user = self.get_user(user_email)
-
-        if song:
-            # check if user has a current track playing
-            if user['current_track']:
-                # if the previous current track is different than the current track,
-                # update the current track to the new one,
-                # and move the previous current track to song history
-                if user['current_track']['song_id'] != song.song_id:
-                    query = {
-                        "email": get_converted_email(user_email)
-                    }
-                    self.user_coll.update_one(
-                        query,
-                        {
-                            "$set": {'current_track': song.__dict__}
-                        }
-                    )
-
-                    prev_current_track = Song(user['current_track']['email'], user['current_track']['song_id'], user['current_track']['song_name'], user['current_track']['artist'],
-                                              user['current_track']['album'], user['current_track']['song_url'], user['current_track']['song_image_url'], user['current_track']['preview_url'])
-                    self.create_song_history(prev_current_track)
-            else:
-                query = {
-                    "email": get_converted_email(user_email)
-                }
-                self.user_coll.update_one(
-                    query,
-                    {
-                        "$set": {'current_track': song.__dict__}
-                    }
-                )
-        else:
-            query = {
-                "email": get_converted_email(user_email)
-            }
-            self.user_coll.update_one(
+        """ Update the current playing track of user in the database,
+        the previous current track is moved to the user's song history.
+        Returns True if the current track changed """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        if not song:
+            result = self.user_coll.update_one(
                 query,
                 {
                     "$set": {'current_track': None}
                 }
             )
+            if result.modified_count > 0:
+                if PROFILE_VIEWS_ENABLED:
+                    self.profile_view_coll.update_one(
+                        query, {"$set": {'current_track': None}})
+                self.bump_versions([user_key(query["email"])])
+                publish_local(query["email"], 'current_track', {
+                    "email": query["email"], "current_track": None})
+                return True
+            return False
+
+        # only match if the user is playing something else (or nothing),
+        # so re-reporting the same song is a single read-only round trip
+        query["current_track.song_id"] = {"$ne": song.song_id}
+        current_track = song.to_document()
+        user = self.user_coll.find_one_and_update(
+            query,
+            {
+                "$set": {'current_track': current_track}
+            },
+            projection={"current_track": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if user is None:
+            return False
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.update_one(
+                {"email": song.email}, {"$set": {'current_track': current_track}})
+        publish_local(song.email, 'current_track', {
+            "email": song.email, "current_track": current_track})
+
+        prev_current_track = user.get('current_track')
+        if prev_current_track:
+            self._create_song_history(Song.from_document(prev_current_track))
+        # one version bump covers the current track and the song history change,
+        # a change costs three round trips (see ROUND_TRIPS)
+        self.bump_versions([user_key(song.email)])
+        return True
 
     # SONG HISTORY CRUD OPERATIONS
     def create_song_history(self, song_history):
-        """ Create a song history in the database """
-        # check if the song history with the same user and song has already existed
-        existing_song_history = self.get_all_song_history_from_user(
-            song_history.email)
-        for song in existing_song_history:
-            if (song_history.song_id == song['song_id']):
-                return
-
-        self.song_history_coll.insert_one(song_history.__dict__)
-
-    def get_all_song_history_from_user(self, user_email):
-        """ Get a song history from the database """
+        """ Create a song history in the database, unless the user already has this song in their history.
+        Returns True if the song history was newly created """
+        created = self._create_song_history(song_history)
+        if created:
+            self.bump_versions([user_key(song_history.email)])
+        return created
+
+    def _create_song_history(self, song_history):
+        """ create_song_history without the version bump """
+        query = {
+            "email": song_history.email,
+            "song_id": song_history.song_id
+        }
+        try:
+            result = self.song_history_coll.update_one(
+                query,
+                {
+                    "$setOnInsert": song_history.to_document()
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # a concurrent request inserted the same song history first
+            return False
+        if result.upserted_id is None:
+            return False
+        if PROFILE_VIEWS_ENABLED:
+            self._push_songs_to_profile_views(
+                [(song_history, result.upserted_id)])
+        return True
+
+    def create_song_histories(self, song_histories):
+        """ Create many song histories in one bulk write, skipping songs already in a user's history.
+        Returns the number of song histories newly created """
+        operations = [
+            UpdateOne(
+                {
+                    "email": song_history.email,
+                    "song_id": song_history.song_id
+                },
+                {
+                    "$setOnInsert": song_history.to_document()
+                },
+                upsert=True
+            )
+            for song_history in song_histories
+        ]
+        if not operations:
+            return 0
+        try:
+            result = self.song_history_coll.bulk_write(operations, ordered=False)
+            upserted = result.upserted_ids
+        except BulkWriteError as error:
+            # duplicate key errors from concurrent inserts, every other write still went through
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                raise
+            upserted = {upsert['index']: upsert['_id']
+                        for upsert in error.details['upserted']}
+        if PROFILE_VIEWS_ENABLED and upserted:
+            self._push_songs_to_profile_views(
+                [(song_histories[index], song_id) for index, song_id in upserted.items()])
+        if upserted:
+            self.bump_versions(
+                [user_key(song_histories[index].email) for index in upserted])
+        return len(upserted)
+
+    def get_all_song_history_from_user(self, user_email, projection=None):
+        """ Get a song history from the database, projection selects the fields to return """
         query = {
             "email": get_converted_email(user_email)
         }
-        response = self.song_history_coll.find(query)
-        songs = []
-        for song in response:
-            song['_id'] = str(song['_id'])
-            songs.append(song)
-        return songs
+        return list(iter_documents(self.song_history_coll.find(query, projection).sort("_id", ASCENDING)))
+
+    def iter_song_history_from_user(self, user_email, after=None, limit=0, projection=None):
+        """ Yield a user's song history in insertion order, straight from the cursor.
+        after is the _id of the last song already seen, limit 0 means no limit.
+        The _id is always returned since it is the cursor of the next page """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        query.update(after_query(after))
+        response = self.song_history_coll.find(query, cursor_projection(projection)).sort(
+            "_id", ASCENDING).limit(limit).batch_size(CURSOR_BATCH_SIZE)
+        return iter_documents(response)
 
     def delete_all_song_history_for_user(self, user_email):
         """ Delete a song history from the database """
@@ -231,74 +812,125 @@ class Database:
             "email": get_converted_email(user_email)
         }
         self.song_history_coll.delete_many(query)
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.update_one(
+                query, {"$set": {"song_history": []}})
+        self.bump_versions([user_key(query["email"])])
 
     def song_history_for_user_exists(self, user_email):
         """ Check if a song history exists in the database """
         query = {
             "email": get_converted_email(user_email)
         }
-        return self.song_history_coll.find_one(query) is not None
+        return document_exists(self.song_history_coll, query)
 
     # REACTIONS CRUD OPERATIONS
     def create_reaction(self, reaction):
-        """ Create a reaction in the database """
-        reactions = self.get_all_reactions()
-        for r in reactions:
-            if r['song_id'] == reaction.song_id and r['email'] == reaction.email and r['sender_email'] == reaction.sender_email:
-                return
-        self.reactions_coll.insert_one(reaction.__dict__)
-
-    def get_reactions(self, user_email, song_id):
-        """ Get a reaction from the database for recipient """
+        """ Create a reaction in the database, unless the sender already reacted to this song.
+        Returns True if the reaction was newly created """
+        query = {
+            "email": reaction.email,
+            "song_id": reaction.song_id,
+            "sender_email": reaction.sender_email
+        }
+        try:
+            result = self.reactions_coll.update_one(
+                query,
+                {
+                    "$setOnInsert": reaction.to_document()
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # a concurrent request inserted the same reaction first
+            return False
+        if result.upserted_id is None:
+            return False
+        document = dict(reaction.to_document(), _id=str(result.upserted_id))
+        self._count_reactions(reaction.email, reaction.song_id, 1)
+        if PROFILE_VIEWS_ENABLED:
+            self.profile_view_coll.update_one(
+                {"email": reaction.email, "song_history": {
+                    "$elemMatch": {"song_id": reaction.song_id}}},
+                {"$push": {"song_history.$.reactions": document}}
+            )
+        self.bump_versions([user_key(reaction.email), REACTIONS_KEY])
+        publish_local(reaction.email, 'reaction', {
+            "email": reaction.email, "reaction": document})
+        return True
+
+    def get_reactions(self, user_email, song_id, projection=None):
+        """ Get a reaction from the database for recipient, projection selects the fields to return """
         query = {
             "email": get_converted_email(user_email),
             "song_id": song_id
         }
-        response = self.reactions_coll.find(query)
-        reactions = []
-        for reaction in response:
-            reaction['_id'] = str(reaction['_id'])
-            reactions.append(reaction)
-        return reactions
+        return list(iter_documents(self.reactions_coll.find(query, projection)))
 
-    def get_sender_reactions(self, sender_email, song_id):
-        """ Get a reaction from the database for sender """
+    def get_sender_reactions(self, sender_email, song_id, projection=None):
+        """ Get a reaction from the database for sender, projection selects the fields to return """
         query = {
             "sender_email": get_converted_email(sender_email),
             "song_id": song_id
         }
-        response = self.reactions_coll.find(query)
-        reactions = []
-        for reaction in response:
-            reaction['_id'] = str(reaction['_id'])
-            reactions.append(reaction)
-        return reactions
-
-    def get_all_reactions(self):
-        """ Get all reactions from the Reactions collection """
-        reactions = []
-        response = self.reactions_coll.find()
-        for reaction in response:
-            reaction['_id'] = str(reaction['_id'])
-            reactions.append(reaction)
-        print(reactions)
-        return reactions
+        return list(iter_documents(self.reactions_coll.find(query, projection)))
+
+    def get_all_reactions(self, projection=None):
+        """ Get all reactions from the Reactions collection, projection selects the fields to return """
+        return list(iter_documents(self.reactions_coll.find({}, projection)))
+
+    def iter_all_reactions(self, after=None, limit=0, projection=None):
+        """ Yield reactions in insertion order, straight from the cursor.
+        after is the _id of the last reaction already seen, limit 0 means no limit.
+        The _id is always returned since it is the cursor of the next page """
+        response = self.reactions_coll.find(after_query(after), cursor_projection(projection)).sort(
+            "_id", ASCENDING).limit(limit).batch_size(CURSOR_BATCH_SIZE)
+        return iter_documents(response)
 
     def delete_reaction(self, user_email, song_id):
-        """ Delete a reaction from the database for recipient """
+        """ Delete a reaction from the database for recipient, returns True if one was deleted """
         query = {
             "email": get_converted_email(user_email),
             "song_id": song_id
         }
-        self.reactions_coll.delete_one(query)
+        reaction = self.reactions_coll.find_one_and_delete(
+            query, {"email": 1, "song_id": 1})
+        if reaction:
+            self._reaction_deleted(reaction)
+        return reaction is not None
 
     def delete_sender_reaction(self, sender_email, song_id):
-        """ Delete a reaction from the database for sender """
+        """ Delete a reaction from the database for sender, returns True if one was deleted """
         query = {
             "sender_email": get_converted_email(sender_email),
             "song_id": song_id
         }
-        self.reactions_coll.delete_one(query)
+        reaction = self.reactions_coll.find_one_and_delete(
+            query, {"email": 1, "song_id": 1})
+        if reaction:
+            self._reaction_deleted(reaction)
+        return reaction is not None
+
+    def get_reaction_counts(self, user_email):
+        """ Get {song_id: number of reactions} of the songs a user received reactions for, from the counters """
+        query = {
+            "email": get_converted_email(user_email),
+            "count": {"$gt": 0}
+        }
+        counters = self.reaction_counts_coll.find(
+            query, {"_id": 0, "song_id": 1, "count": 1})
+        return {counter['song_id']: counter['count'] for counter in counters}
+
+    def get_song_reaction_counts(self, song_ids):
+        """ Get {song_id: number of reactions to the song from all recipients} of song_ids, from the counters """
+        song_ids = list(dict.fromkeys(song_ids))
+        query = {
+            "_id": {"$in": song_ids}
+        }
+        counts = dict.fromkeys(song_ids, 0)
+        for counter in self.song_reaction_counts_coll.find(query):
+            counts[counter['_id']] = counter['count']
+        return counts
 
     def reaction_exists(self, user_email, song_id):
         """ Check if a reaction exists in the database """
@@ -306,7 +938,7 @@ class Database:
             "email": get_converted_email(user_email),
             "song_id": song_id
         }
-        return self.reactions_coll.find_one(query) is not None
+        return document_exists(self.reactions_coll, query)
 
     def reaction_sender_exists(self, sender_email, song_id):
         """ Check if sender_email gives reaction to song_id """
@@ -314,7 +946,121 @@ class Database:
             "sender_email": get_converted_email(sender_email),
             "song_id": song_id
         }
-        return self.reactions_coll.find_one(query) is not None
+        return document_exists(self.reactions_coll, query)
+
+    # REACTION COUNTER OPERATIONS
+    def rebuild_reaction_counts(self):
+        """ Regenerate the reaction_counts and song_reaction_counts collections from the reactions collection """
+        self.reactions_coll.aggregate([
+            {"$group": {"_id": {"email": "$email", "song_id": "$song_id"},
+                        "count": {"$sum": 1}}},
+            {"$project": {"_id": 0, "email": "$_id.email",
+                          "song_id": "$_id.song_id", "count": 1}},
+            {"$out": "reaction_counts"}
+        ])
+        self.reaction_counts_coll.aggregate([
+            {"$group": {"_id": "$song_id", "count": {"$sum": "$count"}}},
+            {"$out": "song_reaction_counts"}
+        ])
+
+    def _count_reactions(self, email, song_id, change):
+        """ Add change to the reaction counters of a recipient's song and of the song """
+        self.reaction_counts_coll.update_one(
+            {"email": email, "song_id": song_id}, {"$inc": {"count": change}}, upsert=True)
+        self.song_reaction_counts_coll.update_one(
+            {"_id": song_id}, {"$inc": {"count": change}}, upsert=True)
+
+    # PROFILE VIEW OPERATIONS
+    def rebuild_profile_views(self):
+        """ Regenerate every profile_view document from the user, song_history and reactions collections """
+        pipeline = complete_user_pipeline({}) + [{"$out": "profile_view"}]
+        self.user_coll.aggregate(pipeline)
+
+    def _push_songs_to_profile_views(self, songs):
+        """ Append newly created (song history, _id) pairs to their users' profile views,
+        with the reactions the songs already received """
+        reactions_query = {
+            "$or": [{"email": song.email, "song_id": song.song_id} for song, _ in songs]
+        }
+        reactions = {}
+        for reaction in self.reactions_coll.find(reactions_query):
+            reaction['_id'] = str(reaction['_id'])
+            reactions.setdefault(
+                (reaction['email'], reaction['song_id']), []).append(reaction)
+
+        songs_by_email = {}
+        for song, song_id in songs:
+            entry = dict(song.to_document(), _id=str(song_id),
+                         reactions=reactions.get((song.email, song.song_id), []))
+            songs_by_email.setdefault(song.email, []).append(entry)
+        self.profile_view_coll.bulk_write([
+            UpdateOne({"email": email}, {
+                      "$push": {"song_history": {"$each": entries}}})
+            for email, entries in songs_by_email.items()
+        ], ordered=False)
+
+    def _reaction_deleted(self, reaction):
+        """ Update the reaction counters, the profile view and resource versions after a reaction was deleted """
+        self._count_reactions(reaction['email'], reaction['song_id'], -1)
+        if PROFILE_VIEWS_ENABLED:
+            self._pull_reaction_from_profile_view(reaction)
+        self.bump_versions([user_key(reaction['email']), REACTIONS_KEY])
+
+    def _pull_reaction_from_profile_view(self, reaction):
+        """ Remove a deleted reaction from its recipient's profile view """
+        self.profile_view_coll.update_one(
+            {"email": reaction['email'], "song_history": {
+                "$elemMatch": {"reactions._id": str(reaction['_id'])}}},
+            {"$pull": {"song_history.$.reactions": {
+                "_id": str(reaction['_id'])}}}
+        )
+
+    # RESOURCE VERSION OPERATIONS
+    def bump_versions(self, keys):
+        """ Increment the version of each resource key, see response_cache """
+        keys = list(dict.fromkeys(keys))
+        self.versions_coll.bulk_write([
+            UpdateOne({"_id": key}, {"$inc": {"v": 1}}, upsert=True)
+            for key in keys
+        ], ordered=False)
+        forget_versions(keys)
+
+    def get_versions(self, keys):
+        """ Get {key: version} of the resource keys that have a version """
+        query = {
+            "_id": {"$in": list(keys)}
+        }
+        return {version['_id']: version['v'] for version in self.versions_coll.find(query)}
+
+    # SPOTIFY TOKEN CRUD OPERATIONS
+    def save_token(self, user_email, token):
+        """ Create or replace the Spotify token info of a user """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        document = dict(token, email=get_converted_email(user_email))
+        self.tokens_coll.replace_one(query, document, upsert=True)
+
+    def get_token(self, user_email):
+        """ Get the Spotify token info of a user, None if there is none """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        return self.tokens_coll.find_one(query, {"_id": 0, "email": 0})
+
+    def get_token_emails(self):
+        """ Get the emails of all users with stored Spotify token info """
+        return [token['email'] for token in self.tokens_coll.find({}, {"_id": 0, "email": 1})]
+
+    def delete_token(self, user_email, refresh_token=None):
+        """ Delete the Spotify token info of a user. If refresh_token is given, only delete
+        it if it still has that refresh token (the user may have logged in again since) """
+        query = {
+            "email": get_converted_email(user_email)
+        }
+        if refresh_token is not None:
+            query["refresh_token"] = refresh_token
+        self.tokens_coll.delete_one(query)
 
 
 """
@@ -350,4 +1096,11 @@ class Database:
     "email": "hevin.jant@gmail.com",
     "friend_email": "newfriend@email.com"
 }
+
+# NEW FRIENDS (BULK) JSON
+{
+    "email": "hevin.jant@gmail.com",
+    "friend_emails": ["newfriend@email.com", "otherfriend@email.com"],
+    "mutual": true
+}
 """
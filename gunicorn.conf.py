@@ -0,0 +1,40 @@
+""" Gunicorn settings, picked up automatically by 'gunicorn backend:app' """
+
+import os
+import tempfile
+import metrics
+from database_manager import close_client, DB_MAX_POOL_SIZE, STORAGE_BACKEND
+from indexes import ensure_indexes
+from pubsub import require_change_streams
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# each worker thread holds at most one pooled connection at a time,
+# so the pool never needs to be bigger than the thread count
+if threads > DB_MAX_POOL_SIZE:
+    threads = DB_MAX_POOL_SIZE
+
+
+def on_starting(server):
+    """ Check that live events reach every worker, sum the metrics of the workers on GET /metrics,
+    and provision the MongoDB indexes once, before any worker is forked """
+    if workers > 1 and STORAGE_BACKEND != 'memory':
+        require_change_streams('the other web workers')
+    if workers > 1 or metrics.METRICS_DIR:
+        metrics.use_directory(metrics.METRICS_DIR or os.path.join(
+            tempfile.gettempdir(), f'spottem-metrics-{os.getpid()}'))
+    if os.environ.get('ENSURE_INDEXES_ON_STARTUP'):
+        ensure_indexes()
+        close_client()
+
+
+def post_fork(server, worker):
+    """ Drop any MongoClient inherited from the master, the worker builds its own on first use """
+    close_client()
+
+
+def worker_exit(server, worker):
+    """ Close the worker's connection pool on shutdown, and write its last metrics """
+    close_client()
+    metrics.registry.flush()
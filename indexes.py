@@ -0,0 +1,58 @@
+""" Index declarations for the spottem collections and the code to provision them.
+
+Every lookup in Database filters on email, (email, song_id) or (sender_email, song_id),
+the indexes below make those lookups index scans instead of collection scans.
+ensure_indexes() is idempotent, it runs on gunicorn startup when ENSURE_INDEXES_ON_STARTUP
+is set, or manually with 'python manage.py ensure-indexes'.
+"""
+
+from pymongo import IndexModel, ASCENDING
+from database_manager import Database
+
+INDEXES = {
+    # one document per user
+    "user": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    # a song appears at most once in a user's history,
+    # the email prefix also serves song_history_for_user_exists
+    "song_history": [
+        IndexModel([("email", ASCENDING), ("song_id", ASCENDING)],
+                   name="email_song_id_unique", unique=True),
+        # a user's history in insertion order: keyset pagination, get_all_song_history_from_user
+        # and the $lookup in complete_user_pipeline
+        IndexModel([("email", ASCENDING), ("_id", ASCENDING)],
+                   name="email_id"),
+    ],
+    # a sender reacts at most once to a recipient's song,
+    # song_id is placed before sender_email so the index also serves the (email, song_id) lookups
+    "reactions": [
+        IndexModel([("email", ASCENDING), ("song_id", ASCENDING), ("sender_email", ASCENDING)],
+                   name="email_song_id_sender_email_unique", unique=True),
+        IndexModel([("sender_email", ASCENDING), ("song_id", ASCENDING)],
+                   name="sender_email_song_id"),
+    ],
+    # materialized complete user documents, read by email
+    "profile_view": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    # one reaction counter per (recipient, song), the email prefix serves the summary of a recipient
+    # and the $lookup of complete_user_pipeline with summary_only. Per song counters are keyed by _id
+    "reaction_counts": [
+        IndexModel([("email", ASCENDING), ("song_id", ASCENDING)],
+                   name="email_song_id_unique", unique=True),
+    ],
+    # one stored Spotify token per user
+    "tokens": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+}
+
+
+def ensure_indexes(database=None):
+    """ Create the declared indexes that don't exist yet, returns the names of all declared indexes """
+    database = database or Database()
+    created = []
+    for collection_name, indexes in INDEXES.items():
+        created += database.db[collection_name].create_indexes(indexes)
+    return created
@@ -0,0 +1,63 @@
+""" Fast JSON serialization of MongoDB documents.
+
+Responses are encoded with orjson when it is installed (falling back to the standard library),
+and ObjectIds and datetimes are converted by default(). MongoJSONEncoder plugs the same encoding
+into Flask's jsonify.
+"""
+
+import datetime
+import json
+import time
+from bson import ObjectId
+from flask.json import JSONEncoder
+from metrics import record_time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(obj):
+    """ Converts the types JSON has no encoding for, raises TypeError for anything else """
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+def dumps(obj, sort_keys=False):
+    """ Returns obj encoded as a compact JSON string, the time it takes counts as serialization time """
+    start = time.perf_counter()
+    try:
+        return _dumps(obj, sort_keys)
+    finally:
+        record_time('serialize', time.perf_counter() - start)
+
+
+def _dumps(obj, sort_keys):
+    """ dumps without the timing """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        try:
+            return orjson.dumps(obj, default=default, option=option).decode()
+        except TypeError:
+            # e.g. integers beyond 64 bits or non-string keys, leave them to the standard library
+            pass
+    return json.dumps(obj, default=default, sort_keys=sort_keys, separators=(',', ':'))
+
+
+class MongoJSONEncoder(JSONEncoder):
+    """ Flask JSON encoder (app.json_encoder) that understands ObjectIds,
+    and encodes with orjson unless pretty printing is asked for """
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return default(o)
+        return super().default(o)
+
+    def encode(self, o):
+        if self.indent is None:
+            return dumps(o, sort_keys=self.sort_keys)
+        return super().encode(o)
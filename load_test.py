@@ -0,0 +1,397 @@
+""" Benchmark and load test of the HTTP end points.
+
+Seeds synthetic users, friends, song histories, reactions and Spotify tokens at a configurable
+scale into the storage selected by STORAGE_BACKEND (or --storage), and replaces Spotify with a
+local stub that always answers with a playing track.
+
+    python load_test.py bench [--users N --friends N --songs N --reactions N --requests N] [--mode both]
+        drives the app in-process through the Flask test client (sync mode) and the ASGI app of
+        asgi.py through httpx (async mode), and reports p50/p99 latency, throughput and database
+        round trips per request of every end point, side by side
+    python load_test.py serve [scale options] [--port 8000 --workers 2 --threads 4] [--mode sync]
+        seeds, then serves the app with gunicorn (uvicorn workers in async mode),
+        the workers inherit the seeded memory engine
+    python load_test.py load --url http://127.0.0.1:8000 [scale options] [--threads 16 --duration 10]
+        multi-threaded HTTP load against a running server seeded with the same scale
+
+With MongoDB, use a scratch database (e.g. DB_NAME=spottem_load), seeded users are not removed.
+Round trips are MongoDB commands with STORAGE_BACKEND=mongo. With the memory engine every storage
+call a request makes counts as the most commands the same Database method may send
+(database_manager.ROUND_TRIPS, which test_database.py holds the methods to), so ROUND_TRIP_BUDGETS
+also catch per-friend or per-song query loops, and extra commands inside a Database method,
+without a database.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import requests
+import database_manager
+from database_manager import User, Song, Reaction, get_database, get_converted_email, ROUND_TRIPS
+
+""" Most database round trips a request to each end point may make, with cold caches """
+ROUND_TRIP_BUDGETS = {
+    'user': 2,
+    'friends': 5,
+    'current_track': 4,
+    'reactions': 1,
+}
+
+""" Currently playing response of the Spotify stub """
+STUB_TRACK = {
+    "is_playing": True,
+    "progress_ms": 1000,
+    "item": {
+        "id": "load-song",
+        "name": "Load Song",
+        "duration_ms": 180000,
+        "artists": [{"name": "Load Artist"}],
+        "album": {"images": [{"url": "image url"}]},
+        "external_urls": {"spotify": "song url"},
+        "preview_url": "preview url"
+    }
+}
+
+# SEEDING
+
+
+def user_email(index):
+    """ Returns the email of the index-th seeded user """
+    return f'load-user-{index}@spottem.com'
+
+
+def seed(database, users=100, friends=10, songs=20, reactions=2):
+    """ Insert users, each with friends friends (the following users), songs songs in their
+    history, reactions reactions from their friends to each song, and a Spotify token """
+    emails = [user_email(index) for index in range(users)]
+    for index, email in enumerate(emails):
+        database.create_user(User(f'Load User {index}', index, email, None))
+        database.save_token(email, {"access_token": f'token-{index}', "refresh_token": None,
+                                    "expires_at": time.time() + 86400, "scope": None})
+    for index, email in enumerate(emails):
+        friend_emails = [emails[(index + offset) % users]
+                         for offset in range(1, min(friends, users - 1) + 1)]
+        if friend_emails:
+            database.add_friends(email, friend_emails)
+        database.create_song_histories([
+            Song(email, f'load-song-{song}', f'Song {song}', 'Artist', 'Album',
+                 'song url', 'image url', 'preview url')
+            for song in range(songs)
+        ])
+        for song in range(songs):
+            for sender in friend_emails[:reactions]:
+                database.create_reaction(Reaction(email, f'Load User {index}', get_converted_email(sender), 'Sender',
+                                                  f'load-song-{song}', f'Song {song}', 'Artist', 'Album', 'song url', 'image url',
+                                                  'preview url', 'time stamp'))
+    return emails
+
+
+def endpoint_paths(email):
+    """ Returns {end point: path} of the requests made for a user """
+    return {
+        'user': f'/user/{email}',
+        'friends': f'/user/friends/{email}',
+        'current_track': f'/current-track/{email}',
+        'reactions': '/reactions?limit=100',
+    }
+
+# SPOTIFY STUB
+
+
+class SpotifyStubHandler(BaseHTTPRequestHandler):
+    """ Answers every request with STUB_TRACK """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        payload = json.dumps(STUB_TRACK).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_spotify_stub():
+    """ Start the Spotify stub on a free local port, returns the server """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SpotifyStubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_spotify_stub(server):
+    """ Point this process' Spotify client at the stub, and drop clients built from the old one """
+    import asgi
+    import current_track_cache
+    import spotify_client
+    import token_manager
+    api_url = f'http://127.0.0.1:{server.server_port}'
+    spotify_client._client = spotify_client.SpotifyClient(
+        api_url=api_url, accounts_url=api_url)
+    spotify_client._client_pid = os.getpid()
+    asgi._spotify = None
+    token_manager._manager = None
+    current_track_cache._cache = None
+
+# ROUND TRIP COUNTING
+
+
+class StorageCallCounter:
+    """ Wraps a storage engine and counts the calls made to its methods,
+    each as the most MongoDB commands the Database method may send """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if not callable(attribute):
+            return attribute
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.count += ROUND_TRIPS[name]
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def use_storage(storage):
+    """ Make the backend, the async storage and the token manager use storage instead of get_database() """
+    import async_database
+    import backend
+    import token_manager
+    backend.get_database = lambda: storage
+    async_database.get_database = lambda: storage
+    token_manager.get_database = lambda: storage
+    token_manager._manager = None
+
+
+def reset_caches():
+    """ Drop the response, version, friend list, token and current track caches of this process,
+    so every mode is benchmarked from cold caches """
+    import backend
+    import current_track_cache
+    import response_cache
+    import token_manager
+    with response_cache._versions_lock:
+        response_cache._versions.clear()
+    response_cache.response_bodies.clear()
+    backend.friend_lists.clear()
+    token_manager._manager = None
+    current_track_cache._cache = None
+
+
+def round_trip_counter(storage):
+    """ Returns a function giving the number of round trips made so far: MongoDB commands if storage
+    is a Database, otherwise the commands counted by storage (a StorageCallCounter) """
+    if isinstance(storage.storage, database_manager.Database):
+        from benchmark import command_counter
+        return lambda: command_counter.count
+    return lambda: storage.count
+
+# REPORTS
+
+
+def percentile(values, fraction):
+    """ Returns the value below which fraction of the sorted values fall """
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(latencies, seconds, round_trips=None):
+    """ Returns the p50 and p99 latency in ms, the throughput and the round trips of a list of latencies """
+    latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'requests_per_second': len(latencies) / seconds if seconds else 0.0,
+    }
+    if round_trips is not None:
+        summary['round_trips_average'] = sum(round_trips) / len(round_trips)
+        summary['round_trips_max'] = max(round_trips)
+    return summary
+
+
+def print_report(results):
+    """ Print one line per end point """
+    print('end point     | requests |   p50 ms |   p99 ms |    req/s | round trips avg, max')
+    for endpoint, summary in results.items():
+        trips = ''
+        if 'round_trips_max' in summary:
+            trips = f"{summary['round_trips_average']:>6.2f}, {summary['round_trips_max']}"
+        print(f"{endpoint:<13} | {summary['requests']:>8} | {summary['p50_ms']:>8.2f} | {summary['p99_ms']:>8.2f} | "
+              f"{summary['requests_per_second']:>8.1f} | {trips}")
+
+# DRIVERS
+
+
+def bench(emails, requests_per_endpoint=200, storage=None, mode='sync'):
+    """ Request every end point requests_per_endpoint times, cycling through emails, through the
+    Flask test client (mode 'sync') or through httpx to the ASGI app (mode 'async').
+    Returns {end point: summary} """
+    import backend
+    storage = StorageCallCounter(storage or get_database())
+    use_storage(storage)
+    reset_caches()
+    round_trips_so_far = round_trip_counter(storage)
+    if mode == 'async':
+        return asyncio.run(bench_async(emails, requests_per_endpoint, round_trips_so_far))
+    client = backend.app.test_client()
+
+    async def get(path):
+        return client.get(path).status_code
+    return asyncio.run(run_bench(get, emails, requests_per_endpoint, round_trips_so_far))
+
+
+async def bench_async(emails, requests_per_endpoint, round_trips_so_far):
+    """ bench of the ASGI app, on one event loop """
+    import asgi
+    async with httpx.AsyncClient(app=asgi.app, base_url='http://load-test') as client:
+        async def get(path):
+            return (await client.get(path)).status_code
+        results = await run_bench(get, emails, requests_per_endpoint, round_trips_so_far)
+    # the Spotify client belongs to this event loop
+    await asgi.shutdown()
+    return results
+
+
+async def run_bench(get, emails, requests_per_endpoint, round_trips_so_far):
+    """ Time the requests of bench made with get(path), which returns the status code """
+    results = {}
+    for endpoint in ROUND_TRIP_BUDGETS:
+        latencies = []
+        round_trips = []
+        start = time.perf_counter()
+        for index in range(requests_per_endpoint):
+            path = endpoint_paths(emails[index % len(emails)])[endpoint]
+            trips_before = round_trips_so_far()
+            request_start = time.perf_counter()
+            status = await get(path)
+            latencies.append(time.perf_counter() - request_start)
+            round_trips.append(round_trips_so_far() - trips_before)
+            if status >= 400:
+                raise RuntimeError(f'GET {path} answered {status}')
+        results[endpoint] = summarize(
+            latencies, time.perf_counter() - start, round_trips)
+    return results
+
+
+def load(url, emails, threads=16, duration=10):
+    """ Request the end points of random seeded users from threads threads for duration seconds.
+    Returns {end point: summary} """
+    deadline = time.monotonic() + duration
+    latencies = {endpoint: [] for endpoint in ROUND_TRIP_BUDGETS}
+    errors = []
+    lock = threading.Lock()
+
+    def run(offset):
+        session = requests.Session()
+        index = offset
+        while time.monotonic() < deadline:
+            for endpoint, path in endpoint_paths(emails[index % len(emails)]).items():
+                start = time.perf_counter()
+                try:
+                    status = session.get(url + path, timeout=30).status_code
+                except requests.RequestException as error:
+                    status = type(error).__name__
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies[endpoint].append(elapsed)
+                    if not isinstance(status, int) or status >= 400:
+                        errors.append((path, status))
+            index += threads
+
+    workers = [threading.Thread(target=run, args=(offset,))
+               for offset in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start
+    if errors:
+        print(f'{len(errors)} failed requests, e.g. {errors[0]}')
+    return {endpoint: summarize(values, seconds) for endpoint, values in latencies.items() if values}
+
+
+def serve(port=8000, workers=2, threads=4, mode='sync'):
+    """ Serve the app with gunicorn, forked workers keep the seeded in-memory storage.
+    In mode 'async' the workers are uvicorn workers serving asgi.app """
+    from gunicorn.app.base import BaseApplication
+    import asgi
+    import backend
+
+    class LoadTestApplication(BaseApplication):
+        """ Gunicorn application serving backend.app with the given settings """
+
+        def load_config(self):
+            self.cfg.set('bind', f'127.0.0.1:{port}')
+            self.cfg.set('workers', workers)
+            self.cfg.set('threads', threads)
+            if mode == 'async':
+                self.cfg.set('worker_class', 'uvicorn.workers.UvicornWorker')
+            self.cfg.set('post_fork', lambda server, worker: (
+                database_manager.close_client(), use_spotify_stub(stub)))
+
+        def load(self):
+            return asgi.app if mode == 'async' else backend.app
+
+    stub = start_spotify_stub()
+    LoadTestApplication().run()
+
+
+def main():
+    """ Parse the command line and run bench, serve or load """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', choices=['bench', 'serve', 'load'])
+    parser.add_argument('--mode', choices=['sync', 'async', 'both'], default=None,
+                        help="app to bench ('both' by default) or serve ('sync' by default)")
+    parser.add_argument('--storage', choices=['mongo', 'memory'],
+                        default=database_manager.STORAGE_BACKEND)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--friends', type=int, default=10)
+    parser.add_argument('--songs', type=int, default=20)
+    parser.add_argument('--reactions', type=int, default=2)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    args = parser.parse_args()
+    if args.command == 'serve' and args.mode == 'both':
+        parser.error('serve runs one mode at a time')
+    database_manager.STORAGE_BACKEND = args.storage
+
+    if args.command == 'load':
+        emails = [user_email(index) for index in range(args.users)]
+        print_report(load(args.url, emails, args.threads, args.duration))
+        return
+    if args.storage == 'mongo':
+        # registers the command counter before the MongoClient is created
+        import benchmark
+    emails = seed(get_database(), args.users,
+                  args.friends, args.songs, args.reactions)
+    if args.command == 'serve':
+        serve(args.port, args.workers, args.threads, args.mode or 'sync')
+        return
+    use_spotify_stub(start_spotify_stub())
+    print(f'{args.users} users, {args.friends} friends, {args.songs} songs, {args.reactions} reactions per song')
+    mode = args.mode or 'both'
+    for bench_mode in (['sync', 'async'] if mode == 'both' else [mode]):
+        print(f'\n{bench_mode} mode')
+        print_report(bench(emails, args.requests, mode=bench_mode))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+""" Maintenance commands, run 'python manage.py --help' for the list """
+
+import argparse
+from database_manager import Database
+from indexes import ensure_indexes
+
+
+def main():
+    """ Parses the command line and runs the requested command """
+    parser = argparse.ArgumentParser(description='spottem backend maintenance commands')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('ensure-indexes',
+                          help='create the declared MongoDB indexes (safe to run repeatedly)')
+    subparsers.add_parser('rebuild-profile-views',
+                          help='regenerate the profile_view collection from the user, song_history and reactions collections')
+    subparsers.add_parser('rebuild-reaction-counts',
+                          help='regenerate the reaction counters from the reactions collection')
+    args = parser.parse_args()
+
+    if args.command == 'ensure-indexes':
+        for name in ensure_indexes():
+            print(f'index ready: {name}')
+    elif args.command == 'rebuild-profile-views':
+        Database().rebuild_profile_views()
+        # $out keeps the indexes of the collection it replaces, but not on the first run
+        ensure_indexes()
+        print('profile views rebuilt')
+    elif args.command == 'rebuild-reaction-counts':
+        Database().rebuild_reaction_counts()
+        # $out keeps the indexes of the collection it replaces, but not on the first run
+        ensure_indexes()
+        print('reaction counts rebuilt')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,493 @@
+""" In-memory storage engine with the same CRUD methods as database_manager.Database.
+
+Selected with STORAGE_BACKEND=memory (see get_database), it keeps users, song histories,
+reactions, resource versions and tokens in dicts, with hash indexes on the lookups the backend
+makes: email, (email, song_id) and (sender_email, song_id). It needs no network, so the backend,
+the tests and the benchmarks can run on a machine without MongoDB. The data lives in the process
+and is lost when it exits, every worker process has its own copy.
+"""
+
+import collections
+import copy
+import threading
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from database_manager import Song, COMPLETE_USER_FIELDS, get_converted_email, get_original_email
+from pubsub import get_broker
+from response_cache import forget_versions, user_key, REACTIONS_KEY
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def project(document, projection):
+    """ Returns a copy of document with the top level fields selected by a find() projection """
+    if projection is None:
+        return copy.deepcopy(document)
+    include_id = projection.get("_id", 1)
+    fields = {field: value for field,
+              value in projection.items() if field != "_id"}
+    if any(fields.values()):
+        selected = {field: copy.deepcopy(document[field])
+                    for field in fields if field in document}
+    else:
+        selected = {field: copy.deepcopy(value) for field, value in document.items()
+                    if field not in fields}
+    if include_id and "_id" in document:
+        selected["_id"] = document["_id"]
+    else:
+        selected.pop("_id", None)
+    return selected
+
+
+def stringify_id(document):
+    """ Returns document with its _id (if any) converted to a string, like iter_documents """
+    if "_id" in document:
+        document["_id"] = str(document["_id"])
+    return document
+
+
+class MemoryDatabase:
+    """ Dict based stand-in for Database, safe to share between threads """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.users = {}
+        self.songs = {}
+        self.reactions = {}
+        self.versions = {}
+        self.tokens = {}
+        # hash indexes, lists keep insertion (and so _id) order
+        self.songs_by_email = {}
+        self.song_by_email_song = {}
+        self.reactions_by_email = {}
+        self.reactions_by_email_song = {}
+        self.reactions_by_sender_song = {}
+        self.reaction_by_email_song_sender = {}
+        # reaction counters, per (email, song_id) and per song_id
+        self.reaction_counts = collections.Counter()
+        self.song_reaction_counts = collections.Counter()
+
+    # USER CRUD OPERATIONS
+    def create_user(self, user):
+        """ Create a user """
+        document = dict(user.to_document(), _id=ObjectId())
+        with self._lock:
+            if document["email"] in self.users:
+                raise DuplicateKeyError(
+                    f"duplicate user {document['email']}", 11000)
+            self.users[document["email"]] = document
+        self.bump_versions([user_key(user.email)])
+
+    def get_user(self, user_email, projection=None):
+        """ Get a user, projection selects the fields to return """
+        with self._lock:
+            user = self.users.get(get_converted_email(user_email))
+            if user is None:
+                return None
+            return stringify_id(project(user, projection))
+
+    def get_complete_user(self, user_email, fields=None, summary_only=False):
+        """ Get a user with their song history and the reactions to each song """
+        return self.get_complete_users([user_email], fields, summary_only).get(get_converted_email(user_email))
+
+    def get_complete_users(self, user_emails, fields=None, summary_only=False):
+        """ Get the complete user data of many users keyed by converted email, see Database.get_complete_users """
+        if fields is not None:
+            unknown = set(fields) - set(COMPLETE_USER_FIELDS)
+            if unknown:
+                raise ValueError(
+                    f"unknown fields: {', '.join(sorted(unknown))}")
+        users = {}
+        with self._lock:
+            for email in dict.fromkeys(get_converted_email(email) for email in user_emails):
+                if email in self.users:
+                    users[email] = self._complete_user(
+                        email, fields, summary_only=summary_only)
+        return users
+
+    def get_friends_feed(self, user_email, limit=None, songs_per_friend=None, summary_only=False):
+        """ Get the complete user data of a user's friends, in the order they were added.
+        Returns None if the user does not exist """
+        with self._lock:
+            user = self.users.get(get_converted_email(user_email))
+            if user is None:
+                return None
+            friends = user.get("friends", [])
+            if limit is not None:
+                friends = friends[:max(limit, 0)]
+            return [self._complete_user(friend, songs_per_user=songs_per_friend, summary_only=summary_only)
+                    for friend in friends if friend in self.users]
+
+    def _complete_user(self, email, fields=None, songs_per_user=None, summary_only=False):
+        """ Returns the complete user document of an existing user """
+        user = stringify_id(copy.deepcopy(self.users[email]))
+        if fields is None or "song_history" in fields:
+            song_ids = self.songs_by_email.get(email, [])
+            if songs_per_user is not None:
+                song_ids = song_ids[-songs_per_user:] if songs_per_user > 0 else []
+            user["song_history"] = []
+            for song_id in song_ids:
+                song = stringify_id(copy.deepcopy(self.songs[song_id]))
+                if summary_only:
+                    song["reaction_count"] = self.reaction_counts[(
+                        email, song["song_id"])]
+                    user["song_history"].append(song)
+                    continue
+                song["reactions"] = [stringify_id(copy.deepcopy(self.reactions[reaction_id]))
+                                     for reaction_id in self.reactions_by_email_song.get((email, song["song_id"]), [])]
+                user["song_history"].append(song)
+        if fields is not None:
+            user = {field: user[field]
+                    for field in fields if field in user}
+            user["email"] = email
+        return user
+
+    def delete_user(self, user_email):
+        """ Delete a user """
+        email = get_converted_email(user_email)
+        with self._lock:
+            self.users.pop(email, None)
+        self.bump_versions([user_key(email)])
+
+    def user_exists(self, user_email):
+        """ Check if a user exists """
+        with self._lock:
+            return get_converted_email(user_email) in self.users
+
+    def insert_friend_to_user(self, user_email, friend_email):
+        """ Insert a friend to user friends array.
+        Returns False if friend_email is not a valid user or is already a friend """
+        email = get_converted_email(user_email)
+        friend_email = get_converted_email(friend_email)
+        with self._lock:
+            user = self.users.get(email)
+            if friend_email not in self.users or user is None or friend_email in user["friends"]:
+                return False
+            user["friends"].append(friend_email)
+        self.bump_versions([user_key(email)])
+        return True
+
+    def add_friends(self, user_email, friend_emails, mutual=False):
+        """ Insert many friends to user friends array, unknown emails are skipped.
+        If mutual is True the user is also added to each friend's friends array.
+        Returns the emails of the friends that exist, None if the user does not exist """
+        user_email = get_converted_email(user_email)
+        friend_emails = [friend_email for friend_email in dict.fromkeys(
+            get_converted_email(friend_email) for friend_email in friend_emails) if friend_email != user_email]
+        with self._lock:
+            user = self.users.get(user_email)
+            if user is None:
+                return None
+            valid_friends = [
+                friend_email for friend_email in friend_emails if friend_email in self.users]
+            if not valid_friends:
+                return []
+            user["friends"] += [friend_email for friend_email in valid_friends
+                                if friend_email not in user["friends"]]
+            if mutual:
+                for friend_email in valid_friends:
+                    friends = self.users[friend_email]["friends"]
+                    if user_email not in friends:
+                        friends.append(user_email)
+        changed = [user_email] + (valid_friends if mutual else [])
+        self.bump_versions([user_key(email) for email in changed])
+        return [get_original_email(friend) for friend in valid_friends]
+
+    def delete_friend(self, user_email, friend_email):
+        """ Remove a friend from user friends array, returns True if it was removed """
+        email = get_converted_email(user_email)
+        friend_email = get_converted_email(friend_email)
+        with self._lock:
+            user = self.users.get(email)
+            if user is None or friend_email not in user["friends"]:
+                return False
+            user["friends"] = [
+                friend for friend in user["friends"] if friend != friend_email]
+        self.bump_versions([user_key(email)])
+        return True
+
+    def get_all_user_friends(self, user_email):
+        """ Get all friends of a user, an empty list if the user does not exist """
+        with self._lock:
+            user = self.users.get(get_converted_email(user_email))
+            if user is None:
+                return []
+            return [get_original_email(friend) for friend in user["friends"]]
+
+    def update_current_track(self, user_email, song):
+        """ Update the current playing track of user, the previous current track is moved to the
+        user's song history. Returns True if the current track changed """
+        email = get_converted_email(user_email)
+        current_track = song.to_document() if song else None
+        with self._lock:
+            user = self.users.get(email)
+            if user is None:
+                return False
+            previous = user.get("current_track")
+            if song is None:
+                if previous is None:
+                    return False
+            elif previous is not None and previous.get("song_id") == song.song_id:
+                return False
+            user["current_track"] = copy.deepcopy(current_track)
+            if song is not None and previous:
+                self._create_song_history(Song.from_document(previous))
+        # change streams never see these writes, they are always published here
+        get_broker().publish(email, 'current_track', {
+            "email": email, "current_track": current_track})
+        self.bump_versions([user_key(email)])
+        return True
+
+    # SONG HISTORY CRUD OPERATIONS
+    def create_song_history(self, song_history):
+        """ Create a song history, unless the user already has this song in their history.
+        Returns True if the song history was newly created """
+        with self._lock:
+            created = self._create_song_history(song_history)
+        if created:
+            self.bump_versions([user_key(song_history.email)])
+        return created
+
+    def _create_song_history(self, song_history):
+        """ create_song_history without the version bump, the lock must be held """
+        key = (song_history.email, song_history.song_id)
+        if key in self.song_by_email_song:
+            return False
+        document = dict(song_history.to_document(), _id=ObjectId())
+        self.songs[document["_id"]] = document
+        self.song_by_email_song[key] = document["_id"]
+        self.songs_by_email.setdefault(
+            song_history.email, []).append(document["_id"])
+        return True
+
+    def create_song_histories(self, song_histories):
+        """ Create many song histories, skipping songs already in a user's history.
+        Returns the number of song histories newly created """
+        with self._lock:
+            created = [song_history for song_history in song_histories
+                       if self._create_song_history(song_history)]
+        if created:
+            self.bump_versions(
+                [user_key(song_history.email) for song_history in created])
+        return len(created)
+
+    def get_all_song_history_from_user(self, user_email, projection=None):
+        """ Get a user's song history, projection selects the fields to return """
+        with self._lock:
+            return [stringify_id(project(self.songs[song_id], projection))
+                    for song_id in self.songs_by_email.get(get_converted_email(user_email), [])]
+
+    def iter_song_history_from_user(self, user_email, after=None, limit=0, projection=None):
+        """ Yield a user's song history in insertion order, see Database.iter_song_history_from_user """
+        with self._lock:
+            song_ids = list(self.songs_by_email.get(
+                get_converted_email(user_email), []))
+        return self._page(self.songs, song_ids, after, limit, projection)
+
+    def delete_all_song_history_for_user(self, user_email):
+        """ Delete a user's song history """
+        email = get_converted_email(user_email)
+        with self._lock:
+            for song_id in self.songs_by_email.pop(email, []):
+                song = self.songs.pop(song_id)
+                del self.song_by_email_song[(email, song["song_id"])]
+        self.bump_versions([user_key(email)])
+
+    def song_history_for_user_exists(self, user_email):
+        """ Check if a user has a song history """
+        with self._lock:
+            return bool(self.songs_by_email.get(get_converted_email(user_email)))
+
+    # REACTIONS CRUD OPERATIONS
+    def create_reaction(self, reaction):
+        """ Create a reaction, unless the sender already reacted to this song.
+        Returns True if the reaction was newly created """
+        key = (reaction.email, reaction.song_id, reaction.sender_email)
+        with self._lock:
+            if key in self.reaction_by_email_song_sender:
+                return False
+            document = dict(reaction.to_document(), _id=ObjectId())
+            reaction_id = document["_id"]
+            self.reactions[reaction_id] = document
+            self.reaction_by_email_song_sender[key] = reaction_id
+            self.reactions_by_email.setdefault(
+                reaction.email, []).append(reaction_id)
+            self.reactions_by_email_song.setdefault(
+                (reaction.email, reaction.song_id), []).append(reaction_id)
+            self.reactions_by_sender_song.setdefault(
+                (reaction.sender_email, reaction.song_id), []).append(reaction_id)
+            self.reaction_counts[(reaction.email, reaction.song_id)] += 1
+            self.song_reaction_counts[reaction.song_id] += 1
+            document = stringify_id(copy.deepcopy(document))
+        self.bump_versions([user_key(reaction.email), REACTIONS_KEY])
+        get_broker().publish(reaction.email, 'reaction', {
+            "email": reaction.email, "reaction": document})
+        return True
+
+    def get_reactions(self, user_email, song_id, projection=None):
+        """ Get the reactions a recipient received for a song """
+        with self._lock:
+            return [stringify_id(project(self.reactions[reaction_id], projection))
+                    for reaction_id in self.reactions_by_email_song.get((get_converted_email(user_email), song_id), [])]
+
+    def get_sender_reactions(self, sender_email, song_id, projection=None):
+        """ Get the reactions a sender gave to a song """
+        with self._lock:
+            return [stringify_id(project(self.reactions[reaction_id], projection))
+                    for reaction_id in self.reactions_by_sender_song.get((get_converted_email(sender_email), song_id), [])]
+
+    def get_all_reactions(self, projection=None):
+        """ Get all reactions """
+        with self._lock:
+            return [stringify_id(project(reaction, projection)) for reaction in self.reactions.values()]
+
+    def iter_all_reactions(self, after=None, limit=0, projection=None):
+        """ Yield reactions in insertion order, see Database.iter_all_reactions """
+        with self._lock:
+            reaction_ids = list(self.reactions)
+        return self._page(self.reactions, reaction_ids, after, limit, projection)
+
+    def delete_reaction(self, user_email, song_id):
+        """ Delete a reaction for recipient, returns True if one was deleted """
+        with self._lock:
+            reaction_ids = self.reactions_by_email_song.get(
+                (get_converted_email(user_email), song_id))
+            if not reaction_ids:
+                return False
+            email = self._delete_reaction(reaction_ids[0])
+        self.bump_versions([user_key(email), REACTIONS_KEY])
+        return True
+
+    def delete_sender_reaction(self, sender_email, song_id):
+        """ Delete a reaction for sender, returns True if one was deleted """
+        with self._lock:
+            reaction_ids = self.reactions_by_sender_song.get(
+                (get_converted_email(sender_email), song_id))
+            if not reaction_ids:
+                return False
+            email = self._delete_reaction(reaction_ids[0])
+        self.bump_versions([user_key(email), REACTIONS_KEY])
+        return True
+
+    def _delete_reaction(self, reaction_id):
+        """ Remove a reaction from the collection and its indexes, returns the recipient's email """
+        reaction = self.reactions.pop(reaction_id)
+        email, song_id, sender_email = reaction["email"], reaction["song_id"], reaction["sender_email"]
+        del self.reaction_by_email_song_sender[(email, song_id, sender_email)]
+        self.reaction_counts[(email, song_id)] -= 1
+        self.song_reaction_counts[song_id] -= 1
+        for index, key in ((self.reactions_by_email, email),
+                           (self.reactions_by_email_song, (email, song_id)),
+                           (self.reactions_by_sender_song, (sender_email, song_id))):
+            index[key].remove(reaction_id)
+            if not index[key]:
+                del index[key]
+        return email
+
+    def get_reaction_counts(self, user_email):
+        """ Get {song_id: number of reactions} of the songs a user received reactions for """
+        email = get_converted_email(user_email)
+        with self._lock:
+            return {song_id: count for (recipient, song_id), count in self.reaction_counts.items()
+                    if recipient == email and count > 0}
+
+    def get_song_reaction_counts(self, song_ids):
+        """ Get {song_id: number of reactions to the song from all recipients} of song_ids """
+        with self._lock:
+            return {song_id: self.song_reaction_counts[song_id] for song_id in song_ids}
+
+    def reaction_exists(self, user_email, song_id):
+        """ Check if a recipient received a reaction for a song """
+        with self._lock:
+            return bool(self.reactions_by_email_song.get((get_converted_email(user_email), song_id)))
+
+    def reaction_sender_exists(self, sender_email, song_id):
+        """ Check if sender_email gives reaction to song_id """
+        with self._lock:
+            return bool(self.reactions_by_sender_song.get((get_converted_email(sender_email), song_id)))
+
+    def _page(self, documents, ids, after, limit, projection):
+        """ Returns an iterator over the documents of ids (in _id order) inserted after the _id after,
+        at most limit of them. An invalid after raises InvalidId here, like Database, not while iterating """
+        if after is not None:
+            after = ObjectId(after)
+            ids = [document_id for document_id in ids if document_id > after]
+        if limit:
+            ids = ids[:limit]
+        projection = {field: value for field, value in (projection or {}).items()
+                      if field != "_id"} or None
+        return self._iter_page(documents, ids, projection)
+
+    def _iter_page(self, documents, ids, projection):
+        """ Yield the documents of ids that still exist """
+        for document_id in ids:
+            with self._lock:
+                document = documents.get(document_id)
+                if document is None:
+                    continue
+                document = project(document, projection)
+            yield stringify_id(document)
+
+    # REACTION COUNTER OPERATIONS
+    def rebuild_reaction_counts(self):
+        """ Recount the reaction counters from the reactions """
+        with self._lock:
+            self.reaction_counts = collections.Counter(
+                (reaction["email"], reaction["song_id"]) for reaction in self.reactions.values())
+            self.song_reaction_counts = collections.Counter(
+                reaction["song_id"] for reaction in self.reactions.values())
+
+    # PROFILE VIEW OPERATIONS
+    def rebuild_profile_views(self):
+        """ Complete users are always assembled from the indexes, there are no views to rebuild """
+        pass
+
+    # RESOURCE VERSION OPERATIONS
+    def bump_versions(self, keys):
+        """ Increment the version of each resource key, see response_cache """
+        keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+        forget_versions(keys)
+
+    def get_versions(self, keys):
+        """ Get {key: version} of the resource keys that have a version """
+        with self._lock:
+            return {key: self.versions[key] for key in keys if key in self.versions}
+
+    # SPOTIFY TOKEN CRUD OPERATIONS
+    def save_token(self, user_email, token):
+        """ Create or replace the Spotify token info of a user """
+        with self._lock:
+            self.tokens[get_converted_email(user_email)] = copy.deepcopy(token)
+
+    def get_token(self, user_email):
+        """ Get the Spotify token info of a user, None if there is none """
+        with self._lock:
+            return copy.deepcopy(self.tokens.get(get_converted_email(user_email)))
+
+    def get_token_emails(self):
+        """ Get the emails of all users with stored Spotify token info """
+        with self._lock:
+            return list(self.tokens)
+
+    def delete_token(self, user_email, refresh_token=None):
+        """ Delete the Spotify token info of a user. If refresh_token is given, only delete
+        it if it still has that refresh token (the user may have logged in again since) """
+        email = get_converted_email(user_email)
+        with self._lock:
+            token = self.tokens.get(email)
+            if token is not None and refresh_token in (None, token.get('refresh_token')):
+                del self.tokens[email]
+
+
+def get_memory_database():
+    """ Returns the process-wide MemoryDatabase, creating it on first use """
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _database = MemoryDatabase()
+    return _database
@@ -0,0 +1,333 @@
+""" Per-request latency metrics.
+
+Every request handled by the backend gets a RequestTimer that collects the MongoDB commands
+(through the CommandListener passed to the MongoClient), the time spent waiting for Spotify and
+the time spent serializing JSON. The timer is kept in a context variable, so it follows the
+request on its thread, and in the async mode of asgi.py on its task and onto the storage thread
+pool of async_database.AsyncStorage, which runs each call in a copy of the task's context.
+When the request ends they are added to per-route histograms, served in the Prometheus text
+format on GET /metrics, and with SERVER_TIMING=1 also sent to the client in a Server-Timing header.
+
+With PROFILE_SLOW_REQUESTS_MS set, the stacks of the threads serving requests are sampled every
+PROFILE_SAMPLE_INTERVAL_MS, and the most frequent stacks of requests slower than the threshold
+are logged.
+
+Metrics are kept per process. With METRICS_DIR set (gunicorn.conf.py sets it up when it runs more than
+one worker) every process also writes its histograms to a file of its own in that directory, at most
+every METRICS_FLUSH_SECONDS, and GET /metrics on any worker serves the sum of all the files, so every
+scrape sees the same series whichever worker answers it.
+"""
+
+import collections
+import contextvars
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import uuid
+from pymongo import monitoring
+
+""" Send a Server-Timing header with the database, Spotify and serialization time of each request """
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '') not in ('', '0')
+
+""" Log the sampled stacks of requests slower than this many milliseconds, 0 disables the profiler """
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get('PROFILE_SLOW_REQUESTS_MS', 0))
+
+""" Milliseconds between two stack samples of the profiler """
+PROFILE_SAMPLE_INTERVAL_MS = float(
+    os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', 5))
+
+""" Directory shared by the worker processes, where each one writes its histograms (see above) """
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+""" Most seconds a process's histograms in METRICS_DIR lag behind its requests """
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+
+""" Upper bounds of the histogram buckets, in seconds and in database commands """
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+logger = logging.getLogger('metrics')
+
+_current = contextvars.ContextVar('request_timer', default=None)
+
+
+class Histogram:
+    """ Cumulative histogram with fixed bucket upper bounds, like a Prometheus histogram """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """ Add one value """
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def add(self, counts, count, total):
+        """ Add the bucket counts, count and sum of another histogram with the same buckets """
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+
+    def cumulative_counts(self):
+        """ Returns [(upper bound, number of values <= bound)] """
+        total = 0
+        counts = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            counts.append((bound, total))
+        return counts
+
+
+class RequestTimer:
+    """ Time and database commands attributed to the request running on a thread """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.start = clock()
+        self.db_commands = 0
+        self.seconds = collections.Counter()
+        self.samples = collections.Counter()
+
+    def elapsed(self):
+        """ Returns the seconds since the request started """
+        return self.clock() - self.start
+
+    def server_timing(self):
+        """ Returns the value of the Server-Timing header of the request """
+        total = self.elapsed() * 1000
+        return ', '.join([
+            f'db;dur={self.seconds["db"] * 1000:.1f};desc="{self.db_commands} commands"',
+            f'spotify;dur={self.seconds["spotify"] * 1000:.1f}',
+            f'serialize;dur={self.seconds["serialize"] * 1000:.1f}',
+            f'total;dur={total:.1f}'
+        ])
+
+
+class Registry:
+    """ Per-route histograms of the finished requests, summed over the processes writing to directory if one is set """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_SECONDS, clock=time.monotonic):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._next_flush = 0
+        self._pid = None
+        self._path = None
+
+    def observe(self, route, timer):
+        """ Add a finished request of route """
+        total = timer.elapsed()
+        values = [('request', total), ('db', timer.seconds['db']), ('spotify', timer.seconds['spotify']),
+                  ('serialize', timer.seconds['serialize']), ('db_commands', timer.db_commands)]
+        with self._lock:
+            for name, value in values:
+                histogram = self._histograms.get((name, route))
+                if histogram is None:
+                    histogram = self._histograms[(name, route)] = self._new_histogram(name)
+                histogram.observe(value)
+            due = self.directory is not None and self.clock() >= self._next_flush
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Write this process's histograms to its file in directory """
+        if self.directory is None:
+            return
+        with self._lock:
+            self._next_flush = self.clock() + self.flush_interval
+            if self._pid != os.getpid():
+                # a forked worker starts a file of its own, even if it got the pid of a process that exited
+                self._pid = os.getpid()
+                self._path = os.path.join(self.directory, f'{self._pid}-{uuid.uuid4().hex}.json')
+            path = self._path
+            snapshot = [[name, route, histogram.counts, histogram.count, histogram.sum]
+                        for (name, route), histogram in self._histograms.items()]
+        # written aside and renamed, so a reader never sees half a file
+        with open(path + '.tmp', 'w') as file:
+            json.dump(snapshot, file)
+        os.replace(path + '.tmp', path)
+
+    def render(self):
+        """ Returns the histograms in the Prometheus text exposition format """
+        lines = []
+        previous = None
+        for (name, route), histogram in sorted(self._collect().items()):
+            metric = f'spottem_{name}' if name == 'db_commands' else f'spottem_{name}_seconds'
+            if metric != previous:
+                lines.append(f'# TYPE {metric} histogram')
+                previous = metric
+            labels = f'route="{route}"'
+            for bound, count in histogram.cumulative_counts():
+                lines.append(
+                    f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(
+                f'{metric}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{metric}_sum{{{labels}}} {histogram.sum}')
+            lines.append(f'{metric}_count{{{labels}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def _collect(self):
+        """ Returns the histograms to render: copies of this process's, or the sums of every file in directory.
+        The files of exited workers are kept, so that the sums never go down """
+        if self.directory is None:
+            with self._lock:
+                snapshot = [[name, route, histogram.counts, histogram.count, histogram.sum]
+                            for (name, route), histogram in self._histograms.items()]
+        else:
+            self.flush()
+            snapshot = []
+            for path in glob.glob(os.path.join(self.directory, '*.json')):
+                try:
+                    with open(path) as file:
+                        snapshot += json.load(file)
+                except (OSError, ValueError):
+                    # removed by on_starting of a new gunicorn master
+                    continue
+        histograms = {}
+        for name, route, counts, count, total in snapshot:
+            histogram = histograms.get((name, route))
+            if histogram is None:
+                histogram = histograms[(name, route)] = self._new_histogram(name)
+            histogram.add(counts, count, total)
+        return histograms
+
+    def _new_histogram(self, name):
+        """ Returns an empty histogram with the buckets of the named value """
+        return Histogram(COMMAND_BUCKETS if name == 'db_commands' else SECONDS_BUCKETS)
+
+
+class CommandListener(monitoring.CommandListener):
+    """ Attributes every MongoDB command to the request it was sent for """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event)
+
+    def _record(self, event):
+        timer = current_timer()
+        if timer is not None:
+            timer.db_commands += 1
+            timer.seconds['db'] += event.duration_micros / 1e6
+
+
+class SlowRequestProfiler:
+    """ Samples the stacks of the threads serving requests from a background thread """
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL_MS / 1000):
+        self.interval = interval
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, timer):
+        """ Start sampling the current thread into timer.samples """
+        with self._lock:
+            self._timers[threading.get_ident()] = timer
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def remove(self):
+        """ Stop sampling the current thread """
+        with self._lock:
+            self._timers.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._timers:
+                    # no request is running, add() starts a new thread for the next one
+                    self._thread = None
+                    return
+                timers = dict(self._timers)
+            frames = sys._current_frames()
+            for ident, timer in timers.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    timer.samples[collapse_stack(frame)] += 1
+
+
+def collapse_stack(frame, depth=12):
+    """ Returns the innermost depth frames of a stack as 'file:function:line;...' from the outside in """
+    entries = []
+    while frame is not None and len(entries) < depth:
+        code = frame.f_code
+        entries.append(
+            f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+command_listener = CommandListener()
+registry = Registry()
+profiler = SlowRequestProfiler()
+
+
+def use_directory(directory):
+    """ Make the processes forked from now on write their histograms to directory and sum them on
+    GET /metrics. The files of a previous run are removed, so that its counts are not served again """
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.json*')):
+        os.remove(path)
+    registry.directory = directory
+
+
+def current_timer():
+    """ Returns the RequestTimer of the current request, None outside of requests """
+    return _current.get()
+
+
+def record_time(name, seconds):
+    """ Add seconds of the given kind ('spotify', 'serialize') to the current request """
+    timer = current_timer()
+    if timer is not None:
+        timer.seconds[name] += seconds
+
+
+def start_request(sample_stacks=True):
+    """ Start timing a request in the current context. sample_stacks=False leaves it out of the
+    profiler, for requests that share their thread with others (async end points) """
+    timer = RequestTimer()
+    _current.set(timer)
+    if PROFILE_SLOW_REQUESTS_MS and sample_stacks:
+        profiler.add(timer)
+    return timer
+
+
+def finish_request(route):
+    """ Stop timing the current request and add it to the histograms of route.
+    Returns its RequestTimer, None if no request was started """
+    timer = current_timer()
+    if timer is None:
+        return None
+    _current.set(None)
+    registry.observe(route, timer)
+    if PROFILE_SLOW_REQUESTS_MS:
+        profiler.remove()
+        elapsed_ms = timer.elapsed() * 1000
+        if elapsed_ms >= PROFILE_SLOW_REQUESTS_MS and timer.samples:
+            stacks = '\n'.join(f'  {count} {stack}' for stack,
+                               count in timer.samples.most_common(5))
+            logger.warning('slow request %s took %.0f ms, most sampled stacks:\n%s',
+                           route, elapsed_ms, stacks)
+    return timer
@@ -0,0 +1,219 @@
+""" Background service that keeps users' current tracks up to date.
+
+Runs next to the web process ('worker: python poller.py' in the Procfile). Every user with a
+stored Spotify token is polled on an adaptive schedule: a playing user is polled again right
+after the current song should end (but at least every POLLER_ACTIVE_INTERVAL seconds), users
+with nothing playing are polled less and less often up to POLLER_IDLE_INTERVAL. Polls run on
+a thread pool of POLLER_CONCURRENCY threads and share a budget of POLLER_RATE_LIMIT Spotify
+calls per second, access token refreshes included. A user whose token is gone (deleted when
+Spotify rejected its refresh) is dropped until they log in again. Changes are written with Database.update_current_track, so with
+CURRENT_TRACK_SOURCE=database the web process can answer current track reads from the database.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from database_manager import Song, get_database
+from spotify_client import get_spotify_client, parse_current_track
+from token_manager import get_token_manager
+from pubsub import require_change_streams
+
+# POLLER SETTINGS
+""" Number of users polled at the same time """
+POLLER_CONCURRENCY = int(os.environ.get('POLLER_CONCURRENCY', 8))
+
+""" Spotify calls per second allowed across all poller threads """
+POLLER_RATE_LIMIT = float(os.environ.get('POLLER_RATE_LIMIT', 10))
+
+""" Seconds between polls of a user who is playing something, and the shortest gap between polls """
+POLLER_ACTIVE_INTERVAL = float(os.environ.get('POLLER_ACTIVE_INTERVAL', 30))
+POLLER_MIN_INTERVAL = float(os.environ.get('POLLER_MIN_INTERVAL', 5))
+
+""" Longest gap between polls of a user who is not playing anything """
+POLLER_IDLE_INTERVAL = float(os.environ.get('POLLER_IDLE_INTERVAL', 300))
+
+""" Seconds between reloads of the list of users to poll """
+POLLER_USERS_REFRESH = float(os.environ.get('POLLER_USERS_REFRESH', 60))
+# end of POLLER SETTINGS
+
+logger = logging.getLogger('poller')
+
+
+class RateLimiter:
+    """ Token bucket shared by all poller threads, acquire() blocks until a call is allowed """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take one token, waiting for it if the bucket is empty """
+        while True:
+            with self._lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class CurrentTrackPoller:
+    """ Polls Spotify for the current track of every user with a stored token """
+
+    def __init__(self, database=None, token_manager=None, spotify=None,
+                 concurrency=POLLER_CONCURRENCY, rate_limit=POLLER_RATE_LIMIT, clock=time.monotonic):
+        self.database = database or get_database()
+        self.token_manager = token_manager or get_token_manager()
+        self.spotify = spotify or get_spotify_client()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.rate_limiter = RateLimiter(rate_limit, clock=clock)
+        self.clock = clock
+        self.stop_event = threading.Event()
+        self.next_poll = {}
+        self.idle_interval = {}
+        self.in_flight = set()
+        self.users_loaded = None
+        self._lock = threading.Lock()
+
+    def load_users(self):
+        """ Reload the users to poll, new users are due immediately """
+        emails = set(self.database.get_token_emails())
+        with self._lock:
+            for email in emails - self.next_poll.keys():
+                self.next_poll[email] = 0
+            for email in self.next_poll.keys() - emails:
+                del self.next_poll[email]
+                self.idle_interval.pop(email, None)
+        self.users_loaded = self.clock()
+
+    def run_once(self):
+        """ Start polls for the due users, returns the seconds until the next user is due """
+        if self.users_loaded is None or self.clock() - self.users_loaded >= POLLER_USERS_REFRESH:
+            self.load_users()
+        now = self.clock()
+        with self._lock:
+            due = [email for email, at in self.next_poll.items()
+                   if at <= now and email not in self.in_flight]
+            self.in_flight.update(due)
+        for email in due:
+            self.executor.submit(self._poll_and_schedule, email)
+        with self._lock:
+            waiting = [at for email, at in self.next_poll.items()
+                       if email not in self.in_flight]
+        if not waiting:
+            return 1
+        return max(min(waiting) - self.clock(), 0)
+
+    def run(self):
+        """ Poll until stop() is called """
+        while not self.stop_event.is_set():
+            try:
+                delay = self.run_once()
+            except Exception:
+                logger.exception('poller iteration failed')
+                delay = POLLER_MIN_INTERVAL
+            self.stop_event.wait(min(delay, 1))
+        self.executor.shutdown(wait=True)
+
+    def stop(self):
+        """ Ask run() to return after the polls in flight """
+        self.stop_event.set()
+
+    def _poll_and_schedule(self, email):
+        """ Poll one user and schedule their next poll """
+        try:
+            delay = self.poll_user(email)
+        except Exception:
+            logger.exception('polling %s failed', email)
+            delay = POLLER_IDLE_INTERVAL
+        with self._lock:
+            self.in_flight.discard(email)
+            if delay is None:
+                # load_users adds the user back if a token is stored again
+                self.next_poll.pop(email, None)
+                self.idle_interval.pop(email, None)
+            elif email in self.next_poll:
+                self.next_poll[email] = self.clock() + delay
+
+    def poll_user(self, email):
+        """ Fetch and store the current track of a user, returns the seconds until they should be polled again,
+        None if they should not be polled anymore because they have no valid token """
+        # refreshing an expiring token is a Spotify call too
+        access_token = self.token_manager.get_access_token(
+            email, before_refresh=self.rate_limiter.acquire)
+        if not access_token:
+            return None
+
+        self.rate_limiter.acquire()
+        try:
+            response = self.spotify.get_currently_playing(access_token)
+        except requests.RequestException:
+            return POLLER_ACTIVE_INTERVAL
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                retry_after = POLLER_ACTIVE_INTERVAL
+            return max(retry_after, POLLER_MIN_INTERVAL)
+        if response.status_code == 401:
+            # token revoked or expired, reload it from the database next time
+            self.token_manager.forget(email)
+            return POLLER_IDLE_INTERVAL
+        if response.status_code >= 400:
+            return POLLER_ACTIVE_INTERVAL
+
+        json_resp = response.json() if response.status_code == 200 else {}
+        track = parse_current_track(json_resp)
+        if track is None:
+            self.database.update_current_track(email, None)
+            return self._idle_delay(email)
+
+        song = Song(email, track['id'], track['track_name'], track['artists'],
+                    "", track['link'], track['image_url'], track['preview_url'])
+        # an unchanged song is a single read-only round trip (see Database.update_current_track)
+        self.database.update_current_track(email, song)
+        self.idle_interval.pop(email, None)
+        if not json_resp.get('is_playing'):
+            return POLLER_ACTIVE_INTERVAL
+        # poll again just after the song should have ended
+        remaining = (json_resp['item'].get('duration_ms', 0) -
+                     (json_resp.get('progress_ms') or 0)) / 1000 + 1
+        return min(max(remaining, POLLER_MIN_INTERVAL), POLLER_ACTIVE_INTERVAL)
+
+    def _idle_delay(self, email):
+        """ Doubles the polling gap of a user with nothing playing, up to POLLER_IDLE_INTERVAL """
+        interval = min(self.idle_interval.get(
+            email, POLLER_ACTIVE_INTERVAL / 2) * 2, POLLER_IDLE_INTERVAL)
+        self.idle_interval[email] = interval
+        return interval
+
+
+def main():
+    """ Run the poller until SIGTERM or SIGINT """
+    require_change_streams('poller.py')
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    poller = CurrentTrackPoller()
+    signal.signal(signal.SIGTERM, lambda signum, frame: poller.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: poller.stop())
+    logger.info('polling current tracks with %d threads, %.1f calls/s',
+                POLLER_CONCURRENCY, POLLER_RATE_LIMIT)
+    poller.run()
+
+
+if __name__ == '__main__':
+    main()
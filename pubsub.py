@@ -0,0 +1,208 @@
+""" In-process publish/subscribe of user events, used to push friends' updates over Server-Sent Events.
+
+Topics are users' (converted) emails. Events are published either by a thread following MongoDB
+change streams (EVENTS_SOURCE=change_streams, the default), which sees the writes of every worker
+and of poller.py but needs a replica set, or by the Database write methods of this process
+(EVENTS_SOURCE=local), which is only complete when this process makes every write: a single web
+worker without poller.py. gunicorn.conf.py and poller.py refuse to start with 'local' in that case.
+The memory engine always publishes its writes itself, its data never leaves the process.
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import logging
+
+""" Where events come from: MongoDB 'change_streams', or 'local' writes of this process """
+EVENTS_SOURCE = os.environ.get('EVENTS_SOURCE', 'change_streams')
+
+""" Events buffered per subscriber before it is considered too slow and told to resync """
+SUBSCRIPTION_QUEUE_SIZE = int(os.environ.get('SUBSCRIPTION_QUEUE_SIZE', 100))
+
+logger = logging.getLogger('pubsub')
+
+_broker = None
+_broker_lock = threading.Lock()
+_feed_pid = None
+
+
+class Subscription:
+    """ Queue of the events published to a set of topics """
+
+    def __init__(self, topics, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.topics = set(topics)
+        self.events = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def get(self, timeout=None):
+        """ Returns the next (event type, data) pair, or None if none arrived within timeout """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, event):
+        """ Queue an event, a full queue drops it and marks the subscription as overflowed """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class AsyncSubscription(Subscription):
+    """ Subscription read from an event loop, events may be published from any thread """
+
+    def __init__(self, topics, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.topics = set(topics)
+        self.loop = asyncio.get_running_loop()
+        self.events = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    async def get(self, timeout=None):
+        """ Returns the next (event type, data) pair, or None if none arrived within timeout """
+        try:
+            return await asyncio.wait_for(self.events.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def put(self, event):
+        """ Queue an event on the subscription's event loop """
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the event loop is closed, the stream is gone
+            pass
+
+    def _put(self, event):
+        """ Queue an event, a full queue drops it and marks the subscription as overflowed """
+        try:
+            self.events.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+
+class Broker:
+    """ Delivers published events to the subscriptions of their topic """
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics, subscription_class=Subscription):
+        """ Returns a new Subscription (or subscription_class) to the given topics """
+        subscription = subscription_class(topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stop delivering events to a subscription """
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscriptions.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[topic]
+
+    def publish(self, topic, event_type, data):
+        """ Deliver an event to every subscription of topic, never blocks """
+        with self._lock:
+            subscribers = list(self._subscriptions.get(topic, ()))
+        for subscription in subscribers:
+            subscription.put((event_type, data))
+
+    def subscriber_count(self):
+        """ Returns the number of (topic, subscription) pairs """
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscriptions.values())
+
+
+def get_broker():
+    """ Returns the process-wide Broker, creating it on first use """
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = Broker()
+    return _broker
+
+
+def require_change_streams(writer):
+    """ Raise RuntimeError if events come from the local writes of a process while writer writes too """
+    if EVENTS_SOURCE == 'local':
+        raise RuntimeError(f'EVENTS_SOURCE=local misses the writes of {writer}, '
+                           'set EVENTS_SOURCE=change_streams')
+
+
+def publish_local(topic, event_type, data):
+    """ Publish an event caused by a write of this process, unless events come from change streams """
+    if EVENTS_SOURCE == 'local':
+        get_broker().publish(topic, event_type, data)
+
+# Change stream feed
+
+
+def follow_current_tracks(database, broker):
+    """ Publish a 'current_track' event for every current_track change in the user collection """
+    pipeline = [
+        {"$match": {
+            "operationType": "update",
+            "updateDescription.updatedFields.current_track": {"$exists": True}
+        }},
+        {"$project": {
+            "fullDocument.email": 1,
+            "updateDescription.updatedFields.current_track": 1
+        }}
+    ]
+    with database.user_coll.watch(pipeline, full_document='updateLookup') as stream:
+        for change in stream:
+            email = change.get('fullDocument', {}).get('email')
+            if email:
+                current_track = change['updateDescription']['updatedFields']['current_track']
+                broker.publish(email, 'current_track', {
+                    "email": email, "current_track": current_track})
+
+
+def follow_reactions(database, broker):
+    """ Publish a 'reaction' event for every reaction inserted in the reactions collection """
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    with database.reactions_coll.watch(pipeline) as stream:
+        for change in stream:
+            reaction = change['fullDocument']
+            reaction['_id'] = str(reaction['_id'])
+            broker.publish(reaction['email'], 'reaction', {
+                "email": reaction['email'], "reaction": reaction})
+
+
+def start_change_stream_feed(database, broker=None):
+    """ Start daemon threads that feed the broker from MongoDB change streams, restarting them on errors """
+    broker = broker or get_broker()
+
+    def run_forever(follow):
+        while True:
+            try:
+                follow(database, broker)
+            except Exception:
+                logger.exception('change stream %s failed, restarting', follow.__name__)
+                threading.Event().wait(1)
+
+    threads = [threading.Thread(target=run_forever, args=(follow,), daemon=True)
+               for follow in (follow_current_tracks, follow_reactions)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def ensure_change_stream_feed(database):
+    """ Start the change stream feed of this process once, if events come from change streams """
+    global _feed_pid
+    if EVENTS_SOURCE != 'change_streams':
+        return
+    with _broker_lock:
+        if _feed_pid == os.getpid():
+            return
+        _feed_pid = os.getpid()
+    start_change_stream_feed(database)
@@ -0,0 +1,133 @@
+""" Versioned response caching for the read end points.
+
+Every resource (a user's profile, history and reactions: 'user:<email>', all reactions: 'reactions')
+has a version number in the 'versions' collection, incremented by the Database write methods.
+Responses carry a strong ETag derived from the request path and the versions of the resources they
+were built from, so a poll with a matching If-None-Match gets 304 Not Modified, and serialized bodies
+are kept in an in-process LRU keyed by that ETag.
+
+Versions are cached in memory for VERSION_CACHE_TTL seconds, which makes unchanged polls free of
+database round trips. A write in this process drops its keys from that cache right away, writes made
+by other processes are noticed once the TTL runs out.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+""" Seconds a resource version read from the database is trusted """
+VERSION_CACHE_TTL = float(os.environ.get('VERSION_CACHE_TTL', 1))
+
+""" Number of serialized response bodies kept in memory """
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def user_key(email):
+    """ Returns the resource key of a user's profile, song history and received reactions """
+    return 'user:' + email
+
+
+""" Resource key of the list of all reactions """
+REACTIONS_KEY = 'reactions'
+
+
+def get_versions(keys, loader, clock=time.monotonic):
+    """ Returns {key: version} for keys, calling loader(missing_keys) once for the keys
+    that are not cached or whose cached version expired """
+    versions, missing = _cached_versions(keys, clock)
+    if missing:
+        _store_versions(versions, missing, loader(missing), clock)
+    return versions
+
+
+async def get_versions_async(keys, loader, clock=time.monotonic):
+    """ get_versions for a loader that is a coroutine function """
+    versions, missing = _cached_versions(keys, clock)
+    if missing:
+        _store_versions(versions, missing, await loader(missing), clock)
+    return versions
+
+
+def _cached_versions(keys, clock):
+    """ Returns ({key: version} of the cached keys, [keys to load]) """
+    now = clock()
+    versions = {}
+    missing = []
+    with _versions_lock:
+        for key in keys:
+            cached = _versions.get(key)
+            if cached is not None and cached[0] > now:
+                versions[key] = cached[1]
+            else:
+                missing.append(key)
+    return versions, missing
+
+
+def _store_versions(versions, missing, loaded, clock):
+    """ Add the loaded versions of the missing keys to versions and to the cache """
+    expires = clock() + VERSION_CACHE_TTL
+    with _versions_lock:
+        for key in missing:
+            versions[key] = loaded.get(key, 0)
+            _versions[key] = (expires, versions[key])
+
+
+def forget_versions(keys):
+    """ Drop cached versions, called after this process bumped them """
+    with _versions_lock:
+        for key in keys:
+            _versions.pop(key, None)
+
+
+def make_etag(path, versions):
+    """ Returns a strong ETag for a response to path built from resources at the given versions """
+    fingerprint = path + '|' + ','.join(f'{key}={versions[key]}'
+                                        for key in sorted(versions))
+    return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+
+class LRUCache:
+    """ Thread-safe least recently used cache """
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        """ Returns the cached value of key, None if it is not cached """
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        """ Cache value under key, evicting the least recently used item if full """
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        """ Drop every item """
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self):
+        """ Returns a copy of the hit and miss counters and the number of cached items """
+        with self._lock:
+            return dict(self.stats, size=len(self._items))
+
+
+response_bodies = LRUCache()
@@ -0,0 +1,276 @@
+""" Client for the Spotify Web API and Accounts service.
+
+A single requests.Session per process keeps connections to Spotify alive between calls,
+every call has a timeout, and rate limited (429) or failed (5xx) calls are retried with
+backoff, honoring Spotify's Retry-After header. Latency is counted per end point.
+"""
+
+import os
+import threading
+import time
+import asyncio
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import record_time
+
+# SPOTIFY END POINTS
+""" Base url of the Spotify Accounts service, where token info is requested """
+SPOTIFY_ACCOUNTS_URL = os.environ.get(
+    'SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com')
+
+""" Base url of the Spotify Web API """
+SPOTIFY_API_URL = os.environ.get('SPOTIFY_API_URL', 'https://api.spotify.com/v1')
+
+"""
+Url where we can get the token info by providing the code.
+Using the code that we got by requesting to the authorization url as one of the parameters,
+we can get the token info from Spotify.
+Token info consists of the access token, the expiration time, and the refresh token.
+"""
+SPOTIFY_ACCESS_TOKEN_PATH = '/api/token'
+
+""" End point to get user current track """
+SPOTIFY_GET_CURRENT_TRACK_PATH = '/me/player/currently-playing'
+
+""" End point to get user account information """
+SPOTIFY_GET_USER_PROFILE_PATH = '/me'
+# end of SPOTIFY END POINTS
+
+# CLIENT SETTINGS
+""" Maximum number of kept-alive connections to each Spotify host, one per worker thread is enough """
+SPOTIFY_POOL_SIZE = int(os.environ.get('SPOTIFY_POOL_SIZE', 10))
+
+""" Seconds to wait for a connection to Spotify, and for Spotify to answer """
+SPOTIFY_CONNECT_TIMEOUT = float(os.environ.get('SPOTIFY_CONNECT_TIMEOUT', 3.05))
+SPOTIFY_READ_TIMEOUT = float(os.environ.get('SPOTIFY_READ_TIMEOUT', 10))
+
+""" Number of retries after a rate limited, failed or timed out call """
+SPOTIFY_MAX_RETRIES = int(os.environ.get('SPOTIFY_MAX_RETRIES', 2))
+
+""" Seconds to wait before the first retry, doubled for every following retry """
+SPOTIFY_BACKOFF = float(os.environ.get('SPOTIFY_BACKOFF', 0.5))
+
+""" Longest Retry-After we are willing to wait for, longer waits fail immediately """
+SPOTIFY_MAX_RETRY_AFTER = float(os.environ.get('SPOTIFY_MAX_RETRY_AFTER', 10))
+# end of CLIENT SETTINGS
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+class SpotifyClient:
+    """ Pooled, retrying HTTP client for the Spotify end points """
+
+    def __init__(self, api_url=SPOTIFY_API_URL, accounts_url=SPOTIFY_ACCOUNTS_URL, pool_size=SPOTIFY_POOL_SIZE,
+                 timeout=(SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT), max_retries=SPOTIFY_MAX_RETRIES,
+                 backoff=SPOTIFY_BACKOFF, max_retry_after=SPOTIFY_MAX_RETRY_AFTER):
+        self.api_url = api_url
+        self.accounts_url = accounts_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_retry_after = max_retry_after
+
+        self.session = self._make_session(pool_size)
+
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _make_session(self, pool_size):
+        """ Returns the pooled HTTP session the calls are sent with """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get_current_user(self, access_token):
+        """ Returns the response of the user account information end point """
+        return self.request('profile', 'GET', self.api_url + SPOTIFY_GET_USER_PROFILE_PATH,
+                            headers={"Authorization": f"Bearer {access_token}"})
+
+    def get_currently_playing(self, access_token):
+        """ Returns the response of the currently playing track end point """
+        return self.request('currently-playing', 'GET', self.api_url + SPOTIFY_GET_CURRENT_TRACK_PATH,
+                            headers={"Authorization": f"Bearer {access_token}"})
+
+    def request_token(self, data):
+        """ Returns the response of the token end point for the given form data """
+        return self.request('token', 'POST', self.accounts_url + SPOTIFY_ACCESS_TOKEN_PATH, data=data)
+
+    def request(self, endpoint, method, url, **kwargs):
+        """ Send a request, retrying rate limited and failed calls.
+        Timeouts and connection errors are only retried for GET requests,
+        since a POST may already have been processed. Returns the last response,
+        or raises the last requests.RequestException if no response was received """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                if method != 'GET' or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            else:
+                elapsed = time.perf_counter() - start
+                delay = self._retry_delay(response, attempt)
+                if delay is None:
+                    self._record(endpoint, elapsed,
+                                 error=response.status_code >= 400)
+                    return response
+                self._record(endpoint, elapsed, error=True)
+                response.close()
+            attempt += 1
+            self._record_retry(endpoint)
+            time.sleep(delay)
+
+    def _retry_delay(self, response, attempt):
+        """ Returns how long to wait before retrying the response, None if it should not be retried """
+        if attempt >= self.max_retries:
+            return None
+        if response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = self.backoff * 2 ** attempt
+            if delay > self.max_retry_after:
+                return None
+            return delay
+        if response.status_code >= 500 and response.request.method == 'GET':
+            return self.backoff * 2 ** attempt
+        return None
+
+    def _record(self, endpoint, seconds, error=False):
+        """ Add one call to the latency counters of an end point, and to the Spotify time of the current request """
+        record_time('spotify', seconds)
+        with self._stats_lock:
+            stats = self.stats.setdefault(
+                endpoint, {'count': 0, 'errors': 0, 'retries': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            if error:
+                stats['errors'] += 1
+
+    def _record_retry(self, endpoint):
+        """ Count a retry of an end point """
+        with self._stats_lock:
+            self.stats[endpoint]['retries'] += 1
+
+    def get_stats(self):
+        """ Returns a copy of the per end point counters, including the average latency """
+        with self._stats_lock:
+            stats = {endpoint: dict(values)
+                     for endpoint, values in self.stats.items()}
+        for values in stats.values():
+            values['average_seconds'] = values['total_seconds'] / values['count']
+        return stats
+
+    def close(self):
+        """ Close the pooled connections """
+        self.session.close()
+
+
+class AsyncSpotifyClient(SpotifyClient):
+    """ SpotifyClient for the ASGI app: the same calls, retries and counters,
+    sent with httpx so waiting on Spotify does not block the event loop.
+    The call methods are coroutines """
+
+    def _make_session(self, pool_size):
+        connect_timeout, read_timeout = self.timeout
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+    async def get_current_user(self, access_token):
+        """ Returns the response of the user account information end point """
+        return await self.request('profile', 'GET', self.api_url + SPOTIFY_GET_USER_PROFILE_PATH,
+                                  headers={"Authorization": f"Bearer {access_token}"})
+
+    async def get_currently_playing(self, access_token):
+        """ Returns the response of the currently playing track end point """
+        return await self.request('currently-playing', 'GET', self.api_url + SPOTIFY_GET_CURRENT_TRACK_PATH,
+                                  headers={"Authorization": f"Bearer {access_token}"})
+
+    async def request_token(self, data):
+        """ Returns the response of the token end point for the given form data """
+        return await self.request('token', 'POST', self.accounts_url + SPOTIFY_ACCESS_TOKEN_PATH, data=data)
+
+    async def request(self, endpoint, method, url, **kwargs):
+        """ Send a request like SpotifyClient.request, raises the last httpx.TransportError
+        if no response was received """
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = await self.session.request(method, url, **kwargs)
+            except httpx.TransportError:
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                if method != 'GET' or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+            else:
+                elapsed = time.perf_counter() - start
+                delay = self._retry_delay(response, attempt)
+                if delay is None:
+                    self._record(endpoint, elapsed,
+                                 error=response.status_code >= 400)
+                    return response
+                self._record(endpoint, elapsed, error=True)
+                await response.aclose()
+            attempt += 1
+            self._record_retry(endpoint)
+            await asyncio.sleep(delay)
+
+    async def close(self):
+        """ Close the pooled connections """
+        await self.session.aclose()
+
+
+def parse_current_track(json_resp):
+    """ Returns the track info the backend uses from a currently playing response,
+    None if no track is playing (e.g. an ad or a podcast episode) """
+    if not json_resp.get('item'):
+        return None
+
+    track_id = json_resp['item']['id']
+    track_name = json_resp['item']['name']
+    artists = list(json_resp['item']['artists'])
+    image_url = json_resp['item']['album']['images'][0]['url']
+
+    link = json_resp['item']['external_urls']['spotify']
+
+    artist_names = ', '.join([artist['name'] for artist in artists])
+
+    preview_url = json_resp['item']['preview_url']
+
+    current_track_info = {
+        "id": track_id,
+        "track_name": track_name,
+        "artists": artist_names,
+        "link": link,
+        "image_url": image_url,
+        "preview_url": preview_url
+    }
+
+    return current_track_info
+
+
+def get_spotify_client():
+    """ Returns the process-wide SpotifyClient, creating it on first use.
+    Like the MongoClient, a client inherited from a parent process is not reused after a fork """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = SpotifyClient()
+                _client_pid = pid
+    return _client
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+import httpx
+import pytest
+import asgi
+import backend
+import current_track_cache
+import database_manager
+import memory_storage
+import metrics
+import response_cache
+import spotify_client
+import token_manager
+from async_database import AsyncStorage, get_executor
+from database_manager import User, Song, Reaction
+
+test_email = 'testuser@spottem.com'
+test_friend_email = 'testfriend@spottem.com'
+
+test_track = {
+    "is_playing": True,
+    "item": {
+        "id": "song-id",
+        "name": "Song",
+        "artists": [{"name": "Artist"}],
+        "album": {"images": [{"url": "image url"}]},
+        "external_urls": {"spotify": "song url"},
+        "preview_url": "preview url"
+    }
+}
+
+
+@pytest.fixture
+def storage(monkeypatch, stub):
+    monkeypatch.setattr(database_manager, 'STORAGE_BACKEND', 'memory')
+    monkeypatch.setattr(memory_storage, '_database', memory_storage.MemoryDatabase())
+    url = f'http://127.0.0.1:{stub.server_address[1]}'
+    monkeypatch.setattr(spotify_client, '_client', spotify_client.SpotifyClient(
+        api_url=url, accounts_url=url))
+    monkeypatch.setattr(spotify_client, '_client_pid', spotify_client.os.getpid())
+    monkeypatch.setattr(token_manager, '_manager', None)
+    monkeypatch.setattr(current_track_cache, '_cache', None)
+    monkeypatch.setattr(asgi, '_spotify', None)
+    response_cache._versions.clear()
+    response_cache.response_bodies.clear()
+    storage = memory_storage.get_memory_database()
+    storage.create_user(User('Test User', 1, test_email, None))
+    storage.create_user(User('Test Friend', 2, test_friend_email, None))
+    storage.insert_friend_to_user(test_email, test_friend_email)
+    storage.create_song_history(Song(test_friend_email, 'song-id', 'Song', 'Artist', 'Album',
+                                     'song url', 'image url', 'preview url'))
+    storage.save_token(test_email, {"access_token": 'token', "refresh_token": None,
+                                    "expires_at": time.time() + 3600, "scope": None})
+    return storage
+
+
+def request_all(*requests):
+    """ Returns the responses of the (method, path, kwargs) requests, made concurrently to asgi.app """
+    async def run():
+        async with httpx.AsyncClient(app=asgi.app, base_url='http://test') as client:
+            responses = await asyncio.gather(*[client.request(method, path, **kwargs)
+                                               for method, path, kwargs in requests])
+        await asgi.shutdown()
+        return responses
+    return asyncio.run(run())
+
+# ASYNC END POINT TESTS
+
+
+def test_async_responses_match_flask(storage):
+    paths = [f'/user/{test_email}', f'/user/friends/{test_email}?songs_per_friend=1',
+             f'/user/friends/{test_email}?summary_only=1', f'/songs/{test_friend_email}', '/reactions',
+             '/user/unknown@spottem.com']
+    responses = request_all(*[('GET', path, {}) for path in paths])
+    flask = backend.app.test_client()
+    for path, response in zip(paths, responses):
+        expected = flask.get(path)
+        assert response.status_code == expected.status_code, path
+        assert response.json() == expected.get_json(), path
+        assert response.headers.get('etag') == expected.headers.get('etag'), path
+
+
+def test_reactions_summary(storage):
+    storage.create_reaction(Reaction(test_friend_email, 'Test Friend', test_email, 'Test User', 'song-id', 'Song',
+                                     'Artist', 'Album', 'song url', 'image url', 'preview url', 'time stamp'))
+    by_email, by_song, missing = request_all(
+        ('GET', f'/reactions/summary?email={test_friend_email}', {}),
+        ('GET', '/reactions/summary?song_id=song-id&song_id=other', {}),
+        ('GET', '/reactions/summary', {}))
+    assert by_email.json() == {'summary': {'song-id': 1}}
+    assert by_song.json() == {'summary': {'song-id': 1, 'other': 0}}
+    assert missing.status_code == 400
+    friends, = request_all(('GET', f'/user/friends/{test_email}?summary_only=true', {}))
+    assert friends.json()['friends'][0]['song_history'][0]['reaction_count'] == 1
+
+
+def test_matching_etag_gets_not_modified(storage):
+    response, = request_all(('GET', f'/user/{test_email}', {}))
+    not_modified, = request_all(('GET', f'/user/{test_email}',
+                                 {'headers': {'If-None-Match': response.headers['etag']}}))
+    assert not_modified.status_code == 304
+    assert not_modified.content == b''
+
+
+def test_other_requests_are_served_by_flask(storage):
+    page, stats, created = request_all(
+        ('GET', '/reactions?limit=10', {}),
+        ('GET', '/current-track/stats', {}),
+        ('POST', f'/songs/{test_email}', {'json': {"email": test_email, "song_id": 'new-song', "song_name": 'New',
+                                                  "song_artists": 'Artist', "song_url": 'url', "song_image_url": 'image'}}))
+    assert page.json() == {'reactions': [], 'next': None}
+    assert 'hits' in stats.json()
+    assert created.status_code == 201
+    assert storage.song_history_for_user_exists(test_email)
+
+
+def test_concurrent_current_track_polls_share_one_spotify_call(storage, stub):
+    stub.responses.append((200, {}, test_track))
+    responses = request_all(*[('GET', f'/current-track/{test_email}', {})] * 5)
+    assert [response.json()['id'] for response in responses] == ['song-id'] * 5
+    assert [request[:2] for request in stub.requests] == [
+        ('GET', '/me/player/currently-playing')]
+    assert storage.get_user(test_email)['current_track']['song_id'] == 'song-id'
+
+
+def test_nothing_playing_is_no_content(storage, stub):
+    stub.responses.append((204, {}, {}))
+    response, = request_all(('GET', f'/current-track/{test_email}', {}))
+    assert response.status_code == 204
+    assert storage.get_user(test_email)['current_track'] is None
+
+
+def test_unknown_current_track_keeps_the_stored_one(storage, stub):
+    song = Song(test_friend_email, 'song-id', 'Song', 'Artist', 'Album', 'song url', 'image url', 'preview url')
+    storage.update_current_track(test_friend_email, song)
+    storage.update_current_track(test_email, song)
+    # the friend has no stored token, and Spotify rejects the user's token
+    stub.responses.append((401, {}, {}))
+    no_token, rejected = request_all(('GET', f'/current-track/{test_friend_email}', {}),
+                                     ('GET', f'/current-track/{test_email}', {}))
+    assert no_token.json()['id'] == rejected.json()['id'] == 'song-id'
+    assert storage.get_user(test_friend_email)['current_track']['song_id'] == 'song-id'
+    assert storage.get_user(test_email)['current_track']['song_id'] == 'song-id'
+
+    current_track_cache._cache = None
+    assert backend.app.test_client().get(f'/current-track/{test_friend_email}').get_json()['id'] == 'song-id'
+    assert storage.get_user(test_friend_email)['current_track']['song_id'] == 'song-id'
+
+
+def test_friends_events_are_streamed(storage, monkeypatch):
+    monkeypatch.setattr(backend, 'STREAM_MAX_SECONDS', 0.5)
+    monkeypatch.setattr(backend, 'STREAM_HEARTBEAT_SECONDS', 0.05)
+    song = Song(test_friend_email, 'song-id', 'Song', 'Artist', 'Album', 'song url', 'image url', 'preview url')
+    # written from another thread once the stream is open
+    writer = threading.Timer(0.2, storage.update_current_track, (test_friend_email, song))
+    writer.start()
+    stream, missing = request_all(('GET', f'/stream/friends/{test_email}', {}),
+                                  ('GET', '/stream/friends/unknown@spottem.com', {}))
+    writer.join()
+    assert stream.headers['content-type'].startswith('text/event-stream')
+    assert stream.text.startswith('retry: 3000\n\n: keep-alive\n\n')
+    assert 'event: current_track\ndata: {"email":"testfriend@spottem-com"' in stream.text
+    assert missing.status_code == 404
+    assert backend.get_broker().subscriber_count() == 0
+
+# ASYNC STORAGE TESTS
+
+
+def test_storage_calls_on_the_executor_count_towards_the_request():
+    class Storage:
+        def get_user(self, email):
+            metrics.record_time('db', 0.5)
+            return {'email': email}
+
+    async def run():
+        timer = metrics.start_request(sample_stacks=False)
+        user = await AsyncStorage(Storage(), get_executor()).get_user(test_email)
+        metrics.finish_request('/test')
+        return user, timer
+    user, timer = asyncio.run(run())
+    assert user == {'email': test_email}
+    assert timer.seconds['db'] == 0.5
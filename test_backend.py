@@ -0,0 +1,119 @@
+import json
+import threading
+import pytest
+import backend
+import current_track_cache
+import database_manager
+import memory_storage
+import response_cache
+from database_manager import User, Song, get_converted_email
+from memory_storage import MemoryDatabase
+
+test_email = 'testuser@spottem.com'
+converted_test_email = get_converted_email(test_email)
+friend_email = 'testfriend@spottem.com'
+
+
+def make_song(song_id, email=test_email):
+    return Song(email, song_id, 'Test Song', 'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = MemoryDatabase()
+    monkeypatch.setattr(database_manager, 'STORAGE_BACKEND', 'memory')
+    monkeypatch.setattr(memory_storage, '_database', db)
+    monkeypatch.setattr(current_track_cache, '_cache', None)
+    response_cache._versions.clear()
+    response_cache.response_bodies.clear()
+    db.create_user(User('Test User', 0, test_email, None))
+    db.create_user(User('Test Friend', 1, friend_email, None))
+    return db
+
+
+@pytest.fixture
+def client(db):
+    return backend.app.test_client()
+
+
+def read_event_stream(response):
+    """ Returns the retry delay and the (event, data) pairs of a finished text/event-stream response,
+    as a browser's EventSource would read them """
+    retry, events = None, []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.splitlines() if not line.startswith(':'))
+        if 'retry' in fields:
+            retry = int(fields['retry'])
+        if 'data' in fields:
+            events.append((fields.get('event', 'message'), json.loads(fields['data'])))
+    return retry, events
+
+# USER END POINT TESTS
+
+
+def test_malformed_user_profile_is_a_bad_request(client, db):
+    response = client.post('/user/new@spottem.com', json={"id": 'new', "email": 'new@spottem.com', "images": ['x']})
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "invalid fields: images"}
+    assert db.get_user('new@spottem.com') is None
+
+# BATCH END POINT TESTS
+
+
+def test_users_batch(client):
+    response = client.post('/users:batch?fields=current_track', json={"emails": [test_email, 'nobody@spottem.com']})
+    assert response.get_json() == {'users': {test_email: {
+        'email': converted_test_email, 'current_track': None}, 'nobody@spottem.com': None}}
+    for body in ({"emails": [test_email], "fields": 5}, {"emails": [test_email], "fields": [1]},
+                 {"emails": [test_email], "fields": ['$where']}, {"emails": test_email}, [test_email]):
+        assert client.post('/users:batch', json=body).status_code == 400, body
+
+# FRIEND END POINT TESTS
+
+
+def test_friends_of_an_unknown_user_are_not_added(client, db):
+    response = client.post('/user/friends/ghost@spottem.com', json={
+        "email": 'ghost@spottem.com', "friend_emails": [friend_email], "mutual": True})
+    assert response.status_code == 404
+    assert db.get_all_user_friends(friend_email) == []
+
+# CURRENT TRACK END POINT TESTS
+
+
+def test_posted_current_track_replaces_the_cached_one(client, monkeypatch):
+    monkeypatch.setattr(backend, 'CURRENT_TRACK_SOURCE', 'database')
+    for song_id in ('s1', 's2'):
+        posted = client.post(f'/current-track/{test_email}', json={
+            "song_id": song_id, "song_name": 'Song', "song_artists": 'Artist', "song_url": 'url',
+            "song_image_url": 'image'})
+        assert posted.status_code == 201
+        assert client.get(f'/current-track/{test_email}').get_json()['id'] == song_id
+
+# PAGINATED END POINT TESTS
+
+
+def test_invalid_cursor_is_a_bad_request(client, db):
+    db.create_song_history(make_song('song0'))
+    for path in (f'/songs/{test_email}?format=ndjson&after=zzz', f'/songs/{test_email}?after=zzz',
+                 '/reactions?format=ndjson&after=zzz'):
+        response = client.get(path)
+        assert response.status_code == 400, path
+        assert response.get_json() == {"error": "invalid cursor"}
+
+# EVENT STREAM END POINT TESTS
+
+
+def test_streams_above_the_limit_end_with_a_resync_and_a_retry_delay(client, monkeypatch):
+    monkeypatch.setattr(backend, 'stream_slots', threading.BoundedSemaphore(1))
+    stream = client.get(f'/stream/friends/{test_email}')
+    assert stream.status_code == 200
+    # an EventSource only reconnects after a 200 text/event-stream response that ends
+    busy = client.get(f'/stream/friends/{test_email}')
+    assert busy.status_code == 200
+    assert busy.mimetype == 'text/event-stream'
+    assert read_event_stream(busy) == (backend.STREAM_BUSY_RETRY_MS, [('resync', {})])
+    stream.close()
+    reopened = client.get(f'/stream/friends/{test_email}')
+    assert reopened.status_code == 200
+    reopened.close()
+    assert backend.get_broker().subscriber_count() == 0
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import time
+import pytest
+from current_track_cache import CurrentTrackCache
+
+test_email = 'testuser@spottem-com'
+
+
+@pytest.fixture
+def cache(clock):
+    return CurrentTrackCache(ttl=5, clock=clock)
+
+# CACHE TESTS
+
+
+def test_value_is_cached_until_ttl(cache, clock):
+    calls = []
+    def loader(): return calls.append(1) or len(calls)
+    assert cache.get(test_email, loader) == 1
+    clock.now += 4
+    assert cache.get(test_email, loader) == 1
+    clock.now += 1
+    assert cache.get(test_email, loader) == 2
+    assert cache.get_stats()['hits'] == 1
+    assert cache.get_stats()['misses'] == 2
+
+
+def test_expired_entries_are_dropped(cache, clock):
+    cache.get('other@spottem-com', lambda: 'other song')
+    cache.get(test_email, lambda: 'song')
+    clock.now += 5
+    cache.get(test_email, lambda: 'new song')
+    assert cache.get_stats()['cached_users'] == 1
+
+
+def test_concurrent_gets_are_coalesced(cache):
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return 'song'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(test_email, loader)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    while cache.get_stats()['coalesced'] < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == ['song'] * 5
+    assert len(calls) == 1
+
+
+def test_loader_error_is_not_cached(cache):
+    def failing_loader(): raise RuntimeError('spotify down')
+    with pytest.raises(RuntimeError):
+        cache.get(test_email, failing_loader)
+    assert cache.get(test_email, lambda: 'song') == 'song'
+
+
+def test_concurrent_async_gets_are_coalesced(cache):
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'song'
+
+    async def poll():
+        return await asyncio.gather(*[cache.get_async(test_email, loader) for _ in range(5)])
+    assert asyncio.run(poll()) == ['song'] * 5
+    assert asyncio.run(poll()) == ['song'] * 5
+    assert len(calls) == 1
+    assert cache.get_stats()['coalesced'] == 4
+    assert cache.get_stats()['hits'] == 5
+
+
+def test_async_loader_error_reaches_every_waiter(cache):
+    async def loader():
+        await asyncio.sleep(0.01)
+        raise ValueError('spotify down')
+
+    async def poll():
+        return await asyncio.gather(*[cache.get_async(test_email, loader) for _ in range(3)],
+                                    return_exceptions=True)
+    results = asyncio.run(poll())
+    assert all(isinstance(result, ValueError) for result in results)
+    assert cache.get_stats()['cached_users'] == 0
@@ -1,5 +1,7 @@
 import pytest
-from database_manager import User, Song, Reaction, Database, get_converted_email, get_original_email
+import metrics
+from database_manager import User, Song, Reaction, Database, ValidationError, get_converted_email, get_original_email, ROUND_TRIPS
+from indexes import ensure_indexes
 
 test_email = 'testuser@spottem.com'
 converted_test_email = get_converted_email(test_email)
@@ -49,6 +51,13 @@ def test_update_current_track2():
     assert user['current_track']['song_id'] == 'abc456'
 
 
+def test_update_current_track_unchanged():
+    song = Song(test_email, 'abc456', 'Test Song', 'Test Artist',
+                'Test Album', 'http://testurl.com', None, None)
+    changed = Database().update_current_track(converted_test_email, song)
+    assert changed == False
+
+
 def test_update_current_track3():
     Database().update_current_track(converted_test_email, None)
     user = Database().get_user(converted_test_email)
@@ -77,6 +86,20 @@ def test_delete_friend():
     assert len(friends) == 0
 
 
+def test_add_friends():
+    friend_email = 'mutualfriend@spottem.com'
+    Database().create_user(User('Mutual Friend', 2, friend_email, None))
+    added = Database().add_friends(
+        converted_test_email, [friend_email, 'nobody@spottem.com'], mutual=True)
+    assert added == [friend_email]
+    assert friend_email in Database().get_all_user_friends(converted_test_email)
+    assert test_email in Database().get_all_user_friends(friend_email)
+    assert Database().add_friends('ghost@spottem.com', [friend_email], mutual=True) is None
+    assert 'ghost@spottem.com' not in Database().get_all_user_friends(friend_email)
+    Database().delete_friend(converted_test_email, friend_email)
+    Database().delete_user(friend_email)
+
+
 def test_delete_user():
     Database().delete_user(test_email)
     isExist = Database().user_exists(converted_test_email)
@@ -98,6 +121,28 @@ def test_get_all_song_history():
     assert song_history[0]['song_name'] == 'Test Song'
 
 
+def test_create_song_history_duplicate():
+    song_history = Song(test_email, 'abc123', 'Test Song',
+                        'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+    assert Database().create_song_history(song_history) == False
+
+
+def test_create_song_histories():
+    song_histories = [Song(test_email, song_id, 'Test Song', 'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+                      for song_id in ['abc123', 'bulk1', 'bulk2', 'bulk2']]
+    created = Database().create_song_histories(song_histories)
+    assert created == 2
+    assert len(Database().get_all_song_history_from_user(converted_test_email)) == 3
+
+
+def test_iter_song_history_pages():
+    first_page = list(Database().iter_song_history_from_user(converted_test_email, limit=2))
+    assert [song['song_id'] for song in first_page] == ['abc123', 'bulk1']
+    second_page = list(Database().iter_song_history_from_user(
+        converted_test_email, after=first_page[-1]['_id'], limit=2))
+    assert [song['song_id'] for song in second_page] == ['bulk2']
+
+
 def test_delete_all_song_history():
     Database().delete_all_song_history_for_user(converted_test_email)
     isExist = Database().song_history_for_user_exists(converted_test_email)
@@ -120,7 +165,8 @@ def test_create_reaction():
 def test_create_reaction2():
     reaction = Reaction(converted_test_email, 'name', sender_email, 'sender name', 'song123',
                         'song name', 'song artists', 'song album', 'song url', 'song image url', 'time stamp')
-    Database().create_reaction(reaction)
+    created = Database().create_reaction(reaction)
+    assert created == False
     reactions = Database().get_all_reactions()
     count = 0
     for r in reactions:
@@ -143,7 +189,231 @@ def test_get_all_reactions():
     assert isExist == True
 
 
+def test_reaction_counts():
+    assert Database().get_reaction_counts(converted_test_email) == {'song123': 1}
+    counts = Database().get_song_reaction_counts(['song123', 'no-reactions'])
+    assert counts['song123'] >= 1
+    assert counts['no-reactions'] == 0
+
+
 def test_delete_reaction():
     Database().delete_reaction(converted_test_email, 'song123')
     isExist = Database().reaction_exists(converted_test_email, 'song123')
     assert isExist == False
+    assert Database().get_reaction_counts(converted_test_email) == {}
+
+# CONNECTION POOL TESTS
+
+
+def test_database_instances_share_client():
+    assert Database().cluster is Database().cluster
+
+# COMPLETE USER TESTS
+
+
+def test_get_complete_user():
+    Database().create_user(User('Test User', 0, test_email, None))
+    Database().create_song_history(Song(test_email, 'song456', 'Test Song', 'Test Artist',
+                                        'Test Album', 'http://testurl.com', None, None))
+    Database().create_reaction(Reaction(converted_test_email, 'name', sender_email, 'sender name', 'song456',
+                                        'song name', 'song artists', 'song album', 'song url', 'song image url', None, 'time stamp'))
+    user = Database().get_complete_user(converted_test_email)
+    assert isinstance(user['_id'], str)
+    assert user['song_history'][0]['song_id'] == 'song456'
+    assert user['song_history'][0]['reactions'][0]['sender_email'] == sender_email
+    summary = Database().get_complete_user(converted_test_email, summary_only=True)
+    assert summary['song_history'][0]['reaction_count'] == 1
+    assert 'reactions' not in summary['song_history'][0]
+    Database().delete_reaction(converted_test_email, 'song456')
+    Database().delete_all_song_history_for_user(test_email)
+    Database().delete_user(test_email)
+
+
+def test_get_complete_user_not_found():
+    assert Database().get_complete_user('nobody@spottem.com') is None
+
+
+def test_get_friends_feed():
+    friend_email = 'testfriend@spottem.com'
+    Database().create_user(User('Test User', 0, test_email, None))
+    Database().create_user(User('Test Friend', 1, friend_email, None))
+    # inserted out of song_id order, so index order and insertion order differ
+    for song_id in ('feed2', 'feed0', 'feed1'):
+        Database().create_song_history(Song(friend_email, song_id, 'Test Song', 'Test Artist',
+                                            'Test Album', 'http://testurl.com', None, None))
+    Database().insert_friend_to_user(test_email, friend_email)
+    feed = Database().get_friends_feed(test_email, songs_per_friend=2)
+    assert [friend['email'] for friend in feed] == [get_converted_email(friend_email)]
+    assert [song['song_id'] for song in feed[0]['song_history']] == ['feed0', 'feed1']
+    assert [song['song_id'] for song in Database().get_all_song_history_from_user(friend_email)] == [
+        'feed2', 'feed0', 'feed1']
+    assert Database().get_friends_feed(test_email, limit=0) == []
+    Database().delete_all_song_history_for_user(friend_email)
+    Database().delete_user(friend_email)
+    Database().delete_user(test_email)
+
+# INDEX TESTS
+
+
+def plan_stages(plan):
+    """ Collect every 'stage' name in an explain plan """
+    stages = []
+    if isinstance(plan, dict):
+        for key, value in plan.items():
+            if key == 'stage':
+                stages.append(value)
+            else:
+                stages += plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += plan_stages(value)
+    return stages
+
+
+def test_ensure_indexes_is_idempotent():
+    assert ensure_indexes() == ensure_indexes()
+
+
+@pytest.mark.parametrize('collection, query', [
+    ('user', {'email': converted_test_email}),
+    ('song_history', {'email': converted_test_email}),
+    ('song_history', {'email': converted_test_email, 'song_id': 'song123'}),
+    ('reactions', {'email': converted_test_email, 'song_id': 'song123'}),
+    ('reactions', {'email': converted_test_email, 'song_id': 'song123', 'sender_email': sender_email}),
+    ('reactions', {'sender_email': sender_email, 'song_id': 'song123'}),
+])
+def test_hot_queries_use_index(collection, query):
+    ensure_indexes()
+    plan = Database().db[collection].find(query).explain()['queryPlanner']
+    stages = plan_stages(plan)
+    assert 'IXSCAN' in stages
+    assert 'COLLSCAN' not in stages
+
+# PROFILE VIEW TESTS
+
+
+def test_rebuild_profile_views():
+    Database().create_user(User('Test User', 0, test_email, None))
+    Database().create_song_history(Song(test_email, 'view123', 'Test Song', 'Test Artist',
+                                        'Test Album', 'http://testurl.com', None, None))
+    Database().rebuild_profile_views()
+    view = Database().profile_view_coll.find_one({'email': converted_test_email})
+    assert view == Database().get_complete_user(converted_test_email)
+    Database().delete_all_song_history_for_user(test_email)
+    Database().delete_user(test_email)
+
+# RESOURCE VERSION TESTS
+
+
+def test_writes_bump_user_version():
+    key = 'user:' + converted_test_email
+    before = Database().get_versions([key]).get(key, 0)
+    Database().create_user(User('Test User', 0, test_email, None))
+    Database().create_song_history(Song(test_email, 'version123', 'Test Song', 'Test Artist',
+                                        'Test Album', 'http://testurl.com', None, None))
+    assert Database().get_versions([key])[key] == before + 2
+    Database().delete_all_song_history_for_user(test_email)
+    Database().delete_user(test_email)
+    assert Database().get_versions([key])[key] == before + 4
+
+
+def commands_sent(call):
+    """ Returns the number of MongoDB commands call() sends, counted by the CommandListener """
+    timer = metrics.start_request(sample_stacks=False)
+    try:
+        call()
+    finally:
+        metrics.finish_request('test')
+    return timer.db_commands
+
+
+def test_methods_stay_within_round_trip_budgets():
+    db = Database()
+    friend_email = 'testfriend@spottem.com'
+    song = Song(test_email, 'budget123', 'Test Song', 'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+    next_song = Song(test_email, 'budget456', 'Test Song', 'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+    reaction = Reaction(converted_test_email, 'name', sender_email, 'sender name', 'budget123',
+                        'song name', 'song artists', 'song album', 'song url', 'song image url', 'time stamp')
+    calls = [
+        ('create_user', lambda: db.create_user(User('Test User', 0, test_email, None))),
+        ('create_user', lambda: db.create_user(User('Test Friend', 1, friend_email, None))),
+        ('insert_friend_to_user', lambda: db.insert_friend_to_user(test_email, friend_email)),
+        ('update_current_track', lambda: db.update_current_track(test_email, song)),
+        # moves budget123 to the history
+        ('update_current_track', lambda: db.update_current_track(test_email, next_song)),
+        ('create_reaction', lambda: db.create_reaction(reaction)),
+        ('get_complete_user', lambda: db.get_complete_user(test_email)),
+        ('get_friends_feed', lambda: db.get_friends_feed(test_email)),
+        ('delete_reaction', lambda: db.delete_reaction(test_email, 'budget123')),
+        ('delete_friend', lambda: db.delete_friend(test_email, friend_email)),
+        ('delete_all_song_history_for_user', lambda: db.delete_all_song_history_for_user(test_email)),
+        ('delete_user', lambda: db.delete_user(friend_email)),
+        ('delete_user', lambda: db.delete_user(test_email)),
+    ]
+    for name, call in calls:
+        assert commands_sent(call) <= ROUND_TRIPS[name], name
+        if name == 'update_current_track':
+            # the song already playing is a single read-only round trip
+            assert commands_sent(call) == 1
+
+# BATCH TESTS
+
+
+def test_get_complete_users():
+    Database().create_user(User('Test User', 0, test_email, None))
+    users = Database().get_complete_users(
+        [test_email, 'nobody@spottem.com'], ['current_track'])
+    assert list(users) == [converted_test_email]
+    assert users[converted_test_email] == {
+        'email': converted_test_email, 'current_track': None}
+    with pytest.raises(ValueError):
+        Database().get_complete_users([test_email], ['$where'])
+    Database().delete_user(test_email)
+
+# PROJECTION TESTS
+
+
+def test_read_methods_accept_projection():
+    Database().create_user(User('Test User', 0, test_email, None))
+    Database().create_song_history(Song(test_email, 'projection123', 'Test Song', 'Test Artist',
+                                        'Test Album', 'http://testurl.com', None, None))
+    assert Database().get_user(test_email, {"_id": 0, "name": 1}) == {
+        'name': 'Test User'}
+    assert Database().get_all_song_history_from_user(test_email, {"_id": 0, "song_id": 1}) == [
+        {'song_id': 'projection123'}]
+    page = list(Database().iter_song_history_from_user(
+        test_email, projection={"_id": 0, "song_id": 1}))
+    assert set(page[0]) == {'_id', 'song_id'}
+    assert Database().get_all_user_friends('nobody@spottem.com') == []
+    Database().delete_all_song_history_for_user(test_email)
+    Database().delete_user(test_email)
+
+# MODEL TESTS
+
+
+def test_model_document_round_trip():
+    song = Song(test_email, 'song123', 'Test Song', 'Test Artist',
+                'Test Album', 'http://testurl.com', None, None)
+    document = dict(song.to_document(), _id='5f8f8c44b54764421b7156c9')
+    assert Song.from_document(document) == song
+    assert not hasattr(song, '__dict__')
+
+
+def test_payload_validation():
+    payload = {'song_id': 'song123', 'song_name': 'Test Song', 'song_artists': 'Test Artist',
+               'song_url': 'http://testurl.com', 'song_image_url': 'http://testurl.com'}
+    song = Song.from_payload(test_email, payload)
+    assert song.email == converted_test_email
+    assert song.album == '' and song.preview_url is None
+    with pytest.raises(ValidationError, match='missing fields: song_id'):
+        Song.from_payload(test_email, {field: value for field, value in payload.items()
+                                       if field != 'song_id'})
+    with pytest.raises(ValidationError, match='invalid fields: song_name'):
+        Song.from_payload(test_email, dict(payload, song_name=1))
+    with pytest.raises(ValidationError):
+        Song.from_payload(test_email, ['not', 'an', 'object'])
+    profile = {'id': 'user123', 'email': test_email, 'images': [{'url': 'http://testurl.com'}]}
+    assert User.from_payload(profile).user_dp == 'http://testurl.com'
+    for images in (['x'], [{'url': 1}]):
+        with pytest.raises(ValidationError, match='invalid fields: images'):
+            User.from_payload(dict(profile, images=images))
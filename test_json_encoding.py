@@ -0,0 +1,29 @@
+import datetime
+import json
+from bson import ObjectId
+from flask import Flask, jsonify
+import json_encoding
+from json_encoding import MongoJSONEncoder, dumps
+
+object_id = ObjectId('5f8f8c44b54764421b7156c9')
+
+
+def test_dumps_converts_mongo_types():
+    document = {'_id': object_id, 'time': datetime.datetime(2021, 11, 1, 12, 30),
+                'nested': [{'_id': object_id}]}
+    assert json.loads(dumps(document)) == {
+        '_id': str(object_id), 'time': '2021-11-01T12:30:00', 'nested': [{'_id': str(object_id)}]}
+
+
+def test_dumps_without_orjson(monkeypatch):
+    monkeypatch.setattr(json_encoding, 'orjson', None)
+    assert dumps({'b': object_id, 'a': 1}, sort_keys=True) == \
+        '{"a":1,"b":"5f8f8c44b54764421b7156c9"}'
+
+
+def test_jsonify_uses_mongo_encoder():
+    app = Flask(__name__)
+    app.json_encoder = MongoJSONEncoder
+    with app.app_context():
+        response = jsonify({'_id': object_id, 'name': 'Test User'})
+    assert response.get_json() == {'_id': str(object_id), 'name': 'Test User'}
@@ -0,0 +1,57 @@
+import pytest
+import asgi
+import async_database
+import backend
+import current_track_cache
+import spotify_client
+import token_manager
+import load_test
+from database_manager import ROUND_TRIPS
+from memory_storage import MemoryDatabase
+
+
+@pytest.fixture
+def emails(monkeypatch):
+    # bench and use_spotify_stub replace these process-wide objects, restore them afterwards
+    for module, name in ((backend, 'get_database'), (async_database, 'get_database'), (token_manager, 'get_database'),
+                         (token_manager, '_manager'), (spotify_client, '_client'), (spotify_client, '_client_pid'),
+                         (current_track_cache, '_cache'), (asgi, '_spotify')):
+        monkeypatch.setattr(module, name, getattr(module, name))
+    storage = MemoryDatabase()
+    emails = load_test.seed(storage, users=20, friends=5, songs=10, reactions=2)
+    stub = load_test.start_spotify_stub()
+    load_test.use_spotify_stub(stub)
+    yield storage, emails
+    stub.shutdown()
+    stub.server_close()
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_endpoints_stay_within_round_trip_budgets(emails, mode):
+    storage, emails = emails
+    results = load_test.bench(emails, requests_per_endpoint=40, storage=storage, mode=mode)
+    for endpoint, budget in load_test.ROUND_TRIP_BUDGETS.items():
+        assert results[endpoint]['requests'] == 40
+        assert results[endpoint]['round_trips_max'] <= budget, endpoint
+
+
+@pytest.mark.parametrize('mode', ['sync', 'async'])
+def test_current_track_comes_from_spotify_stub(emails, mode):
+    storage, emails = emails
+    load_test.bench(emails[:1], requests_per_endpoint=1, storage=storage, mode=mode)
+    assert storage.get_user(emails[0])['current_track']['song_id'] == 'load-song'
+
+
+def test_storage_calls_count_as_their_mongodb_commands():
+    storage = load_test.StorageCallCounter(MemoryDatabase())
+    storage.user_exists('nobody@spottem.com')
+    storage.update_current_track('nobody@spottem.com', None)
+    assert storage.count == ROUND_TRIPS['user_exists'] + ROUND_TRIPS['update_current_track'] == 4
+
+
+def test_summarize():
+    summary = load_test.summarize([0.001 * i for i in range(1, 101)], 2, [1, 3])
+    assert summary['p50_ms'] == pytest.approx(51)
+    assert summary['p99_ms'] == pytest.approx(100)
+    assert summary['requests_per_second'] == 50
+    assert summary['round_trips_max'] == 3
@@ -0,0 +1,163 @@
+import inspect
+import pytest
+import database_manager
+import memory_storage
+from database_manager import User, Song, Reaction, Database, get_converted_email
+from memory_storage import MemoryDatabase
+
+test_email = 'testuser@spottem.com'
+converted_test_email = get_converted_email(test_email)
+friend_email = 'testfriend@spottem.com'
+sender_email = get_converted_email('somerandom@gmail.com')
+
+
+def make_song(song_id, email=test_email):
+    return Song(email, song_id, 'Test Song', 'Test Artist', 'Test Album', 'http://testurl.com', None, None)
+
+
+def make_reaction(song_id, sender=sender_email):
+    return Reaction(test_email, 'Test User', sender, 'Sender', song_id, 'Test Song', 'Test Artist',
+                    'Test Album', 'http://testurl.com', None, None, '11/27/2021')
+
+
+@pytest.fixture
+def db():
+    db = MemoryDatabase()
+    db.create_user(User('Test User', 0, test_email, None))
+    db.create_user(User('Test Friend', 1, friend_email, None))
+    return db
+
+# INTERFACE TESTS
+
+
+def public_methods(cls):
+    return {name: inspect.signature(method) for name, method in inspect.getmembers(cls, inspect.isfunction)
+            if not name.startswith('_')}
+
+
+def test_implements_database_interface():
+    database_methods = public_methods(Database)
+    memory_methods = public_methods(MemoryDatabase)
+    assert set(database_methods) <= set(memory_methods)
+    for name, signature in database_methods.items():
+        assert list(memory_methods[name].parameters) == list(
+            signature.parameters), name
+
+
+def test_every_storage_method_has_a_round_trip_budget():
+    assert set(public_methods(Database)) == set(database_manager.ROUND_TRIPS)
+
+
+def test_get_database_selects_backend(monkeypatch):
+    monkeypatch.setattr(database_manager, 'STORAGE_BACKEND', 'memory')
+    assert database_manager.get_database() is memory_storage.get_memory_database()
+
+# USER TESTS
+
+
+def test_users_and_friends(db):
+    assert db.user_exists(test_email)
+    assert db.get_user(test_email, {"_id": 0, "name": 1}) == {
+        'name': 'Test User'}
+    assert db.insert_friend_to_user(test_email, friend_email)
+    assert not db.insert_friend_to_user(test_email, friend_email)
+    assert not db.insert_friend_to_user(test_email, 'nobody@spottem.com')
+    assert db.add_friends(friend_email, [test_email, 'nobody@spottem.com'], mutual=True) == [
+        test_email]
+    assert db.add_friends('ghost@spottem.com', [friend_email], mutual=True) is None
+    assert db.get_all_user_friends(test_email) == [friend_email]
+    assert db.get_all_user_friends(friend_email) == [test_email]
+    assert db.delete_friend(test_email, friend_email)
+    assert db.get_all_user_friends(test_email) == []
+    db.delete_user(test_email)
+    assert db.get_user(test_email) is None
+
+# SONG HISTORY AND REACTION TESTS
+
+
+def test_current_track_moves_to_history(db):
+    assert db.update_current_track(test_email, make_song('song1'))
+    assert not db.update_current_track(test_email, make_song('song1'))
+    assert db.update_current_track(test_email, make_song('song2'))
+    assert [song['song_id'] for song in db.get_all_song_history_from_user(test_email)] == [
+        'song1']
+    assert db.get_user(test_email)['current_track']['song_id'] == 'song2'
+    assert db.update_current_track(test_email, None)
+    assert not db.update_current_track(test_email, None)
+
+
+def test_complete_user_and_friends_feed(db):
+    assert db.create_song_histories(
+        [make_song('song1'), make_song('song2'), make_song('song1')]) == 2
+    assert db.create_reaction(make_reaction('song1'))
+    assert not db.create_reaction(make_reaction('song1'))
+    user = db.get_complete_user(test_email)
+    assert [song['song_id'] for song in user['song_history']] == [
+        'song1', 'song2']
+    assert [reaction['sender_email'] for reaction in user['song_history'][0]['reactions']] == [
+        sender_email]
+    assert db.get_complete_user(test_email, ['current_track']) == {
+        'email': converted_test_email, 'current_track': None}
+    db.insert_friend_to_user(friend_email, test_email)
+    feed = db.get_friends_feed(friend_email, songs_per_friend=1)
+    assert [song['song_id'] for song in feed[0]['song_history']] == ['song2']
+    assert db.get_friends_feed('nobody@spottem.com') is None
+
+
+def test_reaction_indexes(db):
+    db.create_song_history(make_song('song1'))
+    db.create_reaction(make_reaction('song1'))
+    assert db.reaction_exists(test_email, 'song1')
+    assert db.reaction_sender_exists(sender_email, 'song1')
+    assert len(db.get_sender_reactions(sender_email, 'song1')) == 1
+    assert db.delete_sender_reaction(sender_email, 'song1')
+    assert not db.delete_sender_reaction(sender_email, 'song1')
+    assert db.get_reactions(test_email, 'song1') == []
+    assert db.get_complete_user(test_email)['song_history'][0]['reactions'] == []
+
+
+def test_reaction_counters(db):
+    db.create_song_histories([make_song('song1'), make_song('song2')])
+    db.create_reaction(make_reaction('song1'))
+    db.create_reaction(make_reaction('song1', sender=get_converted_email(friend_email)))
+    db.create_reaction(make_reaction('song1'))
+    assert db.get_reaction_counts(test_email) == {'song1': 2}
+    assert db.get_song_reaction_counts(['song1', 'song2']) == {
+        'song1': 2, 'song2': 0}
+    user = db.get_complete_user(test_email, summary_only=True)
+    assert [(song['song_id'], song['reaction_count']) for song in user['song_history']] == [
+        ('song1', 2), ('song2', 0)]
+    assert 'reactions' not in user['song_history'][0]
+    assert db.delete_sender_reaction(sender_email, 'song1')
+    assert db.get_reaction_counts(test_email) == {'song1': 1}
+    db.rebuild_reaction_counts()
+    assert db.get_song_reaction_counts(['song1']) == {'song1': 1}
+    db.insert_friend_to_user(friend_email, test_email)
+    feed = db.get_friends_feed(friend_email, summary_only=True)
+    assert feed[0]['song_history'][0]['reaction_count'] == 1
+
+
+def test_pagination(db):
+    db.create_song_histories([make_song(f'song{i}') for i in range(5)])
+    first = list(db.iter_song_history_from_user(test_email, limit=2))
+    second = list(db.iter_song_history_from_user(
+        test_email, after=first[-1]['_id'], limit=2, projection={"_id": 0, "song_id": 1}))
+    assert [song['song_id'] for song in first + second] == [
+        'song0', 'song1', 'song2', 'song3']
+    assert set(second[0]) == {'_id', 'song_id'}
+
+# VERSION AND TOKEN TESTS
+
+
+def test_versions_and_tokens(db):
+    key = 'user:' + converted_test_email
+    version = db.get_versions([key])[key]
+    db.create_song_history(make_song('song1'))
+    assert db.get_versions([key, 'reactions']) == {key: version + 1}
+    db.save_token(test_email, {'access_token': 'token'})
+    assert db.get_token(test_email) == {'access_token': 'token'}
+    assert db.get_token_emails() == [converted_test_email]
+    db.delete_token(test_email, 'other refresh token')
+    assert db.get_token(test_email) == {'access_token': 'token'}
+    db.delete_token(test_email)
+    assert db.get_token(test_email) is None
@@ -0,0 +1,142 @@
+import sys
+import threading
+import pytest
+import metrics
+from metrics import Histogram, Registry, RequestTimer, CommandListener, SlowRequestProfiler, collapse_stack
+
+
+class CommandEvent:
+    def __init__(self, duration_micros):
+        self.duration_micros = duration_micros
+
+
+@pytest.fixture(autouse=True)
+def no_request():
+    metrics._current.set(None)
+    yield
+    metrics._current.set(None)
+
+# HISTOGRAM TESTS
+
+
+def test_histogram_counts_are_cumulative():
+    histogram = Histogram((1, 5, 10))
+    for value in (0.5, 1, 3, 7, 20):
+        histogram.observe(value)
+    assert histogram.cumulative_counts() == [(1, 2), (5, 3), (10, 4)]
+    assert histogram.count == 5
+    assert histogram.sum == 31.5
+
+# REQUEST TIMER TESTS
+
+
+def test_commands_are_attributed_to_the_request_on_their_thread():
+    listener = CommandListener()
+    timer = metrics.start_request()
+    listener.succeeded(CommandEvent(2000))
+    listener.failed(CommandEvent(500))
+
+    other = []
+    thread = threading.Thread(target=lambda: (
+        listener.succeeded(CommandEvent(9000)), other.append(metrics.current_timer())))
+    thread.start()
+    thread.join()
+
+    assert timer.db_commands == 2
+    assert timer.seconds['db'] == pytest.approx(0.0025)
+    assert other == [None]
+
+
+def test_record_time_outside_of_requests_is_ignored():
+    metrics.record_time('spotify', 1)
+    timer = metrics.start_request()
+    metrics.record_time('spotify', 0.25)
+    metrics.record_time('serialize', 0.01)
+    assert metrics.finish_request('/route') is timer
+    metrics.record_time('spotify', 1)
+    assert timer.seconds == {'spotify': 0.25, 'serialize': 0.01}
+    assert metrics.finish_request('/route') is None
+
+
+def test_server_timing(clock):
+    timer = RequestTimer(clock)
+    timer.db_commands = 3
+    timer.seconds['db'] = 0.004
+    timer.seconds['spotify'] = 0.1
+    clock.now = 0.15
+    assert timer.server_timing() == ('db;dur=4.0;desc="3 commands", spotify;dur=100.0, '
+                                     'serialize;dur=0.0, total;dur=150.0')
+
+# REGISTRY TESTS
+
+
+def test_registry_renders_prometheus_histograms_per_route(clock):
+    registry = Registry()
+    timer = RequestTimer(clock)
+    timer.db_commands = 2
+    clock.now = 0.003
+    registry.observe('/user/<email>', timer)
+    registry.observe('/user/<email>', timer)
+    registry.observe('/reactions', RequestTimer(clock))
+    text = registry.render()
+    assert text.count('# TYPE spottem_request_seconds histogram') == 1
+    assert 'spottem_request_seconds_bucket{route="/user/<email>",le="0.0025"} 0' in text
+    assert 'spottem_request_seconds_bucket{route="/user/<email>",le="0.005"} 2' in text
+    assert 'spottem_request_seconds_count{route="/reactions"} 1' in text
+    assert 'spottem_db_commands_bucket{route="/user/<email>",le="2"} 2' in text
+    assert 'spottem_db_commands_bucket{route="/user/<email>",le="+Inf"} 2' in text
+
+
+def test_workers_sharing_a_directory_render_the_sum_of_all_workers(tmp_path, clock):
+    workers = [Registry(str(tmp_path), flush_interval=1, clock=clock) for _ in range(2)]
+    for registry in workers:
+        registry.observe('/reactions', RequestTimer(clock))
+    # written to the directory only once the flush interval has passed
+    workers[1].observe('/reactions', RequestTimer(clock))
+    assert 'spottem_request_seconds_count{route="/reactions"} 2' in workers[0].render()
+    clock.now += 1
+    workers[1].observe('/reactions', RequestTimer(clock))
+    for registry in workers:
+        assert 'spottem_request_seconds_count{route="/reactions"} 4' in registry.render()
+
+
+def test_use_directory_removes_the_files_of_a_previous_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'registry', Registry())
+    (tmp_path / '1234-old.json').write_text('[["request", "/", [1], 1, 0.5]]')
+    metrics.use_directory(str(tmp_path))
+    assert list(tmp_path.iterdir()) == []
+    assert metrics.registry.render() == '\n'
+
+# PROFILER TESTS
+
+
+def test_collapse_stack_goes_from_the_outside_in():
+    def inner():
+        return collapse_stack(sys._getframe(), depth=2)
+    stack = inner().split(';')
+    assert stack[0].startswith('test_metrics.py:test_collapse_stack_goes_from_the_outside_in:')
+    assert stack[1].startswith('test_metrics.py:inner:')
+
+
+def test_profiler_samples_the_request_threads():
+    profiler = SlowRequestProfiler(interval=0.001)
+    timer = RequestTimer()
+    profiler.add(timer)
+    while not timer.samples:
+        threading.Event().wait(0.001)
+    profiler.remove()
+    assert any('test_profiler_samples_the_request_threads' in stack for stack in timer.samples)
+
+# END POINT TESTS
+
+
+def test_metrics_end_point_and_server_timing_header(monkeypatch):
+    import backend
+    monkeypatch.setattr(metrics, 'SERVER_TIMING', True)
+    client = backend.app.test_client()
+    response = client.get('/')
+    assert response.headers['Server-Timing'].startswith('db;dur=')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert 'spottem_request_seconds_count{route="/"}' in response.get_data(as_text=True)
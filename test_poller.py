@@ -0,0 +1,129 @@
+import pytest
+from poller import CurrentTrackPoller, RateLimiter, POLLER_IDLE_INTERVAL, POLLER_MIN_INTERVAL
+from spotify_client import SpotifyClient
+
+test_email = 'testuser@spottem-com'
+
+currently_playing = {
+    'is_playing': True,
+    'progress_ms': 60000,
+    'item': {
+        'id': 'abc123',
+        'name': 'Test Song',
+        'artists': [{'name': 'Test Artist'}],
+        'album': {'images': [{'url': 'http://testurl.com/image'}]},
+        'external_urls': {'spotify': 'http://testurl.com'},
+        'preview_url': None,
+        'duration_ms': 80000
+    }
+}
+
+
+class PollerDatabase:
+    """ Stand-in for Database with the methods the poller uses """
+
+    def __init__(self):
+        self.current_tracks = {}
+        self.writes = 0
+
+    def get_token_emails(self):
+        return [test_email]
+
+    def update_current_track(self, user_email, song):
+        self.writes += 1
+        self.current_tracks[user_email] = song.song_id if song else None
+
+
+class Tokens:
+    def get_access_token(self, email, before_refresh=None):
+        return 'token'
+
+    def forget(self, email):
+        pass
+
+
+@pytest.fixture
+def poller(stub):
+    url = f'http://127.0.0.1:{stub.server_address[1]}'
+    spotify = SpotifyClient(api_url=url + '/v1', accounts_url=url, max_retries=0)
+    poller = CurrentTrackPoller(PollerDatabase(), Tokens(), spotify, concurrency=2)
+    yield poller
+    poller.executor.shutdown()
+    spotify.close()
+
+# POLLER TESTS
+
+
+def test_playing_track_is_saved_and_polled_after_it_ends(stub, poller):
+    stub.responses.append((200, {}, currently_playing))
+    delay = poller.poll_user(test_email)
+    assert poller.database.current_tracks[test_email] == 'abc123'
+    assert delay == 21
+
+
+def test_every_poll_is_stored(stub, poller):
+    # the database may have been changed by another process in between
+    stub.responses.extend([(200, {}, currently_playing)] * 2)
+    poller.poll_user(test_email)
+    poller.database.current_tracks[test_email] = None
+    poller.poll_user(test_email)
+    assert poller.database.current_tracks[test_email] == 'abc123'
+
+
+def test_idle_user_is_polled_less_often(stub, poller):
+    stub.responses.extend([(204, {}, {})] * 3)
+    delays = [poller.poll_user(test_email) for _ in range(3)]
+    assert poller.database.current_tracks[test_email] is None
+    assert delays[0] < delays[1] < delays[2] <= POLLER_IDLE_INTERVAL
+
+
+def test_rate_limited_user_waits_for_retry_after(stub, poller):
+    stub.responses.append((429, {'Retry-After': '3600'}, {}))
+    assert poller.poll_user(test_email) == 3600
+    assert poller.database.writes == 0
+
+
+def test_run_once_polls_due_users(stub, poller):
+    stub.responses.append((200, {}, currently_playing))
+    poller.run_once()
+    poller.executor.shutdown(wait=True)
+    assert poller.database.current_tracks[test_email] == 'abc123'
+    assert poller.next_poll[test_email] >= poller.clock() + POLLER_MIN_INTERVAL
+
+
+def test_token_refresh_shares_the_rate_budget(stub, poller, monkeypatch):
+    class RefreshingTokens(Tokens):
+        def get_access_token(self, email, before_refresh=None):
+            before_refresh()
+            return 'token'
+    acquired = []
+    monkeypatch.setattr(poller.rate_limiter, 'acquire', lambda: acquired.append(1))
+    poller.token_manager = RefreshingTokens()
+    stub.responses.append((204, {}, {}))
+    poller.poll_user(test_email)
+    assert len(acquired) == 2
+
+
+def test_user_without_a_valid_token_is_dropped(stub, poller):
+    class NoTokens(Tokens):
+        def get_access_token(self, email, before_refresh=None):
+            return None
+    poller.token_manager = NoTokens()
+    poller.run_once()
+    poller.executor.shutdown(wait=True)
+    assert test_email not in poller.next_poll
+    assert stub.requests == []
+
+
+def test_rate_limiter_waits_when_budget_is_spent():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    limiter = RateLimiter(2, clock=lambda: now[0], sleep=sleep)
+    for _ in range(4):
+        limiter.acquire()
+    assert sum(sleeps) == pytest.approx(1)
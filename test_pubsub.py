@@ -0,0 +1,59 @@
+import asyncio
+import threading
+from pubsub import AsyncSubscription, Broker, Subscription
+import backend
+
+friend_email = 'testfriend@spottem-com'
+
+# BROKER TESTS
+
+
+def test_published_event_reaches_subscribers_of_topic():
+    broker = Broker()
+    subscription = broker.subscribe([friend_email])
+    other = broker.subscribe(['someoneelse@spottem-com'])
+    broker.publish(friend_email, 'current_track', {'email': friend_email})
+    assert subscription.get(timeout=0) == ('current_track', {'email': friend_email})
+    assert other.get(timeout=0) is None
+
+
+def test_unsubscribe_stops_delivery():
+    broker = Broker()
+    subscription = broker.subscribe([friend_email])
+    broker.unsubscribe(subscription)
+    broker.publish(friend_email, 'current_track', {})
+    assert subscription.get(timeout=0) is None
+    assert broker.subscriber_count() == 0
+
+
+def test_full_subscription_is_marked_overflowed():
+    subscription = Subscription([friend_email], maxsize=1)
+    subscription.put(('reaction', {}))
+    subscription.put(('reaction', {}))
+    assert subscription.overflowed == True
+
+# SERVER-SENT EVENTS TESTS
+
+
+def test_server_sent_events_format():
+    broker = backend.get_broker()
+    subscription = broker.subscribe([friend_email])
+    broker.publish(friend_email, 'current_track', {'email': friend_email, 'current_track': None})
+    events = backend.server_sent_events(subscription, heartbeat=0.01, max_seconds=0.05)
+    assert next(events) == 'retry: 3000\n\n'
+    assert next(events) == 'event: current_track\ndata: {"email":"testfriend@spottem-com","current_track":null}\n\n'
+    assert next(events) == ': keep-alive\n\n'
+    list(events)
+    assert broker.subscriber_count() == 0
+
+
+def test_async_subscription_receives_events_from_other_threads():
+    async def run():
+        broker = Broker()
+        subscription = broker.subscribe([friend_email], AsyncSubscription)
+        thread = threading.Thread(target=broker.publish, args=(friend_email, 'reaction', {}))
+        thread.start()
+        event = await subscription.get(timeout=1)
+        thread.join()
+        return event, await subscription.get(timeout=0.01)
+    assert asyncio.run(run()) == (('reaction', {}), None)
@@ -0,0 +1,59 @@
+import pytest
+import response_cache
+from response_cache import LRUCache, get_versions, forget_versions, make_etag
+
+test_key = 'user:testuser@spottem-com'
+
+
+@pytest.fixture(autouse=True)
+def reset_versions():
+    response_cache._versions.clear()
+    yield
+    response_cache._versions.clear()
+
+# VERSION TESTS
+
+
+def test_versions_are_loaded_once_per_ttl(clock):
+    calls = []
+
+    def loader(keys):
+        calls.append(list(keys))
+        return {test_key: 3}
+    assert get_versions([test_key, 'reactions'], loader, clock) == {
+        test_key: 3, 'reactions': 0}
+    clock.now += response_cache.VERSION_CACHE_TTL / 2
+    assert get_versions([test_key], loader, clock) == {test_key: 3}
+    assert calls == [[test_key, 'reactions']]
+    clock.now += response_cache.VERSION_CACHE_TTL
+    get_versions([test_key], loader, clock)
+    assert len(calls) == 2
+
+
+def test_forgotten_versions_are_reloaded(clock):
+    versions = {test_key: 1}
+    assert get_versions([test_key], lambda keys: versions, clock)[test_key] == 1
+    versions[test_key] = 2
+    forget_versions([test_key])
+    assert get_versions([test_key], lambda keys: versions, clock)[test_key] == 2
+
+
+def test_etag_depends_on_path_and_versions():
+    etag = make_etag('/user/a?', {test_key: 1, 'reactions': 2})
+    assert etag == make_etag('/user/a?', {'reactions': 2, test_key: 1})
+    assert etag != make_etag('/user/a?', {test_key: 2, 'reactions': 2})
+    assert etag != make_etag('/user/b?', {test_key: 1, 'reactions': 2})
+
+# LRU TESTS
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.get_stats() == {'hits': 3, 'misses': 1, 'size': 2}
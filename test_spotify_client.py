@@ -0,0 +1,123 @@
+import asyncio
+import httpx
+import pytest
+import requests
+from spotify_client import SpotifyClient, AsyncSpotifyClient
+
+
+@pytest.fixture
+def client(stub):
+    url = f'http://127.0.0.1:{stub.server_address[1]}'
+    spotify = SpotifyClient(api_url=url + '/v1', accounts_url=url, timeout=(1, 0.5),
+                            max_retries=2, backoff=0.01)
+    yield spotify
+    spotify.close()
+
+# CLIENT TESTS
+
+
+def test_get_current_user(stub, client):
+    stub.responses.append((200, {}, {'email': 'testuser@spottem.com'}))
+    response = client.get_current_user('token')
+    assert response.json() == {'email': 'testuser@spottem.com'}
+    assert stub.requests[0][:2] == ('GET', '/v1/me')
+
+
+def test_connections_are_reused(stub, client):
+    for _ in range(5):
+        client.get_currently_playing('token')
+    client_ports = {port for _, _, port in stub.requests}
+    assert len(stub.requests) == 5
+    assert len(client_ports) == 1
+
+
+def test_retry_after_is_honored(stub, client):
+    stub.responses.append((429, {'Retry-After': '0'}, {}))
+    stub.responses.append((200, {}, {'item': None}))
+    response = client.get_currently_playing('token')
+    assert response.status_code == 200
+    assert len(stub.requests) == 2
+    assert client.get_stats()['currently-playing']['retries'] == 1
+
+
+def test_long_retry_after_is_not_waited_for(stub, client):
+    stub.responses.append((429, {'Retry-After': '3600'}, {}))
+    response = client.get_currently_playing('token')
+    assert response.status_code == 429
+    assert len(stub.requests) == 1
+
+
+def test_server_errors_are_retried_until_max_retries(stub, client):
+    stub.responses.extend([(503, {}, {})] * 3)
+    response = client.get_current_user('token')
+    assert response.status_code == 503
+    assert len(stub.requests) == 3
+
+
+def test_token_post_is_not_retried_on_server_error(stub, client):
+    stub.responses.append((500, {}, {}))
+    response = client.request_token({'grant_type': 'authorization_code'})
+    assert response.status_code == 500
+    assert stub.requests[0][:2] == ('POST', '/api/token')
+    assert len(stub.requests) == 1
+
+
+def test_timeout_raises_after_retries(stub, client):
+    stub.responses.extend([(None, {}, {})] * 3)
+    with pytest.raises(requests.Timeout):
+        client.get_currently_playing('token')
+    stats = client.get_stats()['currently-playing']
+    assert stats['errors'] == 3
+    assert stats['retries'] == 2
+
+
+def test_latency_counters(stub, client):
+    client.get_current_user('token')
+    client.get_current_user('token')
+    stats = client.get_stats()['profile']
+    assert stats['count'] == 2
+    assert stats['errors'] == 0
+    assert stats['average_seconds'] <= stats['max_seconds']
+
+# ASYNC CLIENT TESTS
+
+
+def run_async_client(stub, calls):
+    """ Returns the results of calls(client) made with an AsyncSpotifyClient on the stub, and its stats """
+    url = f'http://127.0.0.1:{stub.server_address[1]}'
+
+    async def run():
+        spotify = AsyncSpotifyClient(api_url=url + '/v1', accounts_url=url, timeout=(1, 0.5),
+                                     max_retries=2, backoff=0.01)
+        try:
+            return await calls(spotify), spotify.get_stats()
+        finally:
+            await spotify.close()
+    return asyncio.run(run())
+
+
+def test_async_client_retries_like_the_sync_client(stub):
+    stub.responses.append((429, {'Retry-After': '0'}, {}))
+    stub.responses.append((503, {}, {}))
+    stub.responses.append((200, {}, {'item': None}))
+    response, stats = run_async_client(
+        stub, lambda spotify: spotify.get_currently_playing('token'))
+    assert response.json() == {'item': None}
+    assert [request[:2] for request in stub.requests] == [
+        ('GET', '/v1/me/player/currently-playing')] * 3
+    assert stats['currently-playing']['retries'] == 2
+
+
+def test_async_client_does_not_retry_token_post(stub):
+    stub.responses.append((500, {}, {}))
+    response, _ = run_async_client(
+        stub, lambda spotify: spotify.request_token({'grant_type': 'authorization_code'}))
+    assert response.status_code == 500
+    assert len(stub.requests) == 1
+
+
+def test_async_client_timeout_raises_after_retries(stub):
+    stub.responses.extend([(None, {}, {})] * 3)
+    with pytest.raises(httpx.TimeoutException):
+        run_async_client(stub, lambda spotify: spotify.get_current_user('token'))
+    assert len(stub.requests) == 3
@@ -0,0 +1,102 @@
+import threading
+import pytest
+from spotify_client import SpotifyClient
+from token_manager import TokenManager
+
+test_email = 'testuser@spottem.com'
+
+
+class TokenStore:
+    """ Stand-in for the token collection, with the same save_token / get_token / delete_token methods as Database """
+
+    def __init__(self):
+        self.tokens = {}
+
+    def save_token(self, user_email, token):
+        self.tokens[user_email] = dict(token)
+
+    def get_token(self, user_email):
+        token = self.tokens.get(user_email)
+        return dict(token) if token else None
+
+    def delete_token(self, user_email, refresh_token=None):
+        if refresh_token in (None, self.tokens.get(user_email, {}).get('refresh_token')):
+            self.tokens.pop(user_email, None)
+
+
+@pytest.fixture
+def manager(stub, clock):
+    url = f'http://127.0.0.1:{stub.server_address[1]}'
+    spotify = SpotifyClient(api_url=url + '/v1', accounts_url=url, max_retries=0)
+    yield TokenManager(TokenStore(), spotify, 'client id', 'client secret', refresh_margin=60, clock=clock)
+    spotify.close()
+
+# TOKEN MANAGER TESTS
+
+
+def test_unknown_user_has_no_token(manager):
+    assert manager.get_access_token(test_email) is None
+
+
+def test_valid_token_is_not_refreshed(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'refresh', 'expires_in': 3600})
+    clock.now += 3000
+    assert manager.get_access_token(test_email) == 'first'
+    assert stub.requests == []
+
+
+def test_expiring_token_is_refreshed(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'refresh', 'expires_in': 3600})
+    stub.responses.append((200, {}, {'access_token': 'second', 'expires_in': 3600}))
+    clock.now += 3550
+    refreshes = []
+    assert manager.get_access_token(test_email, before_refresh=lambda: refreshes.append(1)) == 'second'
+    assert manager.get_access_token(test_email, before_refresh=lambda: refreshes.append(1)) == 'second'
+    assert refreshes == [1]
+    assert 'grant_type=refresh_token' in stub.bodies[0]
+    # the refresh token is kept when Spotify does not rotate it
+    assert manager.store.get_token('testuser@spottem-com')['refresh_token'] == 'refresh'
+
+
+def test_token_refreshed_by_another_worker_is_used(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'refresh', 'expires_in': 3600})
+    manager.store.save_token('testuser@spottem-com', {'access_token': 'other worker', 'refresh_token': 'refresh',
+                                                       'expires_at': clock.now + 7200, 'scope': None})
+    clock.now += 3550
+    assert manager.get_access_token(test_email) == 'other worker'
+    assert stub.requests == []
+
+
+def test_concurrent_refreshes_are_deduplicated(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'refresh', 'expires_in': 3600})
+    stub.responses.append((200, {}, {'access_token': 'second', 'expires_in': 3600}))
+    clock.now += 3600
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get_access_token(test_email)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ['second'] * 8
+    assert len(stub.requests) == 1
+
+
+def test_failed_refresh_returns_none(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'revoked', 'expires_in': 3600})
+    stub.responses.append((400, {}, {'error': 'invalid_grant'}))
+    clock.now += 3600
+    assert manager.get_access_token(test_email) is None
+    # the revoked token is deleted, Spotify is not asked again
+    assert manager.store.get_token('testuser@spottem-com') is None
+    assert manager.get_access_token(test_email) is None
+    assert len(stub.requests) == 1
+
+
+def test_unavailable_token_end_point_keeps_the_token(stub, manager, clock):
+    manager.save_token_info(test_email, {'access_token': 'first', 'refresh_token': 'refresh', 'expires_in': 3600})
+    stub.responses.append((503, {}, {}))
+    clock.now += 3600
+    assert manager.get_access_token(test_email) is None
+    assert manager.store.get_token('testuser@spottem-com')['refresh_token'] == 'refresh'
+
@@ -0,0 +1,131 @@
+""" Server-side storage and refreshing of users' Spotify access tokens.
+
+Spotify access tokens expire after expires_in seconds (an hour). Tokens are stored in the
+database keyed by the user's email so any worker can call Spotify for a logged in user,
+and are refreshed with the refresh token shortly before they expire instead of sending
+the user through the OAuth flow again.
+"""
+
+import os
+import threading
+import time
+import requests
+from database_manager import get_database, get_converted_email
+from spotify_client import get_spotify_client
+
+""" Refresh a token when it expires within this many seconds """
+TOKEN_REFRESH_MARGIN = int(os.environ.get('SPOTIFY_TOKEN_REFRESH_MARGIN', 60))
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+class TokenManager:
+    """ Caches users' token info in memory, backed by the database, and refreshes it before it expires """
+
+    def __init__(self, store=None, spotify=None, client_id=None, client_secret=None,
+                 refresh_margin=TOKEN_REFRESH_MARGIN, clock=time.time):
+        self.store = store or get_database()
+        self.spotify = spotify or get_spotify_client()
+        self.client_id = client_id or os.environ.get('SPOTIFY_CLIENT_ID')
+        self.client_secret = client_secret or os.environ.get(
+            'SPOTIFY_CLIENT_SECRET')
+        self.refresh_margin = refresh_margin
+        self.clock = clock
+        self._tokens = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def save_token_info(self, email, token_info):
+        """ Store the token info returned by Spotify's token end point for a user, returns the stored token """
+        email = get_converted_email(email)
+        token = {
+            "access_token": token_info['access_token'],
+            "refresh_token": token_info.get('refresh_token'),
+            "expires_at": self.clock() + token_info.get('expires_in', 3600),
+            "scope": token_info.get('scope')
+        }
+        self.store.save_token(email, token)
+        self._tokens[email] = token
+        return token
+
+    def get_access_token(self, email, before_refresh=None):
+        """ Returns a valid access token for a user, refreshing it first if it is about to expire.
+        Returns None if the user has no stored token or the refresh failed.
+        before_refresh() is called right before Spotify's token end point is, e.g. to wait for a rate limit """
+        email = get_converted_email(email)
+        token = self._tokens.get(email)
+        if token is None:
+            token = self.store.get_token(email)
+            if token is None:
+                return None
+            self._tokens[email] = token
+        if not self._expiring(token):
+            return token['access_token']
+
+        # only one thread refreshes a user's token, the others wait for its result
+        with self._lock_for(email):
+            token = self._tokens.get(email)
+            if token is not None and not self._expiring(token):
+                return token['access_token']
+            # another worker process may have refreshed it already
+            token = self.store.get_token(email)
+            if token is not None and self._expiring(token):
+                token = self._refresh(email, token, before_refresh)
+            if token is None:
+                self._tokens.pop(email, None)
+                return None
+            self._tokens[email] = token
+            return token['access_token']
+
+    def forget(self, email):
+        """ Drop a user's token from the in-memory cache, e.g. after Spotify rejected it """
+        self._tokens.pop(get_converted_email(email), None)
+
+    def _expiring(self, token):
+        """ Returns True if the token expires within the refresh margin """
+        return token['expires_at'] - self.refresh_margin <= self.clock()
+
+    def _lock_for(self, email):
+        """ Returns the refresh lock of a user """
+        with self._locks_lock:
+            return self._locks.setdefault(email, threading.Lock())
+
+    def _refresh(self, email, token, before_refresh=None):
+        """ Exchange the refresh token for a new access token, returns the new token or None """
+        if not token.get('refresh_token'):
+            return None
+        if before_refresh is not None:
+            before_refresh()
+        try:
+            response = self.spotify.request_token({
+                'grant_type': 'refresh_token',
+                'refresh_token': token['refresh_token'],
+                'client_id': self.client_id,
+                'client_secret': self.client_secret
+            })
+        except requests.RequestException:
+            # Spotify unreachable, keep using the old token while it is still valid
+            if token['expires_at'] > self.clock():
+                return token
+            return None
+        if response.status_code >= 400:
+            if response.status_code < 500 and response.status_code != 429:
+                # the refresh token was revoked or is invalid, delete it so that neither the
+                # web workers nor poller.py ask Spotify with it again until the user logs in
+                self.store.delete_token(email, token['refresh_token'])
+            return None
+        token_info = response.json()
+        # Spotify only sends a new refresh token when it rotates it
+        token_info.setdefault('refresh_token', token['refresh_token'])
+        return self.save_token_info(email, token_info)
+
+
+def get_token_manager():
+    """ Returns the process-wide TokenManager, creating it on first use """
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = TokenManager()
+    return _manager